@@ -0,0 +1,224 @@
+import math
+
+import grunt
+
+# G2/G3 arcs for Grunt(arcs=True). Arcs are cut into straight segments no
+# further than chord_tolerance (mm) from the true arc and handed to the G1
+# handler, so they take the same path as any other move: a planner or a
+# batch handler gets them like G1 lines.
+#
+#   G2 X10 Y0 I5 J0 F600    ; clockwise, centre at start + (I, J)
+#   G3 X10 Y0 R5            ; counter-clockwise, radius (negative: > 180 degrees)
+#   G2 X0 Y0 I5 P2          ; two full turns
+#
+# G17/G18/G19 select the XY (I, J), ZX (K, I) and YZ (J, K) planes; the
+# third axis moves linearly along the arc (helix). The position the arc
+# starts from is kept from every G0/G1/G2/G3, starting at 0 and absolute.
+# Registering a handler for any of these codes takes it back from here.
+#
+# The point tables of a unit arc are cached by sweep and segment count, so
+# an arc repeated in a loop, wherever it is placed, costs a lookup and a
+# rotation. With NumPy the points are worked out as arrays.
+
+ARC_CODES = ("G2", "G3", "G17", "G18", "G19")
+PLANES = {
+    # code: (first axis, second axis, linear axis, first offset, second offset)
+    "G17": ("X", "Y", "Z", "I", "J"),
+    "G18": ("Z", "X", "Y", "K", "I"),
+    "G19": ("Y", "Z", "X", "J", "K"),
+}
+CHORD_TOLERANCE = 0.002  # mm
+TABLE_CACHE_SIZE = 64
+ANGLE_EPSILON = 5e-7
+# How far the end point may be from the circle through the start point
+RADIUS_ERROR = 0.005  # mm
+RADIUS_ERROR_RELATIVE = 0.001
+
+class ArcInterpolator:
+    def __init__(self, machine, chord_tolerance=CHORD_TOLERANCE):
+        self.machine = machine
+        self.chord_tolerance = chord_tolerance
+        self.position = {"X": 0.0, "Y": 0.0, "Z": 0.0}
+        self.plane = PLANES["G17"]
+        # Same LRU as the expression cache, keyed by (sweep, segments)
+        self.tables = grunt.ExpressionCache(TABLE_CACHE_SIZE)
+        self.arcs = 0
+        self.segments = 0
+        try:
+            import numpy
+            self.numpy = numpy
+        except ImportError:
+            self.numpy = None
+
+    def move(self, args):
+        # A G0/G1 went to the handler
+        position = self.position
+        for axis in position:
+            value = args.get(axis)
+            if value is not None and not isinstance(value, str):
+                position[axis] = value
+
+    def command(self, code, args, line_no):
+        if code in PLANES:
+            self.plane = PLANES[code]
+            return None
+        return self.arc(code == "G2", args, line_no)
+
+    def arc(self, clockwise, args, line_no):
+        first, second, linear, first_offset, second_offset = self.plane
+        position = self.position
+        start_a, start_b, start_l = position[first], position[second], position[linear]
+        end_a = float(args.get(first, start_a))
+        end_b = float(args.get(second, start_b))
+        end_l = float(args.get(linear, start_l))
+        code = "G2" if clockwise else "G3"
+
+        if "R" in args:
+            center_a, center_b = self.radius_center(clockwise, float(args["R"]), end_a - start_a,
+                                                    end_b - start_b, code, line_no)
+            center_a += start_a
+            center_b += start_b
+        else:
+            if first_offset not in args and second_offset not in args:
+                raise ValueError(f"{code} at line {line_no} needs R or {first_offset}/{second_offset}")
+            center_a = start_a + float(args.get(first_offset, 0.0))
+            center_b = start_b + float(args.get(second_offset, 0.0))
+
+        # Vectors from the centre to the start and end points
+        va, vb = start_a - center_a, start_b - center_b
+        ta, tb = end_a - center_a, end_b - center_b
+        radius = math.sqrt(va * va + vb * vb)
+        error = abs(math.sqrt(ta * ta + tb * tb) - radius)
+        if error > RADIUS_ERROR and error > RADIUS_ERROR_RELATIVE * radius:
+            raise ValueError(f"{code} end point at line {line_no} is {error:.4f} mm off the arc")
+        if radius == 0:
+            raise ValueError(f"{code} at line {line_no} has a radius of 0")
+
+        sweep = math.atan2(va * tb - vb * ta, va * ta + vb * tb)
+        if clockwise:
+            if sweep >= -ANGLE_EPSILON:
+                sweep -= 2 * math.pi
+        elif sweep <= ANGLE_EPSILON:
+            sweep += 2 * math.pi
+        turns = int(args.get("P", 1))
+        if turns > 1:
+            sweep += (turns - 1) * (-2 * math.pi if clockwise else 2 * math.pi)
+
+        if self.chord_tolerance >= radius:
+            step = math.pi
+        else:
+            step = 2 * math.acos(1 - self.chord_tolerance / radius)
+        count = max(int(math.ceil(abs(sweep) / step)), 1)
+
+        self.arcs += 1
+        self.segments += count
+        position[first], position[second], position[linear] = end_a, end_b, end_l
+        words = (first, second, linear if linear in args else None, args.get("F"))
+        points = self.points(sweep, count, center_a, center_b, va, vb, start_l, end_l - start_l)
+        return self.emit(words, points, count, (end_a, end_b, end_l))
+
+    def radius_center(self, clockwise, radius, da, db, code, line_no):
+        # Centre offset from the start point for the R form. A negative R
+        # asks for the arc of more than 180 degrees.
+        distance = math.sqrt(da * da + db * db)
+        if distance == 0:
+            raise ValueError(f"{code} at line {line_no} with R can't make a full circle")
+        h = 4 * radius * radius - da * da - db * db
+        if h < 0:
+            if -h > RADIUS_ERROR * distance:
+                raise ValueError(f"{code} at line {line_no}: R {radius} is too small for the move")
+            h = 0.0
+        h = -math.sqrt(h) / distance
+        if not clockwise:
+            h = -h
+        if radius < 0:
+            h = -h
+        return 0.5 * (da - db * h), 0.5 * (db + da * h)
+
+    def table(self, sweep, count):
+        # cos and sin of each segment's angle and its fraction of the arc
+        key = (sweep, count)
+        table = self.tables.get(key)
+        if table is None:
+            np = self.numpy
+            if np is not None:
+                fractions = np.arange(1, count + 1, dtype=np.float64) / count
+                angles = fractions * sweep
+                table = (np.cos(angles), np.sin(angles), fractions)
+            else:
+                fractions = [k / count for k in range(1, count + 1)]
+                table = ([math.cos(f * sweep) for f in fractions], [math.sin(f * sweep) for f in fractions],
+                         fractions)
+            self.tables.put(key, table)
+        return table
+
+    def points(self, sweep, count, center_a, center_b, va, vb, start_l, dl):
+        # Columns of the end points of the segments: the unit arc rotated to
+        # start at (va, vb), moved to the centre
+        cos, sin, fractions = self.table(sweep, count)
+        if self.numpy is not None:
+            return (center_a + va * cos - vb * sin, center_b + va * sin + vb * cos, start_l + dl * fractions)
+        return ([center_a + va * c - vb * s for c, s in zip(cos, sin)],
+                [center_b + va * s + vb * c for c, s in zip(cos, sin)],
+                [start_l + dl * f for f in fractions])
+
+    def emit(self, words, points, count, end):
+        machine = self.machine
+        handler = machine.gcode_handlers.get("G1")
+        if handler is None:
+            print("Unknown command: G1 (arc segments)")
+            return None
+        first, second, linear, feed = words
+        a, b, l = points
+        if self.numpy is not None:
+            a, b, l = a.tolist(), b.tolist(), l.tolist()
+        # The last point is exactly the end point, whatever rounding did
+        a[-1], b[-1], l[-1] = end
+
+        if isinstance(handler, grunt.BatchCollector):
+            return self.emit_batch(handler, first, second, linear, feed, a, b, l)
+
+        rows = []
+        for i in range(count):
+            args = {first: a[i], second: b[i]}
+            if linear is not None:
+                args[linear] = l[i]
+            if feed is not None:
+                args["F"] = feed
+            rows.append(args)
+        if machine.pending_batch is not None and handler is not machine.pending_batch:
+            machine.flush_batch()
+        rows = iter(rows)
+        for args in rows:
+            result = handler(args)
+            if result is not None and grunt.is_awaitable(result):
+                return self.finish_async(result, handler, rows)
+        return None
+
+    async def finish_async(self, result, handler, rows):
+        # The G1 handler is a coroutine: the rest of the segments wait for it
+        await result
+        for args in rows:
+            result = handler(args)
+            if result is not None and grunt.is_awaitable(result):
+                await result
+
+    def emit_batch(self, collector, first, second, linear, feed, a, b, l):
+        # The whole arc as one array for a batch handler
+        machine = self.machine
+        np = collector.numpy
+        if machine.pending_batch is not None:
+            machine.flush_batch()
+        keys = [first, second] + ([linear] if linear is not None else []) + (["F"] if feed is not None else [])
+        batch = np.empty(len(a), dtype=[(key, 'f8') for key in keys])
+        batch[first] = a
+        batch[second] = b
+        if linear is not None:
+            batch[linear] = l
+        if feed is not None:
+            batch["F"] = feed
+        for start in range(0, len(batch), collector.max_batch):
+            collector.handler(batch[start:start + collector.max_batch])
+
+    def stats(self):
+        return {"arcs": self.arcs, "segments": self.segments, "tables": self.tables.stats()}
@@ -0,0 +1,37 @@
+import json
+import sys
+
+# Compare two result files saved by benchmarks.run:
+#
+#   python -m benchmarks.compare before.json after.json
+#
+# Ratios above 1 mean the second file is faster (or uses less memory).
+
+METRICS = ("lines_per_s", "statements_per_s", "evals_per_s")
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {(r["workload"], r["size"]): r for r in report["results"]}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("Usage: python -m benchmarks.compare <before.json> <after.json>")
+        return 1
+    before_report, before = load(argv[0])
+    after_report, after = load(argv[1])
+    print(f"{before_report.get('commit')} -> {after_report.get('commit')}")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        ratios = []
+        for metric in METRICS:
+            if old[metric]:
+                ratios.append(f"{metric}={new[metric] / old[metric]:.2f}x")
+        if new["peak_bytes"]:
+            ratios.append(f"memory={old['peak_bytes'] / new['peak_bytes']:.2f}x")
+        print(f"{key[0]:18} {key[1]:>8} " + " ".join(ratios))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import grunt
+from benchmarks.run import MOTION_CODES, git_commit
+from benchmarks.workloads import WORKLOADS
+
+# Memory use of the interpreter on CPython, to catch regressions before
+# flashing a board:
+#   - for each workload, with and without low_memory, the bytes allocated
+#     per executed statement (tracemalloc peak above what was already live,
+#     measured around every statement) and the peak of the whole run
+#   - the time and memory it takes to import grunt, and the modules it pulls
+#     in, each in a fresh interpreter
+#
+#   python -m benchmarks.memory --size 2000 --out memory.json
+#   python -m benchmarks.memory --max-bytes 64 --max-import-kb 200
+#
+# With --max-bytes or --max-import-kb it exits with status 1 when a limit
+# is exceeded.
+
+IMPORT_SCRIPT = """
+import sys, time, tracemalloc
+before = set(sys.modules)
+tracemalloc.start()
+start = time.perf_counter()
+import grunt
+elapsed = time.perf_counter() - start
+current, peak = tracemalloc.get_traced_memory()
+print(elapsed, current, peak, ",".join(sorted(set(sys.modules) - before)))
+"""
+
+def make_machine(low_memory):
+    machine = grunt.Grunt(low_memory=low_memory)
+    for code in MOTION_CODES:
+        machine.register(code, lambda args: None)
+    return machine
+
+def statement_allocations(program, low_memory):
+    # Run with every statement that isn't a block wrapped, resetting the
+    # tracemalloc peak before it and reading it after. Blocks are left out
+    # so their bodies aren't counted twice.
+    machine = make_machine(low_memory)
+    compiled = machine.compile(program)
+    machine.run_compiled(compiled)  # Create variables and warm the cache first
+    totals = {"statements": 0, "bytes": 0}
+    get_traced_memory = tracemalloc.get_traced_memory
+    reset_peak = tracemalloc.reset_peak
+
+    def measured(execute):
+        def wrapper(node):
+            current = get_traced_memory()[0]
+            reset_peak()
+            result = execute(node)
+            totals["bytes"] += get_traced_memory()[1] - current
+            totals["statements"] += 1
+            return result
+        return wrapper
+
+    for op in (grunt.OP_GCODE, grunt.OP_SET, grunt.OP_WRITEPIN, grunt.OP_WRITEMSG, grunt.OP_MACRO):
+        machine.dispatch[op] = measured(machine.dispatch[op])
+    tracemalloc.start()
+    try:
+        start = get_traced_memory()[0]
+        reset_peak()
+        machine.run_compiled(compiled)
+        peak = get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return totals["bytes"] / max(totals["statements"], 1), peak
+
+def import_cost(repeat):
+    # Best of repeat imports, each in a new interpreter
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True,
+                                text=True, check=True).stdout.split()
+        elapsed, current, peak = float(output[0]), int(output[1]), int(output[2])
+        if best is None or elapsed < best["import_s"]:
+            best = {"import_s": elapsed, "import_bytes": current, "import_peak_bytes": peak,
+                    "modules": output[3].split(",") if len(output) > 3 else []}
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the memory use of the Grunt interpreter")
+    parser.add_argument("--size", type=int, default=2000, help="workload size (statements)")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workload names")
+    parser.add_argument("--repeat", type=int, default=3, help="imports to time, best is kept")
+    parser.add_argument("--max-bytes", type=float,
+                        help="fail if low_memory allocates more per statement on any workload")
+    parser.add_argument("--max-import-kb", type=float, help="fail if importing grunt takes more memory")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    failures = []
+    results = []
+    for name in options.workloads.split(","):
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload: {name}")
+        program = WORKLOADS[name](options.size)
+        result = {"workload": name, "size": options.size}
+        for low_memory in (False, True):
+            per_statement, peak = statement_allocations(program, low_memory)
+            prefix = "low_memory_" if low_memory else ""
+            result[prefix + "bytes_per_statement"] = per_statement
+            result[prefix + "peak_bytes"] = peak
+        results.append(result)
+        print(f"{name:18} {options.size:>8} bytes/stmt={result['bytes_per_statement']:>8.1f} "
+              f"low_memory={result['low_memory_bytes_per_statement']:>8.1f} "
+              f"peak={result['peak_bytes'] / 1e3:.1f}kB low_memory={result['low_memory_peak_bytes'] / 1e3:.1f}kB")
+        if options.max_bytes is not None and result["low_memory_bytes_per_statement"] > options.max_bytes:
+            failures.append(f"{name} allocates {result['low_memory_bytes_per_statement']:.1f} bytes per statement")
+
+    imports = import_cost(options.repeat)
+    print(f"import grunt: {imports['import_s'] * 1000:.2f}ms {imports['import_bytes'] / 1e3:.1f}kB "
+          f"(peak {imports['import_peak_bytes'] / 1e3:.1f}kB), modules: {', '.join(imports['modules'])}")
+    if options.max_import_kb is not None and imports["import_bytes"] / 1e3 > options.max_import_kb:
+        failures.append(f"import grunt takes {imports['import_bytes'] / 1e3:.1f}kB")
+
+    if options.out:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "import": imports,
+            "results": results,
+        }
+        with open(options.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {options.out}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import grunt
+from benchmarks.workloads import WORKLOADS
+
+# Throughput of Grunt.compile and Grunt.run_compiled on the generated
+# workloads, with no-op handlers so only the interpreter is measured.
+#
+#   python -m benchmarks.run --sizes 10000,100000 --out results.json
+#
+# Each workload is timed in its own pass, then run again once with
+# tracemalloc for peak memory and once with counting wrappers for the number
+# of statements and expression evaluations, so neither slows the timings.
+
+MOTION_CODES = ("G0", "G1")
+
+def make_machine():
+    machine = grunt.Grunt()
+    for code in MOTION_CODES:
+        machine.register(code, lambda args: None)
+    return machine
+
+def time_phases(program, repeat):
+    # Best of repeat runs, on a fresh machine each time
+    best_compile = best_execute = float('inf')
+    for _ in range(repeat):
+        machine = make_machine()
+        start = time.perf_counter()
+        compiled = machine.compile(program)
+        middle = time.perf_counter()
+        machine.run_compiled(compiled)
+        end = time.perf_counter()
+        best_compile = min(best_compile, middle - start)
+        best_execute = min(best_execute, end - middle)
+    return best_compile, best_execute
+
+def peak_memory(program):
+    machine = make_machine()
+    tracemalloc.start()
+    try:
+        machine.run_compiled(machine.compile(program))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def count_work(program):
+    # Number of statements run and expressions evaluated
+    machine = make_machine()
+    compiled = machine.compile(program)
+    counts = {"statements": 0, "expressions": 0}
+
+    def counted(function, key):
+        def wrapper(*args):
+            counts[key] += 1
+            return function(*args)
+        return wrapper
+
+    machine.dispatch = [counted(entry, "statements") for entry in machine.dispatch]
+    machine.evaluate_rpn = counted(machine.evaluate_rpn, "expressions")
+    machine.run_compiled(compiled)
+    return counts
+
+def run_workload(name, size, repeat):
+    program = WORKLOADS[name](size)
+    compile_time, execute_time = time_phases(program, repeat)
+    counts = count_work(program)
+    total = compile_time + execute_time
+    return {
+        "workload": name,
+        "size": size,
+        "source_lines": program.count("\n") + 1,
+        "statements": counts["statements"],
+        "expression_evals": counts["expressions"],
+        "compile_s": compile_time,
+        "execute_s": execute_time,
+        "lines_per_s": (program.count("\n") + 1) / total,
+        "statements_per_s": counts["statements"] / execute_time if execute_time else 0.0,
+        "evals_per_s": counts["expressions"] / execute_time if execute_time else 0.0,
+        "peak_bytes": peak_memory(program),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Grunt interpreter")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="comma separated workload sizes (statements)")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workload names")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per workload, best is kept")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    results = []
+    for name in options.workloads.split(","):
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload: {name}")
+        for size in options.sizes.split(","):
+            result = run_workload(name, int(size), options.repeat)
+            results.append(result)
+            print(f"{name:18} {result['size']:>8} lines/s={result['lines_per_s']:>12.0f} "
+                  f"stmts/s={result['statements_per_s']:>12.0f} evals/s={result['evals_per_s']:>12.0f} "
+                  f"compile={result['compile_s']:.3f}s execute={result['execute_s']:.3f}s "
+                  f"peak={result['peak_bytes'] / 1e6:.1f}MB")
+
+    if options.out:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": options.repeat,
+            "results": results,
+        }
+        with open(options.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {options.out}")
+
+if __name__ == "__main__":
+    main()
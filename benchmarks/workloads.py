@@ -0,0 +1,65 @@
+# Generated Grunt programs for the benchmarks. Every generator takes a size,
+# roughly the number of statements the program runs, and returns the same
+# text for the same size so results can be compared between commits.
+
+def straight_g1(size):
+    # A toolpath of literal moves, like CAM output
+    lines = ["G1 F1200"]
+    for i in range(size - 1):
+        x = (i * 37) % 2000 / 10
+        y = (i * 53) % 1500 / 10
+        lines.append(f"G1 X{x:.3f} Y{y:.3f}")
+    return "\n".join(lines)
+
+def nested_loops(size):
+    # FOR inside WHILE inside FOR, size statements in the innermost body
+    inner = 10
+    middle = 10
+    outer = max(size // (inner * middle * 2), 1)
+    return "\n".join([
+        f"FOR #i 1 {outer}",
+        "  #j = 0",
+        f"  WHILE #j < {middle}",
+        f"    FOR #k 1 {inner}",
+        "      G1 X[#k] Y[#j]",
+        "    ENDFOR",
+        "    #j = [#j + 1]",
+        "  ENDWHILE",
+        "ENDFOR",
+    ])
+
+def macro_heavy(size):
+    # Many CALLs of small macros that call each other
+    lines = [
+        "MACRO corner",
+        "  G1 X[$1] Y[$2]",
+        "  G1 X[$1 + $3] Y[$2]",
+        "ENDMACRO",
+        "MACRO square",
+        "  CALL corner $1 $2 $3",
+        "  CALL corner [$1 + $3] [$2 + $3] [0 - $3]",
+        "ENDMACRO",
+    ]
+    # Each square runs 7 statements
+    for i in range(max(size // 7, 1)):
+        lines.append(f"CALL square {i % 100} {i % 70} {1 + i % 5}")
+    return "\n".join(lines)
+
+def expression_heavy(size):
+    # Parametric program where every word is computed
+    lines = [
+        "#radius = 25",
+        "#step = 0.5",
+        "#n = 0",
+    ]
+    for i in range(max(size // 2, 1)):
+        lines.append(f"#n = [#n + #step * {i % 7 + 1}]")
+        lines.append(f"G1 X[#radius + #n / {i % 9 + 1}] Y[#radius * 2 - #n] Z[#n * #step - {i % 3}]")
+    return "\n".join(lines)
+
+WORKLOADS = {
+    "straight_g1": straight_g1,
+    "nested_loops": nested_loops,
+    "macro_heavy": macro_heavy,
+    "expression_heavy": expression_heavy,
+}
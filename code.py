@@ -7,7 +7,14 @@ from adafruit_wiznet5k.adafruit_wiznet5k_socketpool import SocketPool
 import pwmio
 import adafruit_motor.servo
 import grunt
-import time
+import protocol
+import ringbuffer
+import sessions
+import pins
+import programcache
+import stepgen
+import asyncio
+import json
 
 
 def mac_string_to_tuple(mac_string):
@@ -22,30 +29,27 @@ def ip_string_to_tuple(ip_string):
 def ip_tuple_to_string(ip_tuple):
     return ".".join(str(part) for part in ip_tuple)
 
-class SimpleQueue:
-    def __init__(self):
-        self.queue = []
-    
-    def append(self, item):
-        self.queue.append(item)
-    
-    def popleft(self):
-        if self.queue:
-            return self.queue.pop(0)
-        else:
-            raise IndexError("pop from an empty queue")
-    
-    def __len__(self):
-        return len(self.queue)
+# Queue to store incoming messages. A host flooding [GCODE] messages pushes
+# out the oldest ones instead of running the board out of memory.
+MESSAGE_QUEUE_SIZE = 32
+MESSAGE_QUEUE_OVERFLOW = ringbuffer.DROP_OLDEST
+message_queue = ringbuffer.RingBuffer(MESSAGE_QUEUE_SIZE, MESSAGE_QUEUE_OVERFLOW)
 
-# Queue to store incoming messages
-message_queue = SimpleQueue()
+# Queue of statements waiting for the interpreter. Sequenced lines are kept
+# within it by the receive window; plain lines beyond it get "ERROR busy".
+COMMAND_QUEUE_SIZE = 2 * protocol.WINDOW_SIZE
+command_queue = ringbuffer.RingBuffer(COMMAND_QUEUE_SIZE, ringbuffer.REJECT)
 
 # Message identifier for G-code messages
-GCODE_IDENTIFIER = "[GCODE]"
+GCODE_IDENTIFIER = protocol.GCODE_IDENTIFIER
 
-# Flag to indicate if receive_message is waiting for a message
-receiving_message = False
+# Compiled programs uploaded by the host and run with RUNCACHED <key>. They
+# are kept in memory unless a directory is set; to keep them on flash, make
+# the filesystem writable in boot.py (storage.remount("/", readonly=False))
+# and set this to e.g. "/cache".
+PROGRAM_CACHE_DIR = None
+PROGRAM_CACHE_BUDGET = 64 * 1024
+program_cache = programcache.ProgramCache(PROGRAM_CACHE_DIR, PROGRAM_CACHE_BUDGET)
 
 # Configuration
 SPI1_SCK = board.GP10
@@ -56,6 +60,21 @@ W5500_RSTn = board.GP15
 
 STEPPER_STEP_PIN = board.GP3
 STEPPER_DIR_PIN = board.GP2
+STEPPER_MAX_RATE = 2000  # steps/s
+STEPPER_ACCEL = 8000  # steps/s^2
+
+# Axes that G0/G1 (and arcs) move together: step pin, direction pin and
+# steps per mm. X is the stepper G14 drives. Uncomment the others once
+# their drivers are wired up.
+STEPS_PER_MM = 80.0
+MOTION_AXES = {
+    "X": (STEPPER_STEP_PIN, STEPPER_DIR_PIN, STEPS_PER_MM),
+    # "Y": (board.GP7, board.GP8, STEPS_PER_MM),
+    # "Z": (board.GP9, board.GP14, STEPS_PER_MM),
+}
+MOTION_FEED = 600.0  # mm/min until a program sets F
+MOTION_RAPID_FEED = 1500.0  # mm/min for G0
+MOTION_ACCEL = 100.0  # mm/s^2
 
 RELAY_PIN = board.GP4
 LED_PIN = board.GP25
@@ -107,9 +126,9 @@ pool = SocketPool(eth)
 
 # Create a socket
 sock = pool.socket(pool.AF_INET, pool.SOCK_STREAM)
-sock.settimeout(10)  # Optional: Add a timeout for the socket
+sock.settimeout(0)  # Non-blocking, the server task polls it
 sock.bind((eth.pretty_ip(eth.ip_address), 5000))
-sock.listen(1)
+sock.listen(sessions.MAX_SESSIONS)
 
 print("Listening on port 5000...")
 
@@ -121,6 +140,24 @@ step_pin = digitalio.DigitalInOut(STEPPER_STEP_PIN)
 dir_pin = digitalio.DigitalInOut(STEPPER_DIR_PIN)
 step_pin.direction = digitalio.Direction.OUTPUT
 dir_pin.direction = digitalio.Direction.OUTPUT
+stepper = stepgen.DeadlineStepper(step_pin, dir_pin)
+
+def output_pin(pin):
+    # The G14 stepper's pins are already claimed, so they are shared
+    if pin is STEPPER_STEP_PIN:
+        return step_pin
+    if pin is STEPPER_DIR_PIN:
+        return dir_pin
+    io = digitalio.DigitalInOut(pin)
+    io.direction = digitalio.Direction.OUTPUT
+    return io
+
+motion_axes = {}
+for name, (axis_step_pin, axis_dir_pin, steps_per_mm) in MOTION_AXES.items():
+    motion_axes[name] = stepgen.StepperAxis(output_pin(axis_step_pin), output_pin(axis_dir_pin),
+                                            steps_per_mm, STEPPER_MAX_RATE)
+motion = stepgen.MultiAxisStepper(motion_axes)
+motion_feed = MOTION_FEED
 
 relay = digitalio.DigitalInOut(RELAY_PIN)
 relay.direction = digitalio.Direction.OUTPUT
@@ -128,43 +165,81 @@ relay.direction = digitalio.Direction.OUTPUT
 led = digitalio.DigitalInOut(LED_PIN)
 led.direction = digitalio.Direction.OUTPUT
 
-listening_pins = {}
+# Connected clients. The one in control runs commands, the others watch.
+server = sessions.SessionServer(sock)
 
-# Function to move the stepper motor
-def move_stepper(steps, direction):
-    dir_pin.value = direction
-    for _ in range(steps):
-        step_pin.value = True
-        time.sleep(0.001)
-        step_pin.value = False
-        time.sleep(0.001)
+# Function to move the stepper motor, letting the other tasks run in between steps
+async def move_stepper(steps, direction):
+    await stepper.move_async(int(steps), direction, STEPPER_MAX_RATE, STEPPER_ACCEL)
 
 # Function to handle commands
-def handle_command(command, conn):
-    global listening_pins
-    
-    if command.startswith("test on"):
+async def handle_command(command):
+    if isinstance(command, grunt.Program):
+        # A binary frame
+        await machine.run_async(command)
+    elif command.startswith("test on"):
         led.value = True
     elif command.startswith("test off"):
         led.value = False
-    elif command.startswith("autoauth"):
-        code = int(command.split(" ")[1])
-        conn.send(f"{code}".encode("utf-8"))
+    elif command.startswith("RUNCACHED"):
+        # RUNCACHED <key>: run a compiled program without parsing anything
+        words = command.split()
+        if len(words) != 2:
+            raise ValueError("RUNCACHED needs a program key")
+        program = program_cache.load(machine, words[1])
+        if program is None:
+            raise ValueError(f"Program {words[1]} is not cached")
+        await machine.run_async(program)
+    elif command.startswith("UPLOAD"):
+        # UPLOAD <key> <base64 chunk> ... UPLOAD <key> END
+        words = command.split()
+        if len(words) != 3:
+            raise ValueError("UPLOAD needs a program key and data")
+        if words[2] == "END":
+            size = program_cache.finish_upload(words[1])
+            print(f"Cached program {words[1]} ({size} bytes)")
+        else:
+            program_cache.upload(words[1], words[2])
     else:
-        machine.run(command)
-    return "OK"
+        await machine.run_async(command)
 
 
-machine = grunt.Grunt()
+machine = grunt.Grunt(arcs=True)
 
 # Stepper 
-def g14_handler(args):
+async def g14_handler(args):
     # G14 (S)TEPS (D)IRECTION (+/-)
     s = args.get("S", 0)
     d = args.get("D", "+")
-    move_stepper(s,d=="+")
+    await move_stepper(s,d=="+")
+    # Keep the position G1 moves and G2/G3 arcs start from when G14 turned
+    # the X motor
+    if "X" in motion.axes and motion.axes["X"].step_pin is step_pin:
+        motion.position["X"] += int(s) if d == "+" else -int(s)
+        machine.arcs.position["X"] = motion.position["X"] / motion.axes["X"].steps_per_mm
 machine.register("G14", g14_handler)
 
+# Straight moves of all axes at once, to absolute positions in mm
+async def move_axes(args, feed):
+    target = {}
+    for name in motion.axes:
+        if name in args:
+            target[name] = motion.steps_for(name, float(args[name]))
+    await motion.move_async(target, feed, MOTION_ACCEL)
+
+async def g0_handler(args):
+    # G0 X Y Z, at the rapid feed
+    await move_axes(args, MOTION_RAPID_FEED)
+machine.register("G0", g0_handler)
+
+async def g1_handler(args):
+    # G1 X Y Z (F)eed in mm/min; arcs (G2/G3) come here as short G1 moves
+    global motion_feed
+    if "F" in args:
+        motion_feed = float(args["F"])
+    await move_axes(args, motion_feed)
+machine.register("G1", g1_handler)
+
 # Servo
 def g15_handler(args):
     # G15 (A)ngle
@@ -185,109 +260,207 @@ def m11_handler(args):
     relay.value = True
 machine.register("M11", m11_handler)
 
-allowed_pins = [board.GP5]
+# Pins programs can use, by the number used in READ, WRITE and WAIT PIN
+INPUT_PINS = {0: board.GP5}
+OUTPUT_PINS = {}
+pin_manager = pins.PinManager(INPUT_PINS, OUTPUT_PINS)
 
 def read_pin(pin_number):
-        print(f"Reading from pin {pin_number}")
-        if len(allowed_pins) >= pin_number:
-            return 0
-        pin = digitalio.DigitalInOut(allowed_pins[pin_number])
-        pin.direction = digitalio.Direction.INPUT
-        return pin.value
+    print(f"Reading from pin {pin_number}")
+    if not pin_manager.has_pin(pin_number):
+        return 0
+    return pin_manager.read(pin_number)
 machine.register("READ", read_pin)
 
 def write_pin(pin_number, value):
     print(f"Writing value {value} to pin {pin_number}")
-    if len(allowed_pins) > pin_number:
-        pin = digitalio.DigitalInOut(allowed_pins[pin_number])
-        pin.direction = digitalio.Direction.OUTPUT
-        pin.value = bool(value)  # Set pin to True or False based on value
+    if pin_number in pin_manager.outputs:
+        pin_manager.write(pin_number, value)
     else:
-        print(f"Error: Pin number {pin_number} is out of allowed range")
+        print(f"Error: Pin number {pin_number} is not an output")
 
 machine.register("WRITEPIN", write_pin)
 
+async def wait_pin(pin_number, value, timeout):
+    # WAIT PIN <pin> <value> <timeout>
+    return await pin_manager.wait(pin_number, value, timeout)
+
+machine.register("WAITPIN", wait_pin)
+
+# Pin changes go to every client as they happen
+def broadcast_pin_event(event):
+    timestamp, pin_number, value = event
+    server.broadcast(f"Pin {pin_number} changed to {value} at {timestamp // 1000000}\n")
+
+pin_manager.listeners.append(broadcast_pin_event)
+
 def send_message(message):
     full_message = f"{GCODE_IDENTIFIER} {message}"
-    conn.send(f"{full_message}\n".encode("utf-8"))
+    server.broadcast(f"{full_message}\n")
     print(f"Sent message: {full_message}")
 
 machine.register("WRITEMSG", send_message)
 
-def receive_message(timeout):
-    global message_queue, receiving_message
+async def receive_message(timeout):
+    # The server task queues every [GCODE] message as it arrives
     start_time = time.monotonic()
-    
-    # Set the flag indicating we're waiting for a message
-    receiving_message = True
-    
-    # Check if there is a message in the queue
-    if message_queue:
-        receiving_message = False
-        return message_queue.popleft()
-
-    # Wait for a message with the identifier
     while (time.monotonic() - start_time) < timeout:
-        try:
-            data = conn.recv(1024).decode("utf-8").strip()
-            if data.startswith(GCODE_IDENTIFIER):
-                message = data[len(GCODE_IDENTIFIER):].strip()
-                receiving_message = False
-                return message
-        except Exception as e:
-            print(f"Error receiving message: {e}")
-            break
+        if message_queue:
+            return message_queue.popleft()
+        await asyncio.sleep(0.01)
 
-    # If no message is received within the timeout, reset the flag
-    receiving_message = False
     print(f"No message received within {timeout} seconds.")
     return None
 
 machine.register("RECV", receive_message)
 
-# Main loop to listen for commands and poll pins
-while True:
-    try:
-        conn, addr = sock.accept()
-        print(f"Connected by {addr}")
-        
-        while True:
+def queue_status():
+    parts = ["QUEUES"]
+    for name, queue in (("messages", message_queue), ("commands", command_queue)):
+        stats = queue.stats()
+        parts.append(f"{name}={stats['length']}/{stats['capacity']} high={stats['high_water']} "
+                     f"dropped={stats['dropped']} rejected={stats['rejected']}")
+    return " ".join(parts) + "\n"
+
+def handle_stats(session, command):
+    # STATS [ON|OFF|RESET]. Anyone may look, only the session in control
+    # may switch profiling.
+    action = command[5:].strip().upper()
+    if action and session is not server.owner:
+        session.send("ERROR read-only\n")
+        return
+    if action == "ON":
+        machine.enable_profiling()
+    elif action == "OFF":
+        machine.disable_profiling()
+    elif action == "RESET":
+        if machine.profiler is not None:
+            machine.disable_profiling()
+            machine.enable_profiling()
+    elif action:
+        session.send(f"ERROR Unknown STATS action: {action}\n")
+        return
+    stats = machine.stats()
+    stats["queues"] = {"messages": message_queue.stats(), "commands": command_queue.stats()}
+    stats["pins"] = pin_manager.stats()
+    stats["program_cache"] = program_cache.stats()
+    session.send(f"STATS {json.dumps(stats)}\n")
+
+# Answered by any session straight away, without waiting for the interpreter
+def handle_immediate(session, line):
+    command = line.strip()
+    if command == "QUEUES":
+        session.send(queue_status())
+        return True
+    if command.startswith("STATS"):
+        handle_stats(session, command)
+        return True
+    if command.startswith("autoauth"):
+        try:
+            code = int(command.split(" ")[1])
+        except (IndexError, ValueError):
+            session.send("ERROR bad autoauth\n")
+            return True
+        session.send(f"{code}\n")
+        return True
+    return server.handle_session_command(session, command)
+
+async def handle_session_line(session, line):
+    if handle_immediate(session, line):
+        return
+
+    # Only the session in control may queue commands or RECV messages
+    if session is not server.owner:
+        seq, text = protocol.parse_frame(line)
+        session.send(protocol.reply_lines([seq], "read-only")[0])
+        return
+
+    reply, message, statement = session.receiver.handle_line(line)
+    if reply is not None:
+        session.send(reply)
+    # G-code messages are kept for RECV
+    if message is not None:
+        if not await message_queue.put(message):
+            session.send("BUSY messages\n")
+    if statement is not None:
+        program, seqs = statement
+        if not command_queue.append((program, session, seqs)):
+            session.receiver.finished(seqs)
+            for reply in protocol.reply_lines(seqs, "busy"):
+                session.send(reply)
+
+def handle_session_frame(session, frame):
+    # A binary motion frame goes to the interpreter as an already compiled
+    # command, without any text to parse
+    if session is not server.owner:
+        session.send(protocol.reply_lines([frame[0]], "read-only")[0])
+        return
+    replies, statement = session.receiver.handle_frame(frame)
+    if replies is not None:
+        session.send(replies)
+    if statement is not None:
+        (code, args), seqs = statement
+        if not command_queue.append((machine.gcode_program(code, args), session, seqs)):
+            session.receiver.finished(seqs)
+            for reply in protocol.reply_lines(seqs, "busy"):
+                session.send(reply)
+
+# Accept clients and poll all of them without blocking the other tasks
+async def server_task():
+    while True:
+        server.accept()
+        idle = True
+        for session in list(server.sessions):
+            received = session.read()
+            if received is None:
+                continue
+            idle = False
+            if not received:
+                server.close(session)
+                continue
+
             try:
-                # Poll the listening pins for changes
-                for pin_number, info in list(listening_pins.items()):
-                    pin = info['pin']
-                    current_value = pin.value
-                    if current_value != info['last_value']:
-                        listening_pins[pin_number]['last_value'] = current_value
-                        message = f"Pin {pin_number} changed to {current_value}\n"
-                        conn.send(message.encode("utf-8"))
-                
-                # Check for incoming commands
-                data = conn.recv(1024).decode("utf-8")
-                if not data:
-                    break
-
-                # If receive_message is active, skip G-code messages
-                if receiving_message and data.startswith(GCODE_IDENTIFIER):
-                    continue
-
-                # If it's a G-code message and not waiting, add to the queue
-                if data.startswith(GCODE_IDENTIFIER):
-                    message_queue.append(data[len(GCODE_IDENTIFIER):].strip())
-                    continue
-
-                # Handle other commands
-                response = handle_command(data.strip(), conn)
-                conn.send(response.encode("utf-8"))
-                
-            except Exception as e:
-                print(f"Error: {e}")
-                break
-        
-        conn.close()
-        print(f"Connection with {addr} closed.")
-    
-    except KeyboardInterrupt:
-        print("Server stopped.")
-        sock.close()
-        break
\ No newline at end of file
+                items = session.receiver.framer.feed(session.buffer, received)
+            except ValueError as e:
+                session.send(f"ERROR {e}\n")
+                continue
+            for item in items:
+                if isinstance(item, str):
+                    await handle_session_line(session, item)
+                else:
+                    handle_session_frame(session, item)
+
+        server.flush()
+        # Nobody in control can finish an upload, so don't keep half of it
+        if server.owner is None and program_cache.upload_key is not None:
+            program_cache.cancel_upload()
+        await asyncio.sleep(0.005 if idle else 0)
+
+# Run queued statements one at a time and reply to whoever sent them
+async def interpreter_task():
+    while True:
+        if not command_queue:
+            await asyncio.sleep(0.005)
+            continue
+
+        command, session, seqs = command_queue.popleft()
+        error = None
+        try:
+            await handle_command(command)
+        except Exception as e:
+            print(f"Error: {e}")
+            error = str(e)
+        session.receiver.finished(seqs)
+
+        # Queued on the session even if it has gone; the server task drops it
+        for reply in protocol.reply_lines(seqs, error):
+            session.send(reply)
+
+async def main():
+    await asyncio.gather(server_task(), interpreter_task(), pin_manager.run())
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print("Server stopped.")
+    sock.close()
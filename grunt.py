@@ -1,23 +1,564 @@
-import re
+from array import array
+
+# Node types of a compiled program. Every node is a tuple that starts with
+# its type and the source line number it came from. Expressions are stored
+# as compiled RPN.
+OP_GCODE = 0     # (OP_GCODE, line_no, code, handler_cell, args, dynamic)
+OP_IF = 1        # (OP_IF, line_no, [(condition, body), ...], else_body, [line_no of each branch])
+OP_FOR = 2       # (OP_FOR, line_no, slot, start, end, body)
+OP_WHILE = 3     # (OP_WHILE, line_no, condition, body)
+OP_CALL = 4      # (OP_CALL, line_no, macro_name, [arg, ...])
+OP_MACRO = 5     # (OP_MACRO, line_no, macro_name, body)
+OP_SET = 6       # (OP_SET, line_no, slot, expression)
+OP_WRITEPIN = 7  # (OP_WRITEPIN, line_no, pin_number, value)
+OP_WRITEMSG = 8  # (OP_WRITEMSG, line_no, [text or expression, ...])
+OP_WAIT = 9      # (OP_WAIT, line_no, pin_number, value, timeout, result_slot)
+OP_COUNT = 10
+
+BLOCK_ENDS = ("ELSEIF", "ELSE", "ENDIF", "ENDFOR", "ENDWHILE", "ENDMACRO")
+
+# Item kinds of a compiled expression. Each item is a (kind, value) pair.
+EXPR_CONST = 0  # value is a float
+EXPR_VAR = 1    # value is a variable slot
+EXPR_OP = 2     # value is a two argument function
+EXPR_IO = 3     # value is the name of the handler to call (READ or RECV)
+EXPR_ARG = 4    # value is the index of a macro argument ($1 is index 0)
+
+IO_FUNCTIONS = ("READ", "RECV")
+
+PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, '<': 0, '>': 0, '<=': 0, '>=': 0, '==': 0, '!=': 0}
+
+# Operators are plain module functions, so creating a Grunt doesn't build
+# new ones and compiled programs from any Grunt share them
+def op_add(a, b):
+    return a + b
+
+def op_sub(a, b):
+    return a - b
+
+def op_mul(a, b):
+    return a * b
+
+def op_div(a, b):
+    return a / b  # Be mindful of division by zero
+
+def op_lt(a, b):
+    return a < b
+
+def op_gt(a, b):
+    return a > b
+
+def op_le(a, b):
+    return a <= b
+
+def op_ge(a, b):
+    return a >= b
+
+def op_eq(a, b):
+    return a == b
+
+def op_ne(a, b):
+    return a != b
+
+OPERATORS = {'+': op_add, '-': op_sub, '*': op_mul, '/': op_div, '<': op_lt, '>': op_gt,
+             '<=': op_le, '>=': op_ge, '==': op_eq, '!=': op_ne}
+
+# Comparison words that can be used in place of the symbols
+WORD_OPERATORS = {"LT": "<", "GT": ">", "LE": "<=", "GE": ">=", "EQ": "==", "NE": "!="}
+
+# Size of the evaluation stack allocated up front in low_memory mode
+STACK_SIZE = 32
+
+def is_awaitable(value):
+    # CircuitPython coroutines are generators and have no __await__
+    return hasattr(value, "__await__") or hasattr(value, "send")
+
+def iter_lines(source):
+    # Yield text lines from a program string, an iterable of str/bytes lines,
+    # or anything with readline() (files, socket.makefile(), mmap)
+    if isinstance(source, str):
+        source = source.split("\n")
+    elif hasattr(source, "readline"):
+        source = iter_readline(source)
+    for line in source:
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode("utf-8")
+        yield line.rstrip("\r\n")
+
+def split_arguments(text):
+    # Split on whitespace, keeping [...] expressions with spaces in one piece
+    args = []
+    start = None
+    depth = 0
+    for i, c in enumerate(text):
+        if c == '[':
+            depth += 1
+        elif c == ']' and depth:
+            depth -= 1
+        if c in " \t" and depth == 0:
+            if start is not None:
+                args.append(text[start:i])
+                start = None
+        elif start is None:
+            start = i
+    if start is not None:
+        args.append(text[start:])
+    return args
+
+def is_name_char(c):
+    return c.isalpha() or c.isdigit() or c == '_'
+
+def scan_expression(expr):
+    # Split an expression into tokens without the re module: numbers, names
+    # (#n and #name become var_n and var_name), $n macro arguments,
+    # operators and brackets. Anything else is skipped.
+    tokens = []
+    i = 0
+    n = len(expr)
+    while i < n:
+        c = expr[i]
+        if c.isdigit():
+            start = i
+            while i < n and expr[i].isdigit():
+                i += 1
+            if i < n and expr[i] == '.':
+                i += 1
+                while i < n and expr[i].isdigit():
+                    i += 1
+            tokens.append(expr[start:i])
+        elif c.isalpha() or c == '_' or c == '#':
+            start = i + 1 if c == '#' else i
+            i += 1
+            while i < n and is_name_char(expr[i]):
+                i += 1
+            if c == '#':
+                if i > start:
+                    tokens.append("var_" + expr[start:i])
+            else:
+                word = expr[start:i]
+                tokens.append(WORD_OPERATORS.get(word, word))
+        elif c == '$':
+            start = i
+            i += 1
+            while i < n and expr[i].isdigit():
+                i += 1
+            if i > start + 1:
+                tokens.append(expr[start:i])
+        elif c in "<>=!" and i + 1 < n and expr[i + 1] == '=':
+            tokens.append(expr[i:i + 2])
+            i += 2
+        elif c in "+-*/<>=!()":
+            tokens.append(c)
+            i += 1
+        else:
+            i += 1
+    return tokens
+
+def bracket_macro_args(line):
+    # Wrap bare $n macro arguments in brackets so they are evaluated like any
+    # other expression: "G1 X$1 Y[$2]" becomes "G1 X[$1] Y[$2]"
+    out = []
+    depth = 0
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == '$' and depth == 0 and i + 1 < len(line) and line[i + 1].isdigit():
+            j = i + 1
+            while j < len(line) and line[j].isdigit():
+                j += 1
+            out.append("[" + line[i:j] + "]")
+            i = j
+            continue
+        out.append(c)
+        i += 1
+    return "".join(out)
+
+def iter_readline(source):
+    while True:
+        line = source.readline()
+        if not line:
+            return
+        yield line
+
+class Program:
+    # A compiled Grunt program, reusable with Grunt.run_compiled
+    __slots__ = ("nodes",)
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+# What a variable slot currently holds
+VAR_UNSET = 0
+VAR_NUMBER = 1
+VAR_OBJECT = 2
+
+class VariableTable:
+    # Variable storage indexed by integer slots. Every variable, numbered
+    # (#1) or named (#speed), gets the next slot the first time it is used,
+    # so the table only grows as far as the program needs. Floats are kept
+    # in an array('d'), anything else (ints, bools, RECV strings) in a side
+    # dict.
+    # It also behaves like the old dict keyed by "var_1", "var_speed", ...
+    __slots__ = ("numbered", "numbers", "kinds", "objects", "slots", "slot_names")
+
+    def __init__(self, numbered=5000):
+        self.numbered = numbered  # #0..#numbered are numbered parameters
+        self.numbers = array('d')
+        self.kinds = bytearray()
+        self.objects = {}
+        self.slots = {}
+        self.slot_names = []
+
+    def key(self, name):
+        # "#1", "#01", "var_1" -> "var_1"; "#speed" -> "var_speed"
+        if name.startswith("#"):
+            name = "var_" + name[1:]
+        if name.startswith("var_") and name[4:].isdigit():
+            number = int(name[4:])
+            if number <= self.numbered:
+                return f"var_{number}"
+        return name
+
+    def find(self, name):
+        # The slot of a variable, or None if it was never used. Unlike
+        # slot() this doesn't add anything to the table.
+        return self.slots.get(self.key(name))
+
+    def slot(self, name):
+        # Resolve "#1", "#speed", "var_1" or "var_speed" to a slot
+        name = self.key(name)
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = len(self.kinds)
+            self.slots[name] = slot
+            self.slot_names.append(name)
+            self.numbers.append(0.0)
+            self.kinds.append(VAR_UNSET)
+        return slot
+
+    def name(self, slot):
+        return self.slot_names[slot]
+
+    def get_slot(self, slot):
+        kind = self.kinds[slot]
+        if kind == VAR_NUMBER:
+            return self.numbers[slot]
+        if kind == VAR_OBJECT:
+            return self.objects[slot]
+        raise KeyError(self.name(slot))
+
+    def set_slot(self, slot, value):
+        # Only floats go in the array, so ints (FOR loop counters) and bools
+        # (comparisons) come back as they were set
+        if type(value) is float:
+            if self.kinds[slot] == VAR_OBJECT:
+                del self.objects[slot]
+            self.numbers[slot] = value
+            self.kinds[slot] = VAR_NUMBER
+        else:
+            self.objects[slot] = value
+            self.kinds[slot] = VAR_OBJECT
+
+    def __getitem__(self, name):
+        slot = self.find(name)
+        if slot is None:
+            raise KeyError(name)
+        return self.get_slot(slot)
+
+    def __setitem__(self, name, value):
+        self.set_slot(self.slot(name), value)
+
+    def __delitem__(self, name):
+        slot = self.find(name)
+        if slot is None or self.kinds[slot] == VAR_UNSET:
+            raise KeyError(name)
+        self.objects.pop(slot, None)
+        self.kinds[slot] = VAR_UNSET
+
+    def __contains__(self, name):
+        slot = self.find(name)
+        return slot is not None and self.kinds[slot] != VAR_UNSET
+
+    def __iter__(self):
+        kinds = self.kinds
+        for slot in range(len(kinds)):
+            if kinds[slot]:
+                yield self.name(slot)
+
+    def __len__(self):
+        return len(self.kinds) - self.kinds.count(VAR_UNSET)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, name, default=None):
+        slot = self.find(name)
+        if slot is None or self.kinds[slot] == VAR_UNSET:
+            return default
+        return self.get_slot(slot)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.get_slot(self.slots[name]) for name in self]
+
+    def items(self):
+        return [(name, self.get_slot(self.slots[name])) for name in self]
+
+    def update(self, other):
+        for name, value in other.items():
+            self[name] = value
+
+    def clear(self):
+        for slot in range(len(self.kinds)):
+            self.kinds[slot] = VAR_UNSET
+        self.objects = {}
+
+class ExpressionCache:
+    # Bounded LRU cache of compiled expressions keyed by their source text.
+    # Each entry is [rpn, last use]: dicts on the board don't keep insertion
+    # order, so recency comes from a counter rather than the dict.
+    __slots__ = ("maxsize", "entries", "uses", "hits", "misses", "evictions")
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = {}
+        self.uses = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, expr):
+        entry = self.entries.get(expr)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.uses += 1
+        entry[1] = self.uses
+        self.hits += 1
+        return entry[0]
+
+    def put(self, expr, rpn):
+        if self.maxsize <= 0:
+            return
+        entries = self.entries
+        if expr not in entries and len(entries) >= self.maxsize:
+            oldest = None
+            oldest_use = None
+            for key, entry in entries.items():
+                if oldest_use is None or entry[1] < oldest_use:
+                    oldest, oldest_use = key, entry[1]
+            del entries[oldest]
+            self.evictions += 1
+        self.uses += 1
+        entries[expr] = [rpn, self.uses]
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class BatchCollector:
+    # Registered in place of a handler by Grunt.register_batch. It gathers
+    # consecutive commands with the same code and hands them to the batch
+    # handler as one NumPy structured array (NaN where a word is absent).
+    __slots__ = ("machine", "code", "handler", "max_batch", "numpy", "rows")
+
+    def __init__(self, machine, code, handler, max_batch, numpy):
+        self.machine = machine
+        self.code = code
+        self.handler = handler
+        self.max_batch = max_batch
+        self.numpy = numpy
+        self.rows = []
+
+    def __call__(self, args):
+        machine = self.machine
+        if machine.pending_batch is not self:
+            if machine.pending_batch is not None:
+                machine.flush_batch()
+            machine.pending_batch = self
+        self.rows.append(args)
+        if len(self.rows) >= self.max_batch:
+            machine.flush_batch()
+
+    def flush(self):
+        rows = self.rows
+        self.rows = []
+        if rows:
+            self.handler(self.to_array(rows))
+
+    def to_array(self, rows):
+        np = self.numpy
+        columns = []
+        for row in rows:
+            for key in row:
+                if key not in columns:
+                    columns.append(key)
+        batch = np.empty(len(rows), dtype=[(key, 'f8') for key in columns])
+        nan = float('nan')
+        for key in columns:
+            try:
+                batch[key] = [row.get(key, nan) for row in rows]
+            except ValueError:
+                raise ValueError(f"{self.code} batch has a non-numeric {key} argument")
+        return batch
+
+# Upper bounds of the handler latency histogram buckets, in microseconds
+LATENCY_BUCKETS_US = (10, 100, 1000, 10000, 100000, 1000000)
+
+# Statements that run_async runs itself instead of through the dispatch list
+ASYNC_INLINE_OPS = (OP_SET, OP_IF, OP_FOR, OP_WHILE, OP_CALL, OP_WAIT)
+# Statements whose words may READ/RECV; run_async awaits those first
+IO_WORD_OPS = (OP_GCODE, OP_WRITEPIN, OP_WRITEMSG)
+
+class Profiler:
+    # Timings collected while Grunt.enable_profiling() is on. Line times
+    # are inclusive: a FOR line includes the time of its body.
+    __slots__ = ("clock", "lines", "handlers")
 
-class Grunt:
     def __init__(self):
+        import time
+        self.clock = time.monotonic_ns
+        self.lines = {}  # line_no -> [hits, total_ns]
+        self.handlers = {}  # code -> [calls, total_ns, max_ns, bucket counts]
+
+    def record_line(self, line_no, elapsed):
+        entry = self.lines.get(line_no)
+        if entry is None:
+            self.lines[line_no] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def record_handler(self, code, elapsed):
+        entry = self.handlers.get(code)
+        if entry is None:
+            entry = [0, 0, 0, [0] * (len(LATENCY_BUCKETS_US) + 1)]
+            self.handlers[code] = entry
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+        us = elapsed // 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_US) and us >= LATENCY_BUCKETS_US[bucket]:
+            bucket += 1
+        entry[3][bucket] += 1
+
+    def wrap_node(self, execute):
+        clock = self.clock
+        record_line = self.record_line
+
+        def profiled(node):
+            start = clock()
+            result = execute(node)
+            if result is not None and is_awaitable(result):
+                return self.finish_node(node[1], start, result)
+            record_line(node[1], clock() - start)
+            return result
+        return profiled
+
+    async def finish_node(self, line_no, start, result):
+        try:
+            return await result
+        finally:
+            self.record_line(line_no, self.clock() - start)
+
+    def wrap_handler(self, code, handler):
+        clock = self.clock
+        record_handler = self.record_handler
+
+        def profiled(*args):
+            start = clock()
+            result = handler(*args)
+            if result is not None and is_awaitable(result):
+                return self.finish_handler(code, start, result)
+            record_handler(code, clock() - start)
+            return result
+        profiled.profiled_handler = handler
+        return profiled
+
+    async def finish_handler(self, code, start, result):
+        try:
+            return await result
+        finally:
+            self.record_handler(code, self.clock() - start)
+
+    def stats(self):
+        labels = [f"<{bound}us" for bound in LATENCY_BUCKETS_US] + [f">={LATENCY_BUCKETS_US[-1]}us"]
+        return {
+            "lines": {line_no: {"hits": hits, "time_ms": total / 1000000}
+                      for line_no, (hits, total) in sorted(self.lines.items())},
+            "handlers": {code: {"calls": calls, "time_ms": total / 1000000, "max_ms": longest / 1000000,
+                                "histogram": dict(zip(labels, buckets))}
+                         for code, (calls, total, longest, buckets) in self.handlers.items()},
+        }
+
+class Grunt:
+    def __init__(self, expression_cache_size=256, numbered_variables=5000, optimize=False, unroll_limit=0,
+                 vectorize=False, low_memory=False, arcs=False, chord_tolerance=None):
         # Initialize variables, handlers, and macros
-        self.variables = {}
+        self.variables = VariableTable(numbered_variables)
         self.macros = {}
-        self.operators = {
-            '+': lambda a, b: a + b,
-            '-': lambda a, b: a - b,
-            '*': lambda a, b: a * b,
-            '/': lambda a, b: a / b,  # Be mindful of division by zero
-            '<': lambda a, b: a < b,
-            '>': lambda a, b: a > b,
-            '<=': lambda a, b: a <= b,
-            '>=': lambda a, b: a >= b,
-            '==': lambda a, b: a == b,
-            '!=': lambda a, b: a != b,
-        }
+        self.macro_args = []  # Argument values of the macro calls in progress
+        self.max_call_depth = 64
+        self.operators = dict(OPERATORS)
         self.gcode_handlers = {}
+        self.handler_cells = {}
+        self.pending_batch = None
+        # Node handlers indexed by node type
+        self.dispatch = [None] * OP_COUNT
+        self.dispatch[OP_GCODE] = self.exec_gcode
+        self.dispatch[OP_IF] = self.exec_if
+        self.dispatch[OP_FOR] = self.exec_for
+        self.dispatch[OP_WHILE] = self.exec_while
+        self.dispatch[OP_CALL] = self.exec_call
+        self.dispatch[OP_MACRO] = self.exec_macro
+        self.dispatch[OP_SET] = self.exec_set
+        self.dispatch[OP_WRITEPIN] = self.exec_writepin
+        self.dispatch[OP_WRITEMSG] = self.exec_writemsg
+        self.dispatch[OP_WAIT] = self.exec_wait
+        self.expression_cache = ExpressionCache(expression_cache_size)
+        self.profiler = None
+        # Run compiled programs through optimizer.py; FOR loops of up to
+        # unroll_limit passes are unrolled
+        self.optimize = optimize
+        self.unroll_limit = unroll_limit
+        # Run FOR loops over G-code with NumPy where they allow it (vectorize.py)
+        self.vectorize = vectorize
+        if vectorize:
+            self.dispatch[OP_FOR] = self.exec_for_vectorized
+        # Evaluate expressions on a stack allocated once instead of a new
+        # list for every expression, for boards where garbage collection
+        # pauses show between moves
+        self.low_memory = low_memory
+        if low_memory:
+            self.stack = [None] * STACK_SIZE
+            self.stack_top = 0
+            self.evaluate_rpn = self.evaluate_rpn_preallocated
+        # G2/G3 arcs cut into G1 moves (arcs.py), which means keeping track
+        # of the position
+        self.arcs = None
+        if arcs:
+            import arcs as arc_module
+            if chord_tolerance is None:
+                chord_tolerance = arc_module.CHORD_TOLERANCE
+            self.arcs = arc_module.ArcInterpolator(self, chord_tolerance)
+            self.arc_codes = arc_module.ARC_CODES
+            self.dispatch[OP_GCODE] = self.exec_gcode_arcs
         self.program = ""
 
     def is_float(self, s):
@@ -28,85 +569,231 @@ class Grunt:
             return False
 
     def register(self, code, handler):
+        if self.profiler is not None:
+            handler = self.profile_handler(code, handler)
         self.gcode_handlers[code] = handler
+        cell = self.handler_cells.get(code)
+        if cell is not None:
+            cell[0] = handler
+
+    def enable_profiling(self):
+        # Swap the dispatch entries and handlers for timing wrappers. Nothing
+        # is checked on the normal path, so profiling costs nothing when off.
+        if self.profiler is not None:
+            return self.profiler
+        profiler = Profiler()
+        self.profiler = profiler
+        self.unprofiled_dispatch = self.dispatch
+        self.dispatch = [profiler.wrap_node(execute) for execute in self.dispatch]
+        for code, handler in list(self.gcode_handlers.items()):
+            self.register(code, handler)
+        self.execute_block_async = self.execute_block_async_profiled
+        return profiler
+
+    def disable_profiling(self):
+        if self.profiler is None:
+            return
+        self.profiler = None
+        self.dispatch = self.unprofiled_dispatch
+        for code, handler in list(self.gcode_handlers.items()):
+            self.register(code, getattr(handler, "profiled_handler", handler))
+        del self.execute_block_async
+
+    def profile_handler(self, code, handler):
+        # Batch collectors and planners are compared against pending_batch
+        # by identity, so they are left unwrapped
+        if hasattr(handler, "flush") or hasattr(handler, "profiled_handler"):
+            return handler
+        return self.profiler.wrap_handler(code, handler)
+
+    def stats(self):
+        stats = {"profiling": self.profiler is not None,
+                 "expression_cache": self.expression_cache.stats()}
+        if self.profiler is not None:
+            stats.update(self.profiler.stats())
+        if self.arcs is not None:
+            stats["arcs"] = self.arcs.stats()
+        return stats
+
+    def register_batch(self, code, handler, max_batch=1024):
+        # The handler is called with up to max_batch consecutive commands at
+        # once. Any other command, WRITE, READ or RECV, and the end of the
+        # run deliver the commands gathered so far first, so order is kept.
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("register_batch needs numpy")
+        self.register(code, BatchCollector(self, code, handler, max_batch, numpy))
+
+    def flush_batch(self):
+        batch = self.pending_batch
+        if batch is not None:
+            self.pending_batch = None
+            batch.flush()
 
     def replace_gcode_vars(self, expr):
-        expr = re.sub(r'#(\d+)', r'var_\1', expr)
-        expr = re.sub(r'#([a-zA-Z_]\w*)', r'var_\1', expr)
-        expr = expr.replace("LT", "<").replace("GT", ">").replace("LE", "<=").replace("GE", ">=").replace("EQ", "==").replace("NE", "!=")
-        return expr
+        return " ".join(scan_expression(expr))
 
     def parse_expression(self, expr):
-        expr = self.replace_gcode_vars(expr)
+        return self.evaluate_rpn(self.expression(expr))
 
-        def tokenize(expression):
-            tokens = re.findall(r'\d+\.?\d*|[+\-*/<>=!()]+|[A-Za-z_]\w*', expression)
-            return tokens
+    def expression(self, expr):
+        # Compiled RPN for an expression, shared through the cache
+        rpn = self.expression_cache.get(expr)
+        if rpn is None:
+            rpn = self.compile_expression(expr)
+            self.expression_cache.put(expr, rpn)
+        return rpn
 
-        tokens = tokenize(expr)
+    def compile_expression(self, expr):
+        # Turn an expression into typed RPN: constants are already floats,
+        # variables are keys into self.variables and operators are functions
+        tokens = scan_expression(expr)
 
-        if tokens[0] == "READ":
-            if self.gcode_handlers["READ"]:
-                value = self.gcode_handlers["READ"](int(self.parse_expression(tokens[1])))  # Replace with your actual function to read from a pin
-            else:
-                value = 0
-            return value
-        elif tokens[0] == "RECV":
-            if self.gcode_handlers["RECV"]:
-                message = self.gcode_handlers["RECV"](float(self.parse_expression(tokens[1])))  # Replace with your actual function to receive a message
-            else:
-                message = ""
-            return message
-
-        def to_rpn(tokens):
-            precedence = {'+': 1, '-': 1, '*': 2, '/': 2, '<': 0, '>': 0, '<=': 0, '>=': 0, '==': 0, '!=': 0}
-            output = []
-            ops_stack = []
-
-            for token in tokens:
-                if re.match(r'^\d+\.?\d*$', token) or re.match(r'^[A-Za-z_]\w*$', token):  # Operand
-                    output.append(token)
-                elif token in self.operators:  # Operator
-                    while ops_stack and precedence.get(ops_stack[-1], 0) >= precedence[token]:
-                        output.append(ops_stack.pop())
-                    ops_stack.append(token)
-                elif token == '(':
-                    ops_stack.append(token)
-                elif token == ')':
-                    while ops_stack and ops_stack[-1] != '(':
-                        output.append(ops_stack.pop())
+        if tokens and tokens[0] in IO_FUNCTIONS:
+            if len(tokens) < 2:
+                raise ValueError(f"{tokens[0]} is missing its argument: {expr}")
+            rpn = self.to_rpn(tokens[1:2])
+            rpn.append((EXPR_IO, tokens[0]))
+            return rpn
+
+        rpn = self.to_rpn(tokens)
+
+        # Check the stack depth once here so evaluate_rpn doesn't have to
+        depth = 0
+        for kind, value in rpn:
+            if kind == EXPR_OP:
+                if depth < 2:
+                    raise ValueError(f"Error: Not enough operands in stack for operation in '{expr}'")
+                depth -= 1
+            elif kind != EXPR_IO:
+                depth += 1
+        if depth != 1:
+            raise ValueError(f"Error in expression evaluation: {expr}")
+
+        return rpn
+
+    def to_rpn(self, tokens):
+        output = []
+        ops_stack = []
+
+        for token in tokens:
+            c = token[0]
+            if c.isdigit():  # Constant
+                output.append((EXPR_CONST, float(token)))
+            elif c.isalpha() or c == '_':  # Variable
+                output.append((EXPR_VAR, self.variables.slot(token)))
+            elif token[0] == '$':  # Macro argument
+                output.append((EXPR_ARG, int(token[1:]) - 1))
+            elif token in self.operators:  # Operator
+                while ops_stack and ops_stack[-1] != '(' and PRECEDENCE[ops_stack[-1]] >= PRECEDENCE[token]:
+                    output.append((EXPR_OP, self.operators[ops_stack.pop()]))
+                ops_stack.append(token)
+            elif token == '(':
+                ops_stack.append(token)
+            elif token == ')':
+                while ops_stack and ops_stack[-1] != '(':
+                    output.append((EXPR_OP, self.operators[ops_stack.pop()]))
+                if ops_stack:
                     ops_stack.pop()  # Remove '(' from stack
 
-            while ops_stack:
-                output.append(ops_stack.pop())
-
-            return output
-
-        def evaluate_rpn(rpn):
-            stack = []
-
-            for token in rpn:
-                if self.is_float(token):  # Numeric value
-                    stack.append(float(token))
-                elif token in self.variables:  # Variable
-                    stack.append(self.variables[token])
-                elif token in self.operators:  # Operator
-                    if len(stack) < 2:
-                        raise ValueError(f"Error: Not enough operands in stack for operation '{token}'")
-                    b = stack.pop()
-                    a = stack.pop()
-                    result = self.operators[token](a, b)
-                    stack.append(result)
+        while ops_stack:
+            token = ops_stack.pop()
+            if token != '(':
+                output.append((EXPR_OP, self.operators[token]))
+
+        return output
+
+    def evaluate_rpn(self, rpn):
+        stack = []
+        variables = self.variables
+        kinds = variables.kinds
+        numbers = variables.numbers
+
+        for kind, value in rpn:
+            if kind == EXPR_CONST:
+                stack.append(value)
+            elif kind == EXPR_VAR:
+                var_kind = kinds[value]
+                if var_kind == VAR_NUMBER:
+                    stack.append(numbers[value])
+                elif var_kind == VAR_OBJECT:
+                    stack.append(variables.objects[value])
                 else:
-                    raise ValueError(f"Unexpected token in expression: {token}")
+                    raise ValueError(f"Unexpected token in expression: {variables.name(value)}")
+            elif kind == EXPR_OP:
+                b = stack.pop()
+                stack.append(value(stack.pop(), b))
+            elif kind == EXPR_ARG:
+                args = self.macro_args[-1] if self.macro_args else ()
+                if value >= len(args):
+                    raise ValueError(f"Macro argument ${value + 1} is not set")
+                stack.append(args[value])
+            else:
+                stack.append(self.call_io_sync(value, stack.pop()))
+
+        return stack[0]
+
+    def evaluate_rpn_preallocated(self, rpn):
+        # evaluate_rpn for low_memory mode. Each evaluation uses the part of
+        # self.stack above stack_top, so a READ handler that evaluates
+        # expressions of its own doesn't overwrite the values below it.
+        stack = self.stack
+        base = top = self.stack_top
+        if base + len(rpn) > len(stack):
+            stack.extend([None] * len(rpn))
+        self.stack_top = base + len(rpn)
+        variables = self.variables
+        kinds = variables.kinds
+        numbers = variables.numbers
 
-            if len(stack) != 1:
-                raise ValueError(f"Error in expression evaluation, stack: {stack}")
+        try:
+            for kind, value in rpn:
+                if kind == EXPR_CONST:
+                    stack[top] = value
+                    top += 1
+                elif kind == EXPR_VAR:
+                    var_kind = kinds[value]
+                    if var_kind == VAR_NUMBER:
+                        stack[top] = numbers[value]
+                    elif var_kind == VAR_OBJECT:
+                        stack[top] = variables.objects[value]
+                    else:
+                        raise ValueError(f"Unexpected token in expression: {variables.name(value)}")
+                    top += 1
+                elif kind == EXPR_OP:
+                    top -= 1
+                    stack[top - 1] = value(stack[top - 1], stack[top])
+                elif kind == EXPR_ARG:
+                    args = self.macro_args[-1] if self.macro_args else ()
+                    if value >= len(args):
+                        raise ValueError(f"Macro argument ${value + 1} is not set")
+                    stack[top] = args[value]
+                    top += 1
+                else:
+                    stack[top - 1] = self.call_io_sync(value, stack[top - 1])
+            return stack[base]
+        finally:
+            self.stack_top = base
 
-            return stack[0]
+    def call_io(self, name, arg):
+        if self.pending_batch is not None:
+            self.flush_batch()
+        handler = self.gcode_handlers.get(name)
+        if name == "READ":
+            # Replace with your actual function to read from a pin
+            return handler(int(arg)) if handler else 0
+        # Replace with your actual function to receive a message
+        return handler(float(arg)) if handler else ""
 
-        rpn = to_rpn(tokens)
-        return evaluate_rpn(rpn)
+    def call_io_sync(self, name, arg):
+        # call_io outside run_async, where a coroutine can't be awaited
+        result = self.call_io(name, arg)
+        if is_awaitable(result):
+            if hasattr(result, "close"):
+                result.close()
+            raise ValueError(f"{name} handler is async; use run_async")
+        return result
 
     def evaluate_arguments(self, arguments):
         evaluated_args = {}
@@ -126,141 +813,526 @@ class Grunt:
         return evaluated_args
 
     def execute_gcode(self, command):
-        code, *args = command.split()
-        evaluated_args = self.evaluate_arguments(args)
-        if code in self.gcode_handlers:
-            self.gcode_handlers[code](evaluated_args)
-        else:
-            print(f"Unknown command: {command}")
+        self.execute_command(command)
 
     def execute_command(self, command):
-        if "=" in command:
-            var_name, expr = map(str.strip, command.split("=", 1))
-            var_name = var_name[var_name.find("#"):]
-            if var_name.startswith("#"):
-                var_name = self.replace_gcode_vars(var_name)
-                value = self.parse_expression(expr)
-                self.variables[var_name] = value
-
-        elif command.startswith("G") or command.startswith("M"):
-            self.execute_gcode(command)
-
-        elif command.startswith("WRITE"):
-            args = command.split()
-            if args[1].isdigit() or ('[' in args[1] and len(args) == 3):  # Writing to a pin (including with variables)
-                pin_number = self.parse_expression(args[1]) if '[' in args[1] else args[1]
-                value = self.parse_expression(args[2]) if '[' in args[2] else float(args[2])
-                if self.gcode_handlers["WRITEPIN"]:
-                    self.gcode_handlers["WRITEPIN"](pin_number, value)
-            else:  # Sending a message
-                message = " ".join(args[1:])
-                e = re.findall(r'\[.*?\]', message)
-                if len(e) > 0:
-                    for a in e:
-                        b = self.parse_expression(a[1:-1])
-                        message = message.replace(a, str(b))
-                if self.gcode_handlers["WRITEMSG"]:
-                    self.gcode_handlers["WRITEMSG"](message)
+        # Run a single line that isn't part of a program
+        command = command.split(';')[0].strip()
+        if command:
+            node = self.compile_statement(iter(()), 0, command, command.split())
+            if node is not None:
+                try:
+                    self.execute_node(node)
+                finally:
+                    self.flush_batch()
 
     def execute_macro(self, macro_name, args):
-        if macro_name not in self.macros:
+        # Arguments given as text are converted the same way CALL does
+        args = [float(arg) if isinstance(arg, str) and self.is_float(arg) else arg for arg in args]
+        self.call_macro(macro_name, args)
+
+    def call_macro(self, macro_name, args):
+        body = self.macros.get(macro_name)
+        if body is None:
             raise ValueError(f"Macro {macro_name} not found")
-        macro_body = self.macros[macro_name]
-        for i, arg in enumerate(args):
-            macro_body = re.sub(r'\$' + str(i + 1), str(arg), macro_body)
-        evaluated_body = []
-        for line in macro_body.splitlines():
-            evaluated_line = re.sub(r'\[(.+?)\]', lambda m: str(self.parse_expression(m.group(1))), line)
-            evaluated_body.append(evaluated_line)
-        self.parse_gcode(evaluated_body)
+        if len(self.macro_args) >= self.max_call_depth:
+            raise ValueError(f"Macro {macro_name} exceeded the maximum call depth of {self.max_call_depth}")
+        self.macro_args.append(args)
+        try:
+            self.execute_block(body)
+        finally:
+            self.macro_args.pop()
 
-    def parse_gcode(self, lines):
-        i = 0
-        while i < len(lines):
-            line = lines[i].split(';')[0].strip()
+    def compile(self, program):
+        # Turn program text (a string, list of lines or file) into a Program
+        # that can be run any number of times without re-scanning the source
+        nodes = self.compile_block(enumerate(iter_lines(program), 1), ())[0]
+        if self.optimize:
+            import optimizer
+            return optimizer.optimize(self, Program(nodes))
+        return Program(nodes)
+
+    def compile_block(self, lines, terminators):
+        # Consume lines until one of the terminators is found. Nested blocks
+        # pull their own bodies from the same iterator, so nesting works.
+        nodes = []
+        for line_no, raw in lines:
+            line = raw.split(';')[0].strip()
             if not line:
-                i += 1
                 continue
 
             commands = line.split()
-            if len(commands) == 0:
-                i += 1
-                continue
+            if commands[0] in terminators:
+                return nodes, commands[0], line, line_no
 
-            if commands[0] == "MACRO":
-                if i + 1 < len(lines):
-                    macro_name = commands[1]
-                    macro_body = []
-                    i += 1
-                    while i < len(lines) and not lines[i].startswith("ENDMACRO"):
-                        macro_body.append(lines[i])
-                        i += 1
-                    self.macros[macro_name] = "\n".join(macro_body)
-                else:
-                    raise ValueError(f"MACRO command at line {i+1} is incomplete")
-                i += 1
+            node = self.compile_statement(lines, line_no, line, commands)
+            if node is not None:
+                nodes.append(node)
 
-            elif commands[0].startswith("IF"):
-                condition = line[2:].strip()
-                if not condition:
-                    raise ValueError(f"IF condition is empty at line {i+1}: {line}")
-                if self.parse_expression(condition):
-                    i += 1
-                    continue
-                while i < len(lines) and not lines[i].startswith("ELSEIF") and not lines[i].startswith("ELSE") and not lines[i].startswith("ENDIF"):
-                    i += 1
-                if lines[i].startswith("ELSEIF"):
-                    condition = lines[i][6:].strip()
-                    if not condition:
-                        raise ValueError(f"ELSEIF condition is empty at line {i+1}: {line}")
-                    if self.parse_expression(condition):
-                        i += 1
-                        continue
-
-            elif commands[0].startswith("FOR"):
-                var, start, end = commands[1], commands[2], commands[3]
-                start = self.parse_expression(start)
-                end = self.parse_expression(end)
-                loop_body = []
-                i += 1
-                while i < len(lines) and not lines[i].startswith("ENDFOR"):
-                    loop_body.append(lines[i])
-                    i += 1
-                for val in range(int(start), int(end) + 1):
-                    self.variables[self.replace_gcode_vars(var)] = val
-                    self.parse_gcode(loop_body)
+        return nodes, None, None, None
+
+    def iter_nodes(self, lines):
+        # Compile top level statements one at a time as they are read. Only
+        # the body of a block statement is held in memory until it is done.
+        for line_no, raw in lines:
+            line = raw.split(';')[0].strip()
+            if line:
+                node = self.compile_statement(lines, line_no, line, line.split())
+                if node is not None:
+                    yield node
+
+    def compile_statement(self, lines, line_no, line, commands):
+        word = commands[0]
+
+        if word in BLOCK_ENDS:
+            raise ValueError(f"Unexpected {word} at line {line_no}")
+
+        if word == "MACRO":
+            if len(commands) < 2:
+                raise ValueError(f"MACRO command at line {line_no} is incomplete")
+            macro_body = []
+            for body_no, body_line in lines:
+                if body_line.split(';')[0].strip().startswith("ENDMACRO"):
+                    break
+                macro_body.append((body_no, bracket_macro_args(body_line)))
+            else:
+                raise ValueError(f"MACRO command at line {line_no} is missing ENDMACRO")
+            # The body is compiled once here; CALL only binds the arguments
+            body = self.compile_block(iter(macro_body), ())[0]
+            return (OP_MACRO, line_no, commands[1], body)
 
-            elif commands[0].startswith("WHILE"):
-                condition = re.match(r'WHILE \[(.+)\]', line).group(1)
+        elif word.startswith("IF"):
+            condition = line[2:].strip()
+            if not condition:
+                raise ValueError(f"IF condition is empty at line {line_no}: {line}")
+            branches = []
+            branch_lines = [line_no]
+            else_body = []
+            body, end, end_line, end_no = self.compile_block(lines, ("ELSEIF", "ELSE", "ENDIF"))
+            branches.append((self.expression(condition), body))
+            while end == "ELSEIF":
+                condition = end_line[6:].strip()
                 if not condition:
-                    raise ValueError(f"WHILE condition is empty at line {i+1}: {line}")
-                loop_body = []
-                i += 1
-                while i < len(lines) and not lines[i].startswith("ENDWHILE"):
-                    loop_body.append(lines[i])
-                    i += 1
-                while self.parse_expression(condition):
-                    self.parse_gcode(loop_body)
-
-            elif commands[0].startswith("CALL"):
-                _, macro_name, *args = commands
-                argsJoin = " ".join(args)
-                e = re.findall(r'\[.*?\]', argsJoin)
-                if len(e) > 0:
-                    for a in e:
-                        b = self.parse_expression(a)
-                        argsJoin = argsJoin.replace(a, str(int(b)))
-                args = argsJoin.split(" ")
-                self.execute_macro(macro_name, args)
+                    raise ValueError(f"ELSEIF condition is empty at line {end_no}: {end_line}")
+                branch_lines.append(end_no)
+                body, end, end_line, end_no = self.compile_block(lines, ("ELSEIF", "ELSE", "ENDIF"))
+                branches.append((self.expression(condition), body))
+            if end == "ELSE":
+                else_body, end, end_line, end_no = self.compile_block(lines, ("ENDIF",))
+            if end is None:
+                raise ValueError(f"IF at line {line_no} is missing ENDIF")
+            return (OP_IF, line_no, branches, else_body, branch_lines)
 
+        elif word.startswith("FOR"):
+            commands = split_arguments(line)
+            if len(commands) < 4:
+                raise ValueError(f"FOR command at line {line_no} is incomplete: {line}")
+            var, start, end = commands[1], commands[2], commands[3]
+            body, end_word, _, _ = self.compile_block(lines, ("ENDFOR",))
+            if end_word is None:
+                raise ValueError(f"FOR at line {line_no} is missing ENDFOR")
+            return (OP_FOR, line_no, self.variables.slot(var), self.expression(start), self.expression(end), body)
+
+        elif word.startswith("WHILE"):
+            condition = line[5:].strip()
+            if not condition:
+                raise ValueError(f"WHILE condition is empty at line {line_no}: {line}")
+            body, end_word, _, _ = self.compile_block(lines, ("ENDWHILE",))
+            if end_word is None:
+                raise ValueError(f"WHILE at line {line_no} is missing ENDWHILE")
+            return (OP_WHILE, line_no, self.expression(condition), body)
+
+        elif word.startswith("CALL"):
+            if len(commands) < 2:
+                raise ValueError(f"CALL command at line {line_no} is incomplete")
+            args = []
+            for arg in split_arguments(line)[2:]:
+                if self.is_float(arg):
+                    args.append([(EXPR_CONST, float(arg))])
+                elif arg[0] in "[#$":
+                    args.append(self.expression(arg))
+                else:
+                    args.append([(EXPR_CONST, arg)])
+            return (OP_CALL, line_no, commands[1], args)
+
+        elif "=" in line and "#" in line.split("=", 1)[0]:
+            var_name, expr = map(str.strip, line.split("=", 1))
+            var_name = var_name[var_name.find("#"):]
+            return (OP_SET, line_no, self.variables.slot(var_name), self.expression(expr))
+
+        elif word.startswith("G") or word.startswith("M"):
+            return self.compile_gcode(line_no, line)
+
+        elif word.startswith("WRITE"):
+            return self.compile_write(line_no, line)
+
+        elif word == "WAIT":
+            return self.compile_wait(line_no, line)
+
+        # Anything else is ignored, as it always has been
+        return None
+
+    def compile_gcode(self, line_no, line):
+        code, *words = split_arguments(line)
+        args = []
+        dynamic = False
+        for word in words:
+            key = word[0]
+            if '[' in word and ']' in word:
+                args.append((key, self.expression(word[word.find('[') + 1:word.find(']')]), None))
+                dynamic = True
             else:
-                self.execute_command(line)
+                value = word[1:]
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+                args.append((key, None, value))
+        if not dynamic:
+            # All literal: build the dict once and hand the same one to the
+            # handler every time, so handlers must not modify it
+            args = {key: value for key, _, value in args}
+        return (OP_GCODE, line_no, code, self.handler_cell(code), args, dynamic)
 
-            i += 1
+    def compile_write(self, line_no, line):
+        args = split_arguments(line)
+        if len(args) >= 3 and (args[1].isdigit() or ('[' in args[1] and len(args) == 3)):  # Writing to a pin (including with variables)
+            pin_number = self.expression(args[1]) if '[' in args[1] else [(EXPR_CONST, int(args[1]))]
+            value = self.expression(args[2]) if '[' in args[2] else [(EXPR_CONST, float(args[2]))]
+            return (OP_WRITEPIN, line_no, pin_number, value)
+
+        # Sending a message, split into text and [expression] parts
+        message = " ".join(args[1:])
+        parts = []
+        while True:
+            start = message.find('[')
+            end = message.find(']', start + 1) if start >= 0 else -1
+            if end < 0:
+                break
+            if start:
+                parts.append(message[:start])
+            parts.append(self.expression(message[start + 1:end]))
+            message = message[end + 1:]
+        if message or not parts:
+            parts.append(message)
+        return (OP_WRITEMSG, line_no, parts)
+
+    def compile_wait(self, line_no, line):
+        # WAIT PIN <pin> <value> <timeout> [#result]
+        args = split_arguments(line)
+        if len(args) < 5 or args[1] != "PIN":
+            raise ValueError(f"WAIT command at line {line_no} is incomplete: {line}")
+        pin_number, value, timeout = [self.expression(arg) if '[' in arg else [(EXPR_CONST, float(arg))]
+                                      for arg in args[2:5]]
+        # Without a result variable a timeout stops the program
+        slot = self.variables.slot(args[5]) if len(args) > 5 else None
+        return (OP_WAIT, line_no, pin_number, value, timeout, slot)
+
+    def gcode_program(self, code, args):
+        # A one command program from words that are already numbers, e.g.
+        # from a binary frame (protocol.py)
+        return Program([(OP_GCODE, 0, code, self.handler_cell(code), args, False)])
+
+    def handler_cell(self, code):
+        # Compiled commands hold a one item list with their handler so that
+        # register() can update them without a lookup when they run
+        cell = self.handler_cells.get(code)
+        if cell is None:
+            cell = [self.gcode_handlers.get(code)]
+            self.handler_cells[code] = cell
+        return cell
+
+    def execute_block(self, nodes):
+        dispatch = self.dispatch
+        for node in nodes:
+            dispatch[node[0]](node)
+
+    def execute_node(self, node):
+        self.dispatch[node[0]](node)
+
+    def exec_gcode(self, node):
+        handler = node[3][0]
+        if handler is None:
+            handler = self.gcode_handlers.get(node[2])
+            if handler is None:
+                print(f"Unknown command: {node[2]} (line {node[1]})")
+                return
+        if self.pending_batch is not None and handler is not self.pending_batch:
+            self.flush_batch()
+        args = node[4]
+        if node[5]:
+            # A plain loop rather than a comprehension, which would create a
+            # function object on every call
+            evaluate = self.evaluate_rpn
+            words = args
+            args = {}
+            for key, rpn, value in words:
+                args[key] = evaluate(rpn) if rpn else value
+        return handler(args)
+
+    def exec_gcode_arcs(self, node):
+        # exec_gcode that also keeps the position for arcs, and runs G2/G3
+        # and the plane codes itself when nothing is registered for them
+        code = node[2]
+        args = node[4]
+        if node[5]:
+            evaluate = self.evaluate_rpn
+            words = args
+            args = {}
+            for key, rpn, value in words:
+                args[key] = evaluate(rpn) if rpn else value
+        handler = node[3][0]
+        if handler is None:
+            handler = self.gcode_handlers.get(code)
+            if handler is None:
+                if code in self.arc_codes:
+                    return self.arcs.command(code, args, node[1])
+                print(f"Unknown command: {code} (line {node[1]})")
+                return
+        if code == "G1" or code == "G0":
+            self.arcs.move(args)
+        if self.pending_batch is not None and handler is not self.pending_batch:
+            self.flush_batch()
+        return handler(args)
+
+    def exec_set(self, node):
+        self.variables.set_slot(node[2], self.evaluate_rpn(node[3]))
+
+    def exec_if(self, node):
+        for condition, body in node[2]:
+            if self.evaluate_rpn(condition):
+                self.execute_block(body)
+                return
+        self.execute_block(node[3])
+
+    def exec_for(self, node):
+        _, _, slot, start, end, body = node
+        start = self.evaluate_rpn(start)
+        end = self.evaluate_rpn(end)
+        set_slot = self.variables.set_slot
+        execute_block = self.execute_block
+        for val in range(int(start), int(end) + 1):
+            set_slot(slot, val)
+            execute_block(body)
+
+    def exec_for_vectorized(self, node):
+        if not self.vectorize_for(node):
+            self.exec_for(node)
+
+    def vectorize_for(self, node, batch_only=False):
+        import vectorize
+        return vectorize.run_for(self, node, batch_only)
+
+    def exec_while(self, node):
+        condition, body = node[2], node[3]
+        while self.evaluate_rpn(condition):
+            self.execute_block(body)
+
+    def exec_call(self, node):
+        args = []
+        for arg in node[3]:
+            value = self.evaluate_rpn(arg)
+            # Macro arguments are numbers like the words they stand for, so a
+            # FOR counter passed on arrives as a float
+            args.append(float(value) if type(value) is int else value)
+        self.call_macro(node[2], args)
+
+    def exec_macro(self, node):
+        self.macros[node[2]] = node[3]
+
+    def exec_writepin(self, node):
+        if self.pending_batch is not None:
+            self.flush_batch()
+        handler = self.gcode_handlers.get("WRITEPIN")
+        if handler:
+            return handler(int(self.evaluate_rpn(node[2])), self.evaluate_rpn(node[3]))
+
+    def exec_writemsg(self, node):
+        parts = []
+        for part in node[2]:
+            parts.append(part if isinstance(part, str) else str(self.evaluate_rpn(part)))
+        message = "".join(parts)
+        if self.pending_batch is not None:
+            self.flush_batch()
+        handler = self.gcode_handlers.get("WRITEMSG")
+        if handler:
+            return handler(message)
+
+    def exec_wait(self, node):
+        if self.pending_batch is not None:
+            self.flush_batch()
+        handler = self.gcode_handlers.get("WAITPIN")
+        if handler:
+            result = self.call_wait(handler, node)
+            if is_awaitable(result):
+                # Nothing here can wait for it; run_async awaits it instead
+                if hasattr(result, "close"):
+                    result.close()
+                raise ValueError(f"WAIT PIN handler is async at line {node[1]}; use run_async")
+            self.finish_wait(node, result)
+
+    def call_wait(self, handler, node):
+        return handler(int(self.evaluate_rpn(node[2])), self.evaluate_rpn(node[3]), self.evaluate_rpn(node[4]))
+
+    def finish_wait(self, node, result):
+        if node[5] is not None:
+            self.variables.set_slot(node[5], 1.0 if result else 0.0)
+        elif not result:
+            raise ValueError(f"WAIT PIN timed out at line {node[1]}")
+
+    def parse_gcode(self, lines):
+        self.run_compiled(self.compile(lines))
+
+    def run_compiled(self, program):
+        try:
+            self.execute_block(program.nodes)
+        finally:
+            self.flush_batch()
 
     def run(self, program):
-        self.parse_gcode(program.split("\n"))
+        self.run_compiled(self.compile(program))
 
+    def run_stream(self, source):
+        # Run a program from a file, socket file, mmap or any iterable of
+        # lines while it is being read, without loading all of it first
+        execute_node = self.execute_node
+        try:
+            for node in self.iter_nodes(enumerate(iter_lines(source), 1)):
+                execute_node(node)
+        finally:
+            self.flush_batch()
 
+    # Cooperative execution for asyncio (CPython) and CircuitPython's asyncio.
+    # Handlers may be coroutines; they are awaited. READ and RECV are awaited
+    # in assignments, conditions, loop bounds, CALL arguments, G-code words
+    # and WRITE. The loop
+    # also yields every yield_every nodes so other tasks keep running.
 
+    async def run_async(self, program, yield_every=32):
+        import asyncio
+        if not isinstance(program, Program):
+            program = self.compile(program)
+        self.async_sleep = asyncio.sleep
+        self.yield_every = yield_every
+        self.yield_countdown = yield_every
+        try:
+            await self.execute_block_async(program.nodes)
+        finally:
+            self.flush_batch()
+
+    async def execute_block_async(self, nodes):
+        for node in nodes:
+            op = node[0]
+            if op == OP_SET:
+                self.variables.set_slot(node[2], await self.evaluate_rpn_async(node[3]))
+            elif op == OP_IF:
+                for condition, body in node[2]:
+                    if await self.evaluate_rpn_async(condition):
+                        await self.execute_block_async(body)
+                        break
+                else:
+                    await self.execute_block_async(node[3])
+            elif op == OP_FOR:
+                # Handlers may be coroutines here, so only loops that go
+                # to a batch handler are vectorized
+                if not (self.vectorize and self.vectorize_for(node, batch_only=True)):
+                    _, _, slot, start, end, body = node
+                    start = await self.evaluate_rpn_async(start)
+                    end = await self.evaluate_rpn_async(end)
+                    for val in range(int(start), int(end) + 1):
+                        self.variables.set_slot(slot, val)
+                        await self.execute_block_async(body)
+            elif op == OP_WHILE:
+                while await self.evaluate_rpn_async(node[2]):
+                    await self.execute_block_async(node[3])
+            elif op == OP_CALL:
+                args = []
+                for arg in node[3]:
+                    value = await self.evaluate_rpn_async(arg)
+                    args.append(float(value) if type(value) is int else value)
+                await self.call_macro_async(node[2], args)
+            elif op == OP_WAIT:
+                if self.pending_batch is not None:
+                    self.flush_batch()
+                handler = self.gcode_handlers.get("WAITPIN")
+                if handler:
+                    result = self.call_wait(handler, node)
+                    if is_awaitable(result):
+                        result = await result
+                    self.finish_wait(node, result)
+            else:
+                if op in IO_WORD_OPS:
+                    node = await self.resolve_io_async(node)
+                result = self.dispatch[op](node)
+                if result is not None and is_awaitable(result):
+                    await result
+
+            self.yield_countdown -= 1
+            if self.yield_countdown <= 0:
+                self.yield_countdown = self.yield_every
+                await self.async_sleep(0)
 
+    async def execute_block_async_profiled(self, nodes):
+        # Statements that run_async runs inline are timed here, the rest by
+        # their wrapped dispatch entries
+        execute_block_async = Grunt.execute_block_async
+        profiler = self.profiler
+        for node in nodes:
+            if node[0] in ASYNC_INLINE_OPS:
+                start = profiler.clock()
+                await execute_block_async(self, (node,))
+                profiler.record_line(node[1], profiler.clock() - start)
+            else:
+                await execute_block_async(self, (node,))
+
+    async def resolve_io_async(self, node):
+        # The node with its READ/RECV words awaited and put in as constants,
+        # so the dispatch entry runs it without meeting a coroutine
+        op = node[0]
+        if op == OP_GCODE:
+            if not node[5]:
+                return node
+            words = None
+            for i, (key, rpn, value) in enumerate(node[4]):
+                if rpn and rpn[-1][0] == EXPR_IO:
+                    if words is None:
+                        words = list(node[4])
+                    words[i] = (key, None, await self.evaluate_rpn_async(rpn))
+            return node if words is None else node[:4] + (words, True)
+        if op == OP_WRITEPIN:
+            pin_number, value = node[2], node[3]
+            if pin_number[-1][0] != EXPR_IO and value[-1][0] != EXPR_IO:
+                return node
+            if pin_number[-1][0] == EXPR_IO:
+                pin_number = [(EXPR_CONST, await self.evaluate_rpn_async(pin_number))]
+            if value[-1][0] == EXPR_IO:
+                value = [(EXPR_CONST, await self.evaluate_rpn_async(value))]
+            return (op, node[1], pin_number, value)
+        parts = None
+        for i, part in enumerate(node[2]):
+            if not isinstance(part, str) and part[-1][0] == EXPR_IO:
+                if parts is None:
+                    parts = list(node[2])
+                parts[i] = str(await self.evaluate_rpn_async(part))
+        return node if parts is None else (op, node[1], parts)
+
+    async def evaluate_rpn_async(self, rpn):
+        # READ/RECV is always the last item of an expression
+        if rpn[-1][0] != EXPR_IO:
+            return self.evaluate_rpn(rpn)
+        result = self.call_io(rpn[-1][1], self.evaluate_rpn(rpn[:-1]))
+        if is_awaitable(result):
+            result = await result
+        return result
+
+    async def call_macro_async(self, macro_name, args):
+        body = self.macros.get(macro_name)
+        if body is None:
+            raise ValueError(f"Macro {macro_name} not found")
+        if len(self.macro_args) >= self.max_call_depth:
+            raise ValueError(f"Macro {macro_name} exceeded the maximum call depth of {self.max_call_depth}")
+        self.macro_args.append(args)
+        try:
+            await self.execute_block_async(body)
+        finally:
+            self.macro_args.pop()
@@ -0,0 +1,194 @@
+import binascii
+import select
+import socket
+import sys
+
+import grunt
+import programcache
+import protocol
+from host.encoder import encode_program, frame_text, with_seq
+
+# Host side client for the line protocol in protocol.py. Lines are sent
+# pipelined with sequence numbers, keeping as many in flight as the device's
+# receive window allows instead of waiting for a reply to every line.
+
+# Base64 characters of a compiled program sent per UPLOAD line
+UPLOAD_CHUNK = 768
+
+def compile_program(program):
+    # Compile on the host into the blob the device caches, with its key.
+    # Constants are folded here so the board doesn't have to.
+    machine = grunt.Grunt(optimize=True)
+    key = programcache.source_hash(program)
+    return key, programcache.dumps(machine, machine.compile(program), key)
+
+def upload_lines(key, blob):
+    # UPLOAD lines that store a compiled program on the device
+    encoded = binascii.b2a_base64(blob).decode("ascii").strip()
+    lines = [f"UPLOAD {key} {encoded[i:i + UPLOAD_CHUNK]}" for i in range(0, len(encoded), UPLOAD_CHUNK)]
+    lines.append(f"UPLOAD {key} END")
+    return lines
+
+class Pipeline:
+    # Sending side of the protocol without any I/O: sequence numbers, the
+    # credit window, go-back-N after a NAK and matching replies to lines.
+    # GruntClient and the asyncio client in host/fleet.py drive it.
+    def __init__(self):
+        self.framer = protocol.LineFramer()
+        self.next_seq = 1
+        self.credits = 1  # Until the first ACK says how big the window is
+        self.unacked = []  # Sent but not ACKed yet, in order
+        self.ready = []  # Waiting to be sent (or sent again after a NAK), in order
+        self.lines = {}  # seq -> line, until it has finished
+        self.depth_before = {}  # seq -> block depth before that line
+        self.depth = 0
+        self.errors = []  # (line, message) of failed statements
+        self.messages = []  # [GCODE] messages, pin changes and other replies
+        self.plain_replies = []  # OK/ERROR replies to plain lines
+
+    def add(self, line):
+        # A line of text, or a binary frame from host/encoder.py
+        seq = self.next_seq
+        self.next_seq += 1
+        self.lines[seq] = line
+        self.depth_before[seq] = self.depth
+        if isinstance(line, str):
+            self.depth = max(self.depth + protocol.block_change(line), 0)
+        self.ready.append(seq)
+
+    def can_send(self):
+        # Lines inside an open block go out even without credit, the
+        # device always accepts them
+        return bool(self.ready) and (self.credits > 0 or self.depth_before[self.ready[0]] > 0)
+
+    def next_frame(self):
+        seq = self.ready.pop(0)
+        self.unacked.append(seq)
+        self.credits -= 1
+        line = self.lines[seq]
+        if isinstance(line, bytes):
+            return with_seq(line, seq)
+        return f"@{seq} {line}\n".encode("utf-8")
+
+    def feed(self, data):
+        for line in self.framer.feed(data):
+            self.handle_reply(line)
+
+    def finish(self, seq):
+        # A finished line frees its place in the window
+        if self.lines.pop(seq, None) is not None:
+            self.depth_before.pop(seq, None)
+            self.credits += 1
+
+    def handle_reply(self, line):
+        word, _, rest = line.partition(" ")
+        if word in ("ACK", "NAK"):
+            seq, _, free = rest.partition(" ")
+            seq = int(seq)
+            if word == "NAK":
+                # Go back: everything from seq on is sent again in order
+                for other in self.unacked:
+                    if other >= seq and other not in self.ready:
+                        self.ready.append(other)
+                self.ready.sort()
+                self.unacked = [other for other in self.unacked if other < seq]
+            elif seq in self.unacked:
+                self.unacked.remove(seq)
+            self.credits = int(free) - len(self.unacked)
+        elif word == "OK" and rest:
+            self.finish(int(rest))
+        elif word == "ERR":
+            seq, _, message = rest.partition(" ")
+            line = self.lines.get(int(seq))
+            self.errors.append((frame_text(line) if isinstance(line, bytes) else line, message))
+            self.finish(int(seq))
+        elif word in ("OK", "ERROR"):
+            self.plain_replies.append(line)
+        else:
+            self.messages.append(line)
+
+class GruntClient(Pipeline):
+    def __init__(self, host, port=5000, timeout=10.0):
+        super().__init__()
+        self.sock = socket.create_connection((host, port), timeout)
+        self.timeout = timeout
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, program, binary=False):
+        # With binary, motion lines are sent as frames the device doesn't
+        # have to parse
+        if binary:
+            return self.stream(encode_program(program))
+        return self.stream(program.split("\n"))
+
+    def run_cached(self, program):
+        # Run a program by its key; the first time, it is compiled here and
+        # uploaded so the device never has to parse it
+        key = programcache.source_hash(program)
+        errors = self.stream([f"RUNCACHED {key}"])
+        if errors and "not cached" in errors[0][1]:
+            self.upload(*compile_program(program))
+            errors = self.stream([f"RUNCACHED {key}"])
+        return errors
+
+    def upload(self, key, blob):
+        errors = self.stream(upload_lines(key, blob))
+        if errors:
+            raise ValueError(f"Upload of {key} failed: {errors[0][1]}")
+
+    def command(self, line):
+        errors = self.stream([line])
+        return errors[0][1] if errors else None
+
+    def stream(self, lines):
+        # Send all lines and wait until every one has finished. Returns the
+        # (line, message) pairs of statements that failed.
+        lines = iter(lines)
+        first_error = len(self.errors)
+        exhausted = False
+        while True:
+            if not self.ready and not exhausted:
+                line = next(lines, None)
+                if line is None:
+                    exhausted = True
+                else:
+                    self.add(line)
+
+            if self.can_send():
+                self.sock.sendall(self.next_frame())
+                continue
+
+            if exhausted and not self.lines:
+                return self.errors[first_error:]
+            self.receive()
+
+    def receive(self):
+        readable, _, _ = select.select([self.sock], [], [], self.timeout)
+        if not readable:
+            raise TimeoutError(f"No reply within {self.timeout} seconds")
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed by the device")
+        self.feed(data)
+
+if __name__ == "__main__":
+    # python -m host.client <host> <program file> [--cached | --binary]
+    with open(sys.argv[2]) as f:
+        program = f.read()
+    with GruntClient(sys.argv[1]) as client:
+        if "--cached" in sys.argv[3:]:
+            errors = client.run_cached(program)
+        else:
+            errors = client.run(program, binary="--binary" in sys.argv[3:])
+        for message in client.messages:
+            print(message)
+        for line, message in errors:
+            print(f"Error in '{line}': {message}")
@@ -0,0 +1,84 @@
+import struct
+import sys
+
+import protocol
+
+# Turns G-code programs into the binary frames of protocol.py. Plain motion
+# lines (a code from FRAME_CODES with numeric words from FRAME_WORDS of at
+# most three decimals) become frames; everything else, including anything
+# inside an IF/FOR/WHILE/MACRO block, stays a line of text. Values reach
+# the handlers exactly as they would have been parsed from the text.
+#
+#   python -m host.encoder program.gcode program.bin
+#
+# The frames made here have seq 0. The client fills in the seq when it
+# sends them with sequence numbers.
+
+CODES = {code: opcode for opcode, code in enumerate(protocol.FRAME_CODES)}
+WORD_BITS = {word: 1 << bit for bit, word in enumerate(protocol.FRAME_WORDS)}
+LIMIT = 2 ** 31
+
+def encode_line(line):
+    # The frame for a line, or None if it has to be sent as text
+    words = line.split(';')[0].split()
+    if not words or words[0] not in CODES:
+        return None
+    values = {}
+    for word in words[1:]:
+        key = word[0]
+        if key not in WORD_BITS or key in values:
+            return None
+        try:
+            value = float(word[1:])
+        except ValueError:
+            return None
+        if not -LIMIT < value * protocol.FRAME_SCALE < LIMIT:  # Also catches nan
+            return None
+        scaled = round(value * protocol.FRAME_SCALE)
+        if scaled / protocol.FRAME_SCALE != value:
+            return None
+        values[key] = scaled
+    mask = 0
+    for key in values:
+        mask |= WORD_BITS[key]
+    frame = struct.pack(protocol.FRAME_HEADER, protocol.FRAME_MAGIC, CODES[words[0]], 0, mask)
+    for word in protocol.FRAME_WORDS:
+        if word in values:
+            frame += struct.pack(protocol.FRAME_VALUE, values[word])
+    return frame
+
+def encode_program(program):
+    # The program as a list of frames (bytes) and text lines (str)
+    items = []
+    depth = 0
+    for line in program.split("\n"):
+        frame = encode_line(line) if depth == 0 else None
+        items.append(line if frame is None else frame)
+        depth = max(depth + protocol.block_change(line), 0)
+    return items
+
+def with_seq(frame, seq):
+    frame = bytearray(frame)
+    struct.pack_into("<I", frame, protocol.FRAME_SEQ_OFFSET, seq)
+    return bytes(frame)
+
+def frame_text(frame):
+    # A frame back as a line of G-code, for messages
+    _, code, args = protocol.decode_frame(frame)
+    return " ".join([str(code)] + [f"{key}{value:g}" for key, value in args.items()])
+
+def to_stream(items):
+    # Frames and lines as the bytes a plain (unsequenced) sender would send
+    return b"".join(item if isinstance(item, bytes) else f"{item}\n".encode("utf-8") for item in items)
+
+if __name__ == "__main__":
+    # python -m host.encoder <program file> [<output file>]
+    with open(sys.argv[1]) as f:
+        items = encode_program(f.read())
+    stream = to_stream(items)
+    frames = sum(1 for item in items if isinstance(item, bytes))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "wb") as f:
+            f.write(stream)
+    text = sum(len(item) + 1 for item in items if isinstance(item, str))
+    print(f"{frames} of {len(items)} lines as frames, {len(stream)} bytes ({text} bytes of text left)")
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import sys
+
+import grunt
+import programcache
+import protocol
+
+# Stand-in for code.py on a computer: the same line protocol, receive window,
+# immediate commands and program cache, with handlers that only count what
+# they were asked to do. Used to try out host tools without any boards.
+#
+#   python -m host.fakeserver 8 --port 6000    # 8 fakes on ports 6000-6007
+
+MOTION_CODES = ("G0", "G1", "G14", "G15", "M10", "M11")
+COMMAND_QUEUE_SIZE = 2 * protocol.WINDOW_SIZE
+
+class FakeController:
+    def __init__(self, name="fake", latency=0.0):
+        self.name = name
+        self.latency = latency  # Extra seconds each statement takes
+        self.machine = grunt.Grunt()
+        self.counts = {}  # code -> commands run
+        for code in MOTION_CODES:
+            self.machine.register(code, self.counter(code))
+        self.machine.register("WRITEMSG", self.send_message)
+        self.machine.register("READ", lambda pin_number: 0)
+        self.machine.register("RECV", lambda timeout: None)
+        self.machine.register("WRITEPIN", lambda pin_number, value: None)
+        self.cache = programcache.ProgramCache()
+        self.queue = asyncio.Queue(COMMAND_QUEUE_SIZE)
+        self.writers = []
+        self.server = None
+        self.task = None
+        self.port = None
+        self.statements = 0
+
+    def counter(self, code):
+        def handler(args):
+            self.counts[code] = self.counts.get(code, 0) + 1
+        return handler
+
+    def send_message(self, message):
+        data = f"{protocol.GCODE_IDENTIFIER} {message}\n".encode("utf-8")
+        for writer in self.writers:
+            writer.write(data)
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.task = asyncio.ensure_future(self.interpreter())
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.task.cancel()
+        for writer in self.writers:
+            writer.close()
+
+    def status(self):
+        return (f"QUEUES messages=0/32 high=0 dropped=0 rejected=0 "
+                f"commands={self.queue.qsize()}/{COMMAND_QUEUE_SIZE} high=0 dropped=0 rejected=0\n")
+
+    def immediate(self, command):
+        # The reply to a command code.py answers at once, or None
+        if command == "QUEUES":
+            return self.status()
+        if command == "STATS":
+            stats = self.machine.stats()
+            stats["counts"] = self.counts
+            stats["program_cache"] = self.cache.stats()
+            return f"STATS {json.dumps(stats)}\n"
+        if command.startswith("autoauth"):
+            return f"{command.split(' ')[1]}\n"
+        return None
+
+    async def serve(self, reader, writer):
+        receiver = protocol.Receiver()
+        self.writers.append(writer)
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                for line in receiver.framer.feed(data):
+                    if not isinstance(line, str):
+                        self.handle_frame(receiver, writer, line)
+                        continue
+                    reply = self.immediate(line.strip())
+                    if reply is not None:
+                        writer.write(reply.encode("utf-8"))
+                        continue
+                    reply, message, statement = receiver.handle_line(line)
+                    if reply is not None:
+                        writer.write(reply.encode("utf-8"))
+                    if statement is not None:
+                        try:
+                            self.queue.put_nowait((statement, receiver, writer))
+                        except asyncio.QueueFull:
+                            receiver.finished(statement[1])
+                            for reply in protocol.reply_lines(statement[1], "busy"):
+                                writer.write(reply.encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writers.remove(writer)
+            writer.close()
+
+    def handle_frame(self, receiver, writer, frame):
+        replies, statement = receiver.handle_frame(frame)
+        if replies is not None:
+            writer.write(replies.encode("utf-8"))
+        if statement is not None:
+            (code, args), seqs = statement
+            try:
+                self.queue.put_nowait(((self.machine.gcode_program(code, args), seqs), receiver, writer))
+            except asyncio.QueueFull:
+                receiver.finished(seqs)
+                for reply in protocol.reply_lines(seqs, "busy"):
+                    writer.write(reply.encode("utf-8"))
+
+    async def interpreter(self):
+        while True:
+            (command, seqs), receiver, writer = await self.queue.get()
+            error = None
+            try:
+                await self.run(command)
+            except Exception as e:
+                error = str(e)
+            self.statements += 1
+            receiver.finished(seqs)
+            for reply in protocol.reply_lines(seqs, error):
+                writer.write(reply.encode("utf-8"))
+
+    async def run(self, command):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(command, grunt.Program):
+            await self.machine.run_async(command)
+            return
+        words = command.split()
+        if command.startswith("RUNCACHED"):
+            program = self.cache.load(self.machine, words[1])
+            if program is None:
+                raise ValueError(f"Program {words[1]} is not cached")
+            await self.machine.run_async(program)
+        elif command.startswith("UPLOAD"):
+            if words[2] == "END":
+                self.cache.finish_upload(words[1])
+            else:
+                self.cache.upload(words[1], words[2])
+        else:
+            await self.machine.run_async(command)
+
+async def start_fakes(count, host="127.0.0.1", port=0, latency=0.0):
+    # Start count fakes on consecutive ports from port (any free ports if 0)
+    fakes = []
+    for i in range(count):
+        fake = FakeController(f"fake{i}", latency)
+        await fake.start(host, port + i if port else 0)
+        fakes.append(fake)
+    return fakes
+
+if __name__ == "__main__":
+    # python -m host.fakeserver [count] [--port first_port] [--latency seconds]
+    args = sys.argv[1:]
+    options = {"--port": 5000, "--latency": 0.0}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            options[name] = type(options[name])(args[i + 1])
+            del args[i:i + 2]
+    count = int(args[0]) if args else 1
+
+    async def main():
+        fakes = await start_fakes(count, port=options["--port"], latency=options["--latency"])
+        for fake in fakes:
+            print(f"{fake.name} listening on 127.0.0.1:{fake.port}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
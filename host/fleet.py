@@ -0,0 +1,295 @@
+import asyncio
+import json
+import sys
+import time
+
+import programcache
+from host.client import Pipeline, compile_program, upload_lines
+
+# Sending programs to many boards at once with asyncio. Every device keeps
+# one persistent connection that is opened when first needed and opened
+# again after a failure. Jobs for the same device run one after another,
+# and jobs for different devices run side by side.
+#
+#   async with Fleet(["192.168.0.111", "192.168.0.112:5001"]) as fleet:
+#       results = await fleet.broadcast(program)
+#
+# Results are dicts:
+#   {"device", "ok", "errors": [(line, message)], "messages", "elapsed", "error"}
+# where error is set when the job didn't complete (timeout, connection lost).
+
+DEFAULT_PORT = 5000
+
+class AsyncGruntClient(Pipeline):
+    def __init__(self, host, port=DEFAULT_PORT, timeout=10.0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.writer = None
+
+    async def run(self, program):
+        return await self.stream(program.split("\n"))
+
+    async def run_cached(self, program):
+        key = programcache.source_hash(program)
+        errors = await self.stream([f"RUNCACHED {key}"])
+        if errors and "not cached" in errors[0][1]:
+            errors = await self.stream(upload_lines(*compile_program(program)))
+            if errors:
+                return errors
+            errors = await self.stream([f"RUNCACHED {key}"])
+        return errors
+
+    async def stream(self, lines):
+        # Same as GruntClient.stream, waiting in the event loop
+        lines = iter(lines)
+        first_error = len(self.errors)
+        exhausted = False
+        while True:
+            if not self.ready and not exhausted:
+                line = next(lines, None)
+                if line is None:
+                    exhausted = True
+                else:
+                    self.add(line)
+
+            if self.can_send():
+                self.writer.write(self.next_frame())
+                continue
+
+            await self.writer.drain()
+            if exhausted and not self.lines:
+                return self.errors[first_error:]
+            await self.receive()
+
+    async def receive(self):
+        try:
+            data = await asyncio.wait_for(self.reader.read(4096), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No reply from {self.host}:{self.port} within {self.timeout} seconds")
+        if not data:
+            raise ConnectionError(f"Connection closed by {self.host}:{self.port}")
+        self.feed(data)
+
+    async def request(self, line, reply_word):
+        # Send a plain line the device answers at once (QUEUES, STATS,
+        # autoauth) and return the reply that starts with reply_word
+        first_message = len(self.messages)
+        first_plain = len(self.plain_replies)
+        self.writer.write(f"{line}\n".encode("utf-8"))
+        await self.writer.drain()
+        while True:
+            for i in range(first_message, len(self.messages)):
+                message = self.messages[i]
+                if message.split(" ", 1)[0] == reply_word:
+                    del self.messages[i]
+                    return message
+            for reply in self.plain_replies[first_plain:]:
+                if reply.startswith("ERROR"):
+                    raise ValueError(reply[6:])
+            await self.receive()
+
+class Device:
+    def __init__(self, address, timeout=10.0, max_pending=4, concurrency=None):
+        host, _, port = address.partition(":")
+        self.address = address
+        self.host = host
+        self.port = int(port) if port else DEFAULT_PORT
+        self.timeout = timeout
+        self.client = None
+        self.lock = asyncio.Lock()  # One job at a time on the connection
+        # Jobs waiting or running; submit() waits when it is used up, so a
+        # slow device holds back its own jobs and nobody else's
+        self.slots = asyncio.Semaphore(max_pending)
+        # Shared with the other devices of a fleet, to bound open sockets.
+        # It is only taken once this device is free, so jobs queued for a
+        # busy device don't hold it.
+        self.concurrency = concurrency
+        self.state = "idle"
+        self.jobs = 0
+        self.failures = 0
+        self.last_error = None
+
+    async def connection(self):
+        if self.client is None or not self.client.connected():
+            self.client = AsyncGruntClient(self.host, self.port, self.timeout)
+            await self.client.connect()
+        return self.client
+
+    async def drop(self):
+        # After a timeout or error the protocol state is unknown
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def call(self, job, timeout):
+        # Run job(client) on the connection, giving up after timeout seconds
+        async with self.slots:
+            async with self.lock:
+                if self.concurrency is None:
+                    return await self.run(job, timeout)
+                async with self.concurrency:
+                    return await self.run(job, timeout)
+
+    async def run(self, job, timeout):
+        self.state = "busy"
+        try:
+            client = await self.connection()
+            result = await asyncio.wait_for(job(client), timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            await self.drop()
+            self.state = "error"
+            raise TimeoutError(f"{self.address} did not finish within {timeout} seconds")
+        except (ConnectionError, OSError, ValueError):
+            await self.drop()
+            self.state = "error"
+            raise
+        self.state = "idle"
+        return result
+
+    async def submit(self, program, cached=False, timeout=None):
+        start = time.monotonic()
+        first_message = 0
+        result = {"device": self.address, "ok": False, "errors": [], "messages": [],
+                  "elapsed": 0.0, "error": None}
+
+        async def job(client):
+            nonlocal first_message
+            first_message = len(client.messages)
+            if cached:
+                return await client.run_cached(program)
+            return await client.run(program)
+
+        self.jobs += 1
+        try:
+            errors = await self.call(job, timeout or self.timeout)
+            result["errors"] = errors
+            result["ok"] = not errors
+            result["messages"] = self.client.messages[first_message:]
+            del self.client.messages[first_message:]
+        except (TimeoutError, ConnectionError, OSError, ValueError) as e:
+            result["error"] = str(e) or type(e).__name__
+        if not result["ok"]:
+            self.failures += 1
+            self.last_error = result["error"] or result["errors"][0][1]
+        result["elapsed"] = time.monotonic() - start
+        return result
+
+    async def request(self, line, reply_word, timeout=None):
+        return await self.call(lambda client: client.request(line, reply_word), timeout or self.timeout)
+
+class Fleet:
+    def __init__(self, addresses, timeout=10.0, max_pending=4, max_concurrency=32):
+        # Devices worked on at the same time, to bound open sockets
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.devices = {address: Device(address, timeout, max_pending, self.concurrency)
+                        for address in addresses}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await asyncio.gather(*[device.drop() for device in self.devices.values()])
+
+    def device(self, address):
+        if address not in self.devices:
+            raise ValueError(f"Unknown device: {address}")
+        return self.devices[address]
+
+    async def submit(self, address, program, cached=False, timeout=None):
+        return await self.device(address).submit(program, cached, timeout)
+
+    async def submit_many(self, jobs, cached=False, timeout=None):
+        # jobs maps a device address to its program; returns address -> result
+        addresses = list(jobs)
+        results = await asyncio.gather(*[self.submit(address, jobs[address], cached, timeout)
+                                         for address in addresses])
+        return dict(zip(addresses, results))
+
+    async def broadcast(self, program, addresses=None, cached=False, timeout=None):
+        # The same program on every device (or the given ones). With cached,
+        # each device is sent the compiled program once and then runs it by key.
+        addresses = list(self.devices) if addresses is None else addresses
+        return await self.submit_many({address: program for address in addresses}, cached, timeout)
+
+    async def gather_requests(self, line, reply_word, timeout=None):
+        async def one(device):
+            try:
+                return await device.request(line, reply_word, timeout)
+            except (TimeoutError, ConnectionError, OSError, ValueError) as e:
+                return e
+        devices = list(self.devices.values())
+        replies = await asyncio.gather(*[one(device) for device in devices])
+        return {device.address: reply for device, reply in zip(devices, replies)}
+
+    async def status(self, timeout=None):
+        # Queue levels of every device, plus what the fleet knows about it
+        replies = await self.gather_requests("QUEUES", "QUEUES", timeout)
+        status = {}
+        for address, reply in replies.items():
+            device = self.devices[address]
+            status[address] = {
+                "state": "offline" if isinstance(reply, Exception) else device.state,
+                "queues": None if isinstance(reply, Exception) else reply[7:],
+                "jobs": device.jobs,
+                "failures": device.failures,
+                "last_error": str(reply) if isinstance(reply, Exception) else device.last_error,
+            }
+        return status
+
+    async def stats(self, timeout=None):
+        replies = await self.gather_requests("STATS", "STATS", timeout)
+        return {address: reply if isinstance(reply, Exception) else json.loads(reply[6:])
+                for address, reply in replies.items()}
+
+    async def autoauth(self, code, timeout=None):
+        # The devices that answered autoauth with the code
+        replies = await self.gather_requests(f"autoauth {code}", str(code), timeout)
+        return [address for address, reply in replies.items() if not isinstance(reply, Exception)]
+
+if __name__ == "__main__":
+    # python -m host.fleet <program file> <device[:port]> ... [--cached]
+    # python -m host.fleet --status <device[:port]> ...
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+
+    async def main():
+        if "--status" in flags:
+            async with Fleet(args) as fleet:
+                for address, status in (await fleet.status()).items():
+                    print(f"{address}: {status}")
+            return
+        with open(args[0]) as f:
+            program = f.read()
+        async with Fleet(args[1:]) as fleet:
+            results = await fleet.broadcast(program, cached="--cached" in flags)
+        for address, result in results.items():
+            if result["ok"]:
+                print(f"{address}: ok in {result['elapsed']:.2f}s")
+            else:
+                print(f"{address}: failed: {result['error'] or result['errors']}")
+            for message in result["messages"]:
+                print(f"  {message}")
+
+    asyncio.run(main())
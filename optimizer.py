@@ -0,0 +1,289 @@
+import grunt
+
+# Optimization pass over compiled Grunt programs:
+#   - constant subexpressions are folded: [10 * 2.54] becomes 25.4
+#   - IF/ELSEIF/ELSE branches with constant conditions are pruned, and
+#     WHILE loops whose condition is constantly false are dropped
+#   - FOR loops with constant bounds and at most unroll_limit iterations
+#     are unrolled (off unless unroll_limit is set)
+#
+# Enabled with Grunt(optimize=True), or on a compiled program with
+# optimize(machine, program). To see what it does to a program:
+#
+#   python optimizer.py program.gcode [unroll_limit]
+
+def fold_expression(rpn, values=None):
+    # Returns the RPN with every operator on constants replaced by its
+    # result. values maps variable slots known to be constant to their value.
+    stack = []
+    for item in rpn:
+        kind, value = item
+        if kind == grunt.EXPR_VAR and values and value in values:
+            stack.append([(grunt.EXPR_CONST, values[value])])
+        elif kind == grunt.EXPR_OP:
+            b = stack.pop()
+            a = stack.pop()
+            if len(a) == 1 and len(b) == 1 and a[0][0] == grunt.EXPR_CONST and b[0][0] == grunt.EXPR_CONST:
+                try:
+                    stack.append([(grunt.EXPR_CONST, value(a[0][1], b[0][1]))])
+                    continue
+                except (ArithmeticError, TypeError):
+                    pass  # Left for the error to happen when it runs
+            stack.append(a + b + [item])
+        elif kind == grunt.EXPR_IO:
+            stack.append(stack.pop() + [item])
+        else:
+            stack.append([item])
+    return stack[0] if len(stack) == 1 else list(rpn)
+
+def constant(rpn):
+    # (True, value) for a constant expression, (False, None) otherwise
+    if len(rpn) == 1 and rpn[0][0] == grunt.EXPR_CONST:
+        return True, rpn[0][1]
+    return False, None
+
+def assigns(nodes, slot):
+    # True if the nodes might change the variable in slot
+    for node in nodes:
+        op = node[0]
+        if op == grunt.OP_CALL:
+            return True  # Macros share the variables
+        if op in (grunt.OP_SET, grunt.OP_FOR) and node[2] == slot:
+            return True
+        if op == grunt.OP_WAIT and node[5] == slot:
+            return True
+        if op == grunt.OP_IF:
+            if any(assigns(body, slot) for _, body in node[2]) or assigns(node[3], slot):
+                return True
+        elif op == grunt.OP_FOR and assigns(node[5], slot):
+            return True
+        elif op == grunt.OP_WHILE and assigns(node[3], slot):
+            return True
+    return False
+
+class Optimizer:
+    def __init__(self, unroll_limit=0):
+        self.unroll_limit = unroll_limit
+        self.values = {}  # Loop variables known to be constant while unrolling
+
+    def fold(self, rpn):
+        return fold_expression(rpn, self.values)
+
+    def block(self, nodes):
+        out = []
+        for node in nodes:
+            out.extend(self.node(node))
+        return out
+
+    def node(self, node):
+        # Returns the list of nodes that replace node
+        op = node[0]
+        if op == grunt.OP_GCODE:
+            _, line_no, code, cell, args, dynamic = node
+            if not dynamic:
+                return [node]
+            args = [(key, self.fold(rpn), None) if rpn else (key, rpn, value) for key, rpn, value in args]
+            folded = []
+            for key, rpn, value in args:
+                if rpn:
+                    is_constant, value = constant(rpn)
+                    if not is_constant:
+                        return [(op, line_no, code, cell, args, True)]
+                folded.append((key, value))
+            return [(op, line_no, code, cell, dict(folded), False)]
+
+        if op == grunt.OP_IF:
+            branches = []
+            branch_lines = []
+            for (condition, body), branch_line in zip(node[2], node[4]):
+                condition = self.fold(condition)
+                is_constant, value = constant(condition)
+                if is_constant and not value:
+                    continue
+                if is_constant:
+                    # Always taken: it becomes the else of what is left
+                    if not branches:
+                        return self.block(body)
+                    return [(op, branch_lines[0], branches, self.block(body), branch_lines)]
+                branches.append((condition, self.block(body)))
+                branch_lines.append(branch_line)
+            if not branches:
+                return self.block(node[3])
+            return [(op, branch_lines[0], branches, self.block(node[3]), branch_lines)]
+
+        if op == grunt.OP_FOR:
+            _, line_no, slot, start, end, body = node
+            start = self.fold(start)
+            end = self.fold(end)
+            unrolled = self.unroll(line_no, slot, start, end, body)
+            if unrolled is not None:
+                return unrolled
+            return [(op, line_no, slot, start, end, self.block(body))]
+
+        if op == grunt.OP_WHILE:
+            condition = self.fold(node[2])
+            is_constant, value = constant(condition)
+            if is_constant and not value:
+                return []
+            return [(op, node[1], condition, self.block(node[3]))]
+
+        if op == grunt.OP_CALL:
+            return [(op, node[1], node[2], [self.fold(arg) for arg in node[3]])]
+
+        if op == grunt.OP_MACRO:
+            # Loop variables outside the macro mean nothing inside it
+            values = self.values
+            self.values = {}
+            body = self.block(node[3])
+            self.values = values
+            return [(op, node[1], node[2], body)]
+
+        if op == grunt.OP_SET:
+            return [(op, node[1], node[2], self.fold(node[3]))]
+
+        if op == grunt.OP_WRITEPIN:
+            return [(op, node[1], self.fold(node[2]), self.fold(node[3]))]
+
+        if op == grunt.OP_WRITEMSG:
+            parts = []
+            for part in node[2]:
+                if not isinstance(part, str):
+                    part = self.fold(part)
+                    is_constant, value = constant(part)
+                    if is_constant:
+                        part = str(value)
+                if isinstance(part, str) and parts and isinstance(parts[-1], str):
+                    parts[-1] += part
+                else:
+                    parts.append(part)
+            return [(op, node[1], parts)]
+
+        if op == grunt.OP_WAIT:
+            return [(op, node[1], self.fold(node[2]), self.fold(node[3]), self.fold(node[4]), node[5])]
+
+        return [node]
+
+    def unroll(self, line_no, slot, start, end, body):
+        # Unrolled loops set the variable before each pass like the loop
+        # would. Where the body can't change it, its uses become constants.
+        is_start, first = constant(start)
+        is_end, last = constant(end)
+        if not (is_start and is_end) or self.unroll_limit <= 0:
+            return None
+        count = int(last) - int(first) + 1
+        if count > self.unroll_limit:
+            return None
+        substitute = not assigns(body, slot)
+        out = []
+        for val in range(int(first), int(last) + 1):
+            out.append((grunt.OP_SET, line_no, slot, [(grunt.EXPR_CONST, val)]))
+            if substitute:
+                self.values[slot] = val
+            out.extend(self.block(body))
+        self.values.pop(slot, None)
+        return out
+
+def optimize(machine, program, unroll_limit=None):
+    if unroll_limit is None:
+        unroll_limit = machine.unroll_limit
+    return grunt.Program(Optimizer(unroll_limit).block(program.nodes))
+
+def count_nodes(nodes):
+    count = 0
+    for node in nodes:
+        count += 1
+        op = node[0]
+        if op == grunt.OP_IF:
+            count += sum(count_nodes(body) for _, body in node[2]) + count_nodes(node[3])
+        elif op == grunt.OP_FOR:
+            count += count_nodes(node[5])
+        elif op in (grunt.OP_WHILE, grunt.OP_MACRO):
+            count += count_nodes(node[3])
+    return count
+
+def format_expression(machine, rpn):
+    # RPN back to infix, with brackets only where they are needed
+    symbols = {function: symbol for symbol, function in machine.operators.items()}
+    stack = []  # (text, precedence)
+    for kind, value in rpn:
+        if kind == grunt.EXPR_CONST:
+            stack.append((repr(value) if isinstance(value, str) else str(value), 9))
+        elif kind == grunt.EXPR_VAR:
+            stack.append((machine.variables.name(value).replace("var_", "#", 1), 9))
+        elif kind == grunt.EXPR_ARG:
+            stack.append((f"${value + 1}", 9))
+        elif kind == grunt.EXPR_IO:
+            stack.append((f"{value}[{stack.pop()[0]}]", 9))
+        else:
+            symbol = symbols[value]
+            precedence = grunt.PRECEDENCE[symbol]
+            b = stack.pop()
+            a = stack.pop()
+            left = a[0] if a[1] >= precedence else f"({a[0]})"
+            right = b[0] if b[1] > precedence else f"({b[0]})"
+            stack.append((f"{left} {symbol} {right}", precedence))
+    return f"[{stack[0][0]}]"
+
+def dump(machine, program):
+    # The program as text, one node per line with its source line number
+    lines = []
+    variable = lambda slot: machine.variables.name(slot).replace("var_", "#", 1)
+    expression = lambda rpn: format_expression(machine, rpn)
+
+    def block(nodes, indent):
+        pad = "  " * indent
+        for node in nodes:
+            op, line_no = node[0], node[1]
+            prefix = f"{line_no:5}: {pad}"
+            if op == grunt.OP_GCODE:
+                if node[5]:
+                    words = [key + (expression(rpn) if rpn else str(value)) for key, rpn, value in node[4]]
+                else:
+                    words = [key + str(value) for key, value in node[4].items()]
+                lines.append(prefix + " ".join([node[2]] + words))
+            elif op == grunt.OP_IF:
+                # Each branch shows the line its IF or ELSEIF is on
+                for i, (condition, body) in enumerate(node[2]):
+                    lines.append(f"{node[4][i]:5}: {pad}" + ("IF " if i == 0 else "ELSEIF ") + expression(condition))
+                    block(body, indent + 1)
+                if node[3]:
+                    lines.append(f"{'':5}  {pad}ELSE")
+                    block(node[3], indent + 1)
+                lines.append(f"{'':5}  {pad}ENDIF")
+            elif op == grunt.OP_FOR:
+                lines.append(prefix + f"FOR {variable(node[2])} {expression(node[3])} {expression(node[4])}")
+                block(node[5], indent + 1)
+                lines.append(f"{'':5}  {pad}ENDFOR")
+            elif op == grunt.OP_WHILE:
+                lines.append(prefix + f"WHILE {expression(node[2])}")
+                block(node[3], indent + 1)
+                lines.append(f"{'':5}  {pad}ENDWHILE")
+            elif op == grunt.OP_CALL:
+                lines.append(prefix + " ".join(["CALL", node[2]] + [expression(arg) for arg in node[3]]))
+            elif op == grunt.OP_MACRO:
+                lines.append(prefix + f"MACRO {node[2]}")
+                block(node[3], indent + 1)
+                lines.append(f"{'':5}  {pad}ENDMACRO")
+            elif op == grunt.OP_SET:
+                lines.append(prefix + f"{variable(node[2])} = {expression(node[3])}")
+            elif op == grunt.OP_WRITEPIN:
+                lines.append(prefix + f"WRITE {expression(node[2])} {expression(node[3])}")
+            elif op == grunt.OP_WRITEMSG:
+                text = "".join(part if isinstance(part, str) else expression(part) for part in node[2])
+                lines.append(prefix + f"WRITE {text}")
+            elif op == grunt.OP_WAIT:
+                result = f" {variable(node[5])}" if node[5] is not None else ""
+                lines.append(prefix + f"WAIT PIN {expression(node[2])} {expression(node[3])} {expression(node[4])}{result}")
+
+    block(program.nodes, 0)
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import sys
+
+    machine = grunt.Grunt()
+    with open(sys.argv[1]) as f:
+        program = machine.compile(f.read())
+    optimized = optimize(machine, program, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print(dump(machine, optimized))
+    print(f"; {count_nodes(program.nodes)} nodes before, {count_nodes(optimized.nodes)} after")
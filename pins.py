@@ -0,0 +1,194 @@
+import stepgen
+
+# Pins used by Grunt programs, configured once at startup instead of on
+# every READ or WRITE. Inputs are watched by a backend that turns changes
+# into timestamped (time_ns, pin_number, value) events:
+#
+#   KeypadBackend   keypad scans the pins in the background and queues every
+#                   change, so nothing is missed while a command is running
+#   PollingBackend  reads the pins each time it is polled, for boards
+#                   without keypad
+#   SimulatedBackend  values are set from code, for running on a computer
+#
+#   manager = PinManager({0: board.GP5}, outputs={1: board.GP7})
+#   manager.listeners.append(print)
+#   asyncio.create_task(manager.run())
+
+POLL_INTERVAL = 0.01
+
+# supervisor.ticks_ms() wraps around at 2**29
+TICKS_PERIOD = 1 << 29
+
+def digital_output(pin):
+    import digitalio
+    io = digitalio.DigitalInOut(pin)
+    io.direction = digitalio.Direction.OUTPUT
+    return io
+
+class KeypadBackend:
+    def __init__(self, pins, clock, interval=0.005):
+        import keypad
+        import supervisor
+        self.numbers = list(pins)
+        self.keys = keypad.Keys([pins[number] for number in self.numbers],
+                                value_when_pressed=True, pull=False, interval=interval)
+        self.event = keypad.Event()
+        self.ticks_ms = supervisor.ticks_ms
+        self.clock = clock
+        # keypad starts with every key released and reports the ones that
+        # are high as changes on its first scan
+        self.values = {number: False for number in self.numbers}
+        self.missed = 0
+
+    def events(self):
+        changes = []
+        now = self.clock.now()
+        ticks = self.ticks_ms()
+        queue = self.keys.events
+        if queue.overflowed:
+            self.missed += 1
+            queue.clear()
+            self.keys.reset()
+        event = self.event
+        while queue.get_into(event):
+            # Work back from the age of the event to a clock time
+            age = (ticks - event.timestamp) % TICKS_PERIOD
+            number = self.numbers[event.key_number]
+            self.values[number] = event.pressed
+            changes.append((now - age * 1000000, number, event.pressed))
+        return changes
+
+    def output(self, pin):
+        return digital_output(pin)
+
+class PollingBackend:
+    # Changes shorter than the poll interval are missed
+    def __init__(self, pins, clock):
+        import digitalio
+        self.clock = clock
+        self.inputs = {}
+        for number, pin in pins.items():
+            io = digitalio.DigitalInOut(pin)
+            io.direction = digitalio.Direction.INPUT
+            self.inputs[number] = io
+        self.values = {number: io.value for number, io in self.inputs.items()}
+        self.missed = 0
+
+    def events(self):
+        changes = []
+        now = self.clock.now()
+        for number, io in self.inputs.items():
+            value = io.value
+            if value != self.values[number]:
+                self.values[number] = value
+                changes.append((now, number, value))
+        return changes
+
+    def output(self, pin):
+        return digital_output(pin)
+
+class SimulatedBackend:
+    def __init__(self, pins, clock):
+        self.clock = clock
+        self.values = {number: False for number in pins}
+        self.pending = []
+        self.missed = 0
+
+    def set(self, number, value):
+        # Change an input as if it happened now
+        self.pending.append((self.clock.now(), number, bool(value)))
+
+    def events(self):
+        changes = self.pending
+        self.pending = []
+        for _, number, value in changes:
+            self.values[number] = value
+        return changes
+
+    def output(self, pin):
+        return stepgen.SimulatedPin(self.clock)
+
+def make_backend(pins, clock):
+    try:
+        return KeypadBackend(pins, clock)
+    except ImportError:
+        return PollingBackend(pins, clock)
+
+class PinManager:
+    def __init__(self, inputs, outputs=None, backend=None, clock=None):
+        # inputs and outputs map the pin numbers used by programs to pins
+        self.clock = clock or stepgen.MonotonicClock()
+        self.backend = backend if backend is not None else make_backend(inputs, self.clock)
+        self.outputs = {number: self.backend.output(pin) for number, pin in (outputs or {}).items()}
+        self.listeners = []  # Called with every event
+        self.waiters = []
+        self.event_count = 0
+
+    def has_pin(self, number):
+        return number in self.backend.values or number in self.outputs
+
+    def update(self):
+        # Hand the backend's new events to the listeners and waiters
+        for event in self.backend.events():
+            self.event_count += 1
+            _, number, value = event
+            for waiter in self.waiters:
+                if waiter[0] == number and waiter[1] == value:
+                    waiter[2] = True
+            for listener in self.listeners:
+                listener(event)
+
+    def read(self, number):
+        if number in self.outputs:
+            return self.outputs[number].value
+        if number not in self.backend.values:
+            raise ValueError(f"Pin {number} is not configured")
+        self.update()
+        return self.backend.values[number]
+
+    def write(self, number, value):
+        output = self.outputs.get(number)
+        if output is None:
+            raise ValueError(f"Pin {number} is not configured as an output")
+        output.value = bool(value)
+
+    async def wait(self, number, value, timeout):
+        # Wait until an input has the value, or has had it since the wait
+        # started, so a pulse between two updates still counts. Returns
+        # False on timeout.
+        if number not in self.backend.values:
+            raise ValueError(f"Pin {number} is not configured as an input")
+        value = bool(value)
+        self.update()
+        if self.backend.values[number] == value:
+            return True
+        waiter = [number, value, False]
+        self.waiters.append(waiter)
+        deadline = self.clock.now() + int(timeout * stepgen.NS)
+        interval = int(POLL_INTERVAL * stepgen.NS)
+        try:
+            while not waiter[2]:
+                left = deadline - self.clock.now()
+                if left <= 0:
+                    return False
+                await self.clock.sleep(min(interval, left))
+                self.update()
+        finally:
+            self.waiters.remove(waiter)
+        return True
+
+    async def run(self, interval=POLL_INTERVAL):
+        # Update on a fixed cadence, whether or not a program is running
+        ns = int(interval * stepgen.NS)
+        while True:
+            self.update()
+            await self.clock.sleep(ns)
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "inputs": len(self.backend.values),
+            "outputs": len(self.outputs),
+            "events": self.event_count,
+            "missed": self.backend.missed,
+        }
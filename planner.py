@@ -0,0 +1,206 @@
+import math
+
+# Motion planner that sits between Grunt and the motion handlers. G1 moves
+# are buffered so the speed at each junction can be planned ahead, then
+# handed on as Segments with their entry, cruise and exit speeds.
+#
+#   planner = Planner({"X": {"max_velocity": 100, "max_accel": 500},
+#                      "Y": {"max_velocity": 100, "max_accel": 500}}, emit)
+#   planner.attach(machine)
+#
+# Distances are in mm, speeds in mm/s and accelerations in mm/s^2. Feed
+# rates (F) are given in mm/min as usual in G-code.
+
+class Segment:
+    __slots__ = ("start", "target", "length", "unit", "nominal_speed", "accel",
+                 "max_entry_speed", "entry_speed", "exit_speed")
+
+    def __init__(self, start, target, length, unit, nominal_speed, accel, max_entry_speed):
+        self.start = start
+        self.target = target
+        self.length = length
+        self.unit = unit
+        self.nominal_speed = nominal_speed
+        self.accel = accel
+        self.max_entry_speed = max_entry_speed
+        self.entry_speed = 0.0
+        self.exit_speed = 0.0
+
+    def profile(self):
+        # Trapezoid as (cruise_speed, accel_distance, cruise_distance, decel_distance)
+        a2 = 2 * self.accel
+        v0 = self.entry_speed * self.entry_speed
+        v1 = self.exit_speed * self.exit_speed
+        vn = self.nominal_speed * self.nominal_speed
+        accel_distance = (vn - v0) / a2
+        decel_distance = (vn - v1) / a2
+        if accel_distance + decel_distance <= self.length:
+            return self.nominal_speed, accel_distance, self.length - accel_distance - decel_distance, decel_distance
+        # Too short to reach the nominal speed: accelerate then decelerate
+        peak = (a2 * self.length + v0 + v1) / 2
+        accel_distance = min(max((peak - v0) / a2, 0.0), self.length)
+        return math.sqrt(peak), accel_distance, 0.0, self.length - accel_distance
+
+    def duration(self):
+        cruise_speed, accel_distance, cruise_distance, decel_distance = self.profile()
+        time = 0.0
+        if accel_distance:
+            time += 2 * accel_distance / (self.entry_speed + cruise_speed)
+        if cruise_distance:
+            time += cruise_distance / cruise_speed
+        if decel_distance:
+            time += 2 * decel_distance / (cruise_speed + self.exit_speed)
+        return time
+
+    def to_dict(self):
+        cruise_speed = self.profile()[0]
+        return {
+            "start": self.start,
+            "target": self.target,
+            "length": self.length,
+            "entry_speed": self.entry_speed,
+            "cruise_speed": cruise_speed,
+            "exit_speed": self.exit_speed,
+            "accel": self.accel,
+            "duration": self.duration(),
+        }
+
+class Planner:
+    def __init__(self, axes, emit, junction_deviation=0.01, buffer_size=16, feed=600.0):
+        # axes maps an axis letter to {"max_velocity": ..., "max_accel": ...}
+        self.axes = axes
+        self.axis_names = list(axes)
+        self.emit = emit
+        self.junction_deviation = junction_deviation
+        self.buffer_size = max(buffer_size, 2)
+        self.feed = feed
+        self.position = [0.0] * len(self.axis_names)
+        self.blocks = []
+        self.previous = None  # Last planned segment, None when stopped
+        self.machine = None
+
+    def attach(self, machine, codes=("G1",)):
+        # Use the planner as the handler for motion codes. Grunt flushes it
+        # like a pending batch before any other command and at the end of a
+        # run, so the machine comes to a stop before side effects happen.
+        self.machine = machine
+        for code in codes:
+            machine.register(code, self)
+
+    def __call__(self, args):
+        machine = self.machine
+        if machine is not None and machine.pending_batch is not self:
+            if machine.pending_batch is not None:
+                machine.flush_batch()
+            machine.pending_batch = self
+        feed = args.get("F")
+        if feed is not None:
+            self.feed = float(feed)
+        target = list(self.position)
+        for i, name in enumerate(self.axis_names):
+            value = args.get(name)
+            if value is not None:
+                target[i] = float(value)
+        self.move(target)
+
+    def move(self, target, feed=None):
+        if feed is not None:
+            self.feed = feed
+        start = self.position
+        delta = [t - s for t, s in zip(target, start)]
+        length = math.sqrt(sum(d * d for d in delta))
+        if length == 0:
+            return
+        unit = [d / length for d in delta]
+
+        # The axis that hits its limit first sets the limit for the move
+        nominal_speed = self.feed / 60
+        accel = float('inf')
+        for name, u in zip(self.axis_names, unit):
+            if u:
+                limits = self.axes[name]
+                nominal_speed = min(nominal_speed, limits["max_velocity"] / abs(u))
+                accel = min(accel, limits["max_accel"] / abs(u))
+
+        max_entry_speed = 0.0
+        previous = self.previous
+        if previous is not None:
+            max_entry_speed = min(self.junction_speed(previous.unit, unit, accel),
+                                  nominal_speed, previous.nominal_speed)
+
+        segment = Segment(start, target, length, unit, nominal_speed, accel, max_entry_speed)
+        self.blocks.append(segment)
+        self.previous = segment
+        self.position = target
+
+        if len(self.blocks) >= self.buffer_size:
+            self.plan()
+            self.emit(self.blocks.pop(0))
+
+    def junction_speed(self, previous_unit, unit, accel):
+        # Junction deviation: the fastest speed at which the corner can be
+        # taken while staying within junction_deviation of the sharp corner
+        cos_theta = -sum(a * b for a, b in zip(previous_unit, unit))
+        if cos_theta > 0.999999:  # Full reversal
+            return 0.0
+        if cos_theta < -0.999999:  # Straight line
+            return float('inf')
+        sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+        return math.sqrt(accel * self.junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2))
+
+    def plan(self):
+        # The last buffered segment is assumed to end at a stop, so whatever
+        # is emitted can always be brought to rest if no more moves arrive.
+        # The first segment's entry speed is already fixed.
+        blocks = self.blocks
+        next_entry = 0.0
+        for block in reversed(blocks[1:]):
+            block.entry_speed = min(block.max_entry_speed,
+                                    math.sqrt(next_entry * next_entry + 2 * block.accel * block.length))
+            next_entry = block.entry_speed
+
+        for i, block in enumerate(blocks):
+            if i + 1 < len(blocks):
+                following = blocks[i + 1]
+                reachable = math.sqrt(block.entry_speed * block.entry_speed + 2 * block.accel * block.length)
+                if following.entry_speed > reachable:
+                    following.entry_speed = reachable
+                block.exit_speed = following.entry_speed
+            else:
+                block.exit_speed = 0.0
+
+    def flush(self):
+        # Plan everything buffered down to a stop and emit it
+        if self.blocks:
+            self.plan()
+            blocks = self.blocks
+            self.blocks = []
+            for block in blocks:
+                self.emit(block)
+        self.previous = None
+
+def plan_program(program, axes, **options):
+    # Run a program through a Grunt with only the planner attached and
+    # return the planned segments, for checking plans offline
+    import grunt
+    segments = []
+    machine = grunt.Grunt()
+    planner = Planner(axes, segments.append, **options)
+    planner.attach(machine)
+    machine.run(program)
+    planner.flush()
+    return segments
+
+if __name__ == "__main__":
+    import sys
+
+    limits = {"max_velocity": 100.0, "max_accel": 500.0}
+    with open(sys.argv[1]) as f:
+        segments = plan_program(f.read(), {"X": limits, "Y": limits, "Z": limits})
+    total = 0.0
+    for segment in segments:
+        info = segment.to_dict()
+        total += info["duration"]
+        print(f"{info['target']} len={info['length']:.3f} entry={info['entry_speed']:.2f} "
+              f"cruise={info['cruise_speed']:.2f} exit={info['exit_speed']:.2f} t={info['duration']:.4f}")
+    print(f"{len(segments)} segments, {total:.3f} s")
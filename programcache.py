@@ -0,0 +1,470 @@
+import binascii
+import struct
+
+import grunt
+
+# Compiled Grunt programs saved as compact binary blobs, so a program that
+# is run again and again is only parsed once. Expressions are stored as
+# RPN, operators by their symbol and variables by name; handlers, operator
+# functions and variable slots are looked up again when a blob is loaded
+# into a machine.
+#
+# A blob is a header followed by a string table and the nodes:
+#
+#   "GRC" version:u8 key:8 bytes crc32:u32 length:u32
+#   count:u16 (length:u16 utf-8)*   strings, referred to by index below
+#   nodes                           count:u32 then each node
+#
+# The key is the first 8 bytes of the SHA-256 of the program text, so the
+# host can name a program without sending it:
+#
+#   blob = dumps(machine, machine.compile(text), source_hash(text))
+#   program = loads(machine, blob)
+
+MAGIC = b"GRC"
+VERSION = 3
+HEADER = "<3sB8sII"
+HEADER_SIZE = struct.calcsize(HEADER)
+
+# CircuitPython's struct raises ValueError and has no struct.error
+STRUCT_ERROR = getattr(struct, "error", ValueError)
+
+CACHE_BUDGET = 64 * 1024
+SUFFIX = ".grc"
+
+# Tags of stored values
+TAG_NONE = 0
+TAG_FLOAT = 1
+TAG_INT = 2
+TAG_STRING = 3
+TAG_EXPRESSION = 4
+TAG_WHOLE = 5    # float with a whole value that fits in 16 bits
+TAG_FLOAT32 = 6  # float that survives the trip through 32 bits
+TAG_BOOL = 7
+
+def source_hash(text):
+    try:
+        import hashlib
+        digest = hashlib.new("sha256", text.encode("utf-8")).digest()
+    except ImportError:
+        import adafruit_hashlib
+        digest = adafruit_hashlib.sha256(text.encode("utf-8")).digest()
+    return binascii.hexlify(digest[:8]).decode()
+
+class BlobWriter:
+    def __init__(self, machine):
+        self.symbols = {function: symbol for symbol, function in machine.operators.items()}
+        self.variables = machine.variables
+        self.strings = {}
+        self.out = bytearray()
+
+    def pack(self, fmt, *values):
+        self.out.extend(struct.pack(fmt, *values))
+
+    def string(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = len(self.strings)
+            self.strings[text] = index
+        self.pack("<H", index)
+
+    def value(self, value):
+        if value is None:
+            self.pack("<B", TAG_NONE)
+        elif isinstance(value, str):
+            self.pack("<B", TAG_STRING)
+            self.string(value)
+        elif isinstance(value, bool):
+            self.pack("<BB", TAG_BOOL, value)
+        elif isinstance(value, int):
+            self.pack("<Bi", TAG_INT, value)
+        elif value == int(value) and -32768 <= value <= 32767:
+            self.pack("<Bh", TAG_WHOLE, int(value))
+        elif struct.unpack("<f", struct.pack("<f", value))[0] == value:
+            self.pack("<Bf", TAG_FLOAT32, value)
+        else:
+            self.pack("<Bd", TAG_FLOAT, value)
+
+    def expression(self, rpn):
+        self.pack("<H", len(rpn))
+        for kind, value in rpn:
+            self.pack("<B", kind)
+            if kind == grunt.EXPR_CONST:
+                self.value(value)
+            elif kind == grunt.EXPR_VAR:
+                self.string(self.variables.name(value))
+            elif kind == grunt.EXPR_OP:
+                self.string(self.symbols[value])
+            elif kind == grunt.EXPR_IO:
+                self.string(value)
+            else:
+                self.pack("<H", value)
+
+    def block(self, nodes):
+        self.pack("<I", len(nodes))
+        for node in nodes:
+            self.node(node)
+
+    def node(self, node):
+        op = node[0]
+        self.pack("<BI", op, node[1])
+        if op == grunt.OP_GCODE:
+            _, _, code, _, args, dynamic = node
+            self.string(code)
+            self.pack("<BH", 1 if dynamic else 0, len(args))
+            if dynamic:
+                for key, rpn, value in args:
+                    self.string(key)
+                    if rpn:
+                        self.pack("<B", TAG_EXPRESSION)
+                        self.expression(rpn)
+                    else:
+                        self.value(value)
+            else:
+                for key, value in args.items():
+                    self.string(key)
+                    self.value(value)
+        elif op == grunt.OP_IF:
+            self.pack("<H", len(node[2]))
+            for (condition, body), branch_line in zip(node[2], node[4]):
+                self.pack("<I", branch_line)
+                self.expression(condition)
+                self.block(body)
+            self.block(node[3])
+        elif op == grunt.OP_FOR:
+            self.string(self.variables.name(node[2]))
+            self.expression(node[3])
+            self.expression(node[4])
+            self.block(node[5])
+        elif op == grunt.OP_WHILE:
+            self.expression(node[2])
+            self.block(node[3])
+        elif op == grunt.OP_CALL:
+            self.string(node[2])
+            self.pack("<H", len(node[3]))
+            for arg in node[3]:
+                self.expression(arg)
+        elif op == grunt.OP_MACRO:
+            self.string(node[2])
+            self.block(node[3])
+        elif op == grunt.OP_SET:
+            self.string(self.variables.name(node[2]))
+            self.expression(node[3])
+        elif op == grunt.OP_WRITEPIN:
+            self.expression(node[2])
+            self.expression(node[3])
+        elif op == grunt.OP_WRITEMSG:
+            self.pack("<H", len(node[2]))
+            for part in node[2]:
+                if isinstance(part, str):
+                    self.value(part)
+                else:
+                    self.pack("<B", TAG_EXPRESSION)
+                    self.expression(part)
+        elif op == grunt.OP_WAIT:
+            self.expression(node[2])
+            self.expression(node[3])
+            self.expression(node[4])
+            self.value(None if node[5] is None else self.variables.name(node[5]))
+        else:
+            raise ValueError(f"Can't store node type {op} (line {node[1]})")
+
+    def finish(self, key):
+        table = bytearray(struct.pack("<H", len(self.strings)))
+        for text in self.strings:  # Insertion order is index order
+            data = text.encode("utf-8")
+            table.extend(struct.pack("<H", len(data)))
+            table.extend(data)
+        payload = bytes(table) + bytes(self.out)
+        header = struct.pack(HEADER, MAGIC, VERSION, binascii.unhexlify(key),
+                             binascii.crc32(payload), len(payload))
+        return header + payload
+
+class BlobReader:
+    def __init__(self, machine, data, offset):
+        self.machine = machine
+        self.operators = machine.operators
+        self.variables = machine.variables
+        self.data = data
+        self.offset = offset
+        count = self.unpack("<H")[0]
+        self.strings = []
+        for _ in range(count):
+            length = self.unpack("<H")[0]
+            self.strings.append(bytes(data[self.offset:self.offset + length]).decode("utf-8"))
+            self.offset += length
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def string(self):
+        return self.strings[self.unpack("<H")[0]]
+
+    def value(self, tag=None):
+        if tag is None:
+            tag = self.unpack("<B")[0]
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_STRING:
+            return self.string()
+        if tag == TAG_INT:
+            return self.unpack("<i")[0]
+        if tag == TAG_WHOLE:
+            return float(self.unpack("<h")[0])
+        if tag == TAG_FLOAT32:
+            return self.unpack("<f")[0]
+        if tag == TAG_FLOAT:
+            return self.unpack("<d")[0]
+        if tag == TAG_BOOL:
+            return bool(self.unpack("<B")[0])
+        raise ValueError(f"Bad value tag {tag} in compiled program")
+
+    def expression(self):
+        rpn = []
+        for _ in range(self.unpack("<H")[0]):
+            kind = self.unpack("<B")[0]
+            if kind == grunt.EXPR_CONST:
+                rpn.append((kind, self.value()))
+            elif kind == grunt.EXPR_VAR:
+                rpn.append((kind, self.variables.slot(self.string())))
+            elif kind == grunt.EXPR_OP:
+                rpn.append((kind, self.operators[self.string()]))
+            elif kind == grunt.EXPR_IO:
+                rpn.append((kind, self.string()))
+            else:
+                rpn.append((kind, self.unpack("<H")[0]))
+        return rpn
+
+    def block(self):
+        return [self.node() for _ in range(self.unpack("<I")[0])]
+
+    def node(self):
+        op, line_no = self.unpack("<BI")
+        if op == grunt.OP_GCODE:
+            code = self.string()
+            dynamic, count = self.unpack("<BH")
+            if dynamic:
+                args = []
+                for _ in range(count):
+                    key = self.string()
+                    tag = self.unpack("<B")[0]
+                    if tag == TAG_EXPRESSION:
+                        args.append((key, self.expression(), None))
+                    else:
+                        args.append((key, None, self.value(tag)))
+            else:
+                args = {}
+                for _ in range(count):
+                    key = self.string()
+                    args[key] = self.value()
+            return (op, line_no, code, self.machine.handler_cell(code), args, bool(dynamic))
+        if op == grunt.OP_IF:
+            branches = []
+            branch_lines = []
+            for _ in range(self.unpack("<H")[0]):
+                branch_lines.append(self.unpack("<I")[0])
+                condition = self.expression()
+                branches.append((condition, self.block()))
+            return (op, line_no, branches, self.block(), branch_lines)
+        if op == grunt.OP_FOR:
+            slot = self.variables.slot(self.string())
+            start = self.expression()
+            end = self.expression()
+            return (op, line_no, slot, start, end, self.block())
+        if op == grunt.OP_WHILE:
+            condition = self.expression()
+            return (op, line_no, condition, self.block())
+        if op == grunt.OP_CALL:
+            name = self.string()
+            return (op, line_no, name, [self.expression() for _ in range(self.unpack("<H")[0])])
+        if op == grunt.OP_MACRO:
+            name = self.string()
+            return (op, line_no, name, self.block())
+        if op == grunt.OP_SET:
+            slot = self.variables.slot(self.string())
+            return (op, line_no, slot, self.expression())
+        if op == grunt.OP_WRITEPIN:
+            pin_number = self.expression()
+            return (op, line_no, pin_number, self.expression())
+        if op == grunt.OP_WRITEMSG:
+            parts = []
+            for _ in range(self.unpack("<H")[0]):
+                tag = self.unpack("<B")[0]
+                parts.append(self.expression() if tag == TAG_EXPRESSION else self.value(tag))
+            return (op, line_no, parts)
+        if op == grunt.OP_WAIT:
+            pin_number = self.expression()
+            value = self.expression()
+            timeout = self.expression()
+            name = self.value()
+            return (op, line_no, pin_number, value, timeout, None if name is None else self.variables.slot(name))
+        raise ValueError(f"Bad node type {op} in compiled program")
+
+def dumps(machine, program, key):
+    writer = BlobWriter(machine)
+    writer.block(program.nodes)
+    return writer.finish(key)
+
+def blob_key(data):
+    # The key stored in a blob's header, after checking the header
+    if len(data) < HEADER_SIZE:
+        raise ValueError("Compiled program is truncated")
+    magic, version, key, crc, length = struct.unpack_from(HEADER, data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a compiled program")
+    if version != VERSION:
+        raise ValueError(f"Compiled program has version {version}, expected {VERSION}")
+    if len(data) - HEADER_SIZE != length or binascii.crc32(memoryview(data)[HEADER_SIZE:]) != crc:
+        raise ValueError("Compiled program is corrupt")
+    return binascii.hexlify(key).decode()
+
+def loads(machine, data):
+    blob_key(data)
+    try:
+        reader = BlobReader(machine, data, HEADER_SIZE)
+        return grunt.Program(reader.block())
+    except (STRUCT_ERROR, IndexError, KeyError, UnicodeError) as e:
+        # A body that passes the CRC but doesn't make sense, e.g. one written
+        # by a buggy host: it is corrupt all the same
+        raise ValueError(f"Compiled program is corrupt: {e!r}")
+
+class ProgramCache:
+    # Blobs by key, evicting the least recently used ones to stay within
+    # budget bytes. With a directory they are kept on flash (which boot.py
+    # must remount writable); without one, in memory. The use order is only
+    # kept in memory, so after a restart eviction starts in listing order.
+    # Dicts on the board don't keep insertion order, so every entry records
+    # when it was last used.
+    def __init__(self, directory=None, budget=CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.entries = {}  # key -> [size, last use]
+        self.uses = 0
+        self.blobs = {}  # key -> blob, without a directory
+        # One upload at a time: its key and the blob received so far
+        self.upload_key = None
+        self.upload_data = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            self.scan()
+
+    def path(self, key):
+        return f"{self.directory}/{key}{SUFFIX}"
+
+    def scan(self):
+        import os
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            os.mkdir(self.directory)
+            names = []
+        for name in names:
+            if name.endswith(SUFFIX):
+                key = name[:-len(SUFFIX)]
+                self.uses += 1
+                self.entries[key] = [os.stat(self.path(key))[6], self.uses]
+
+    def size(self):
+        return sum(entry[0] for entry in self.entries.values())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def least_recently_used(self):
+        oldest = None
+        oldest_use = None
+        for key, entry in self.entries.items():
+            if oldest_use is None or entry[1] < oldest_use:
+                oldest, oldest_use = key, entry[1]
+        return oldest
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.uses += 1
+        entry[1] = self.uses
+        self.hits += 1
+        if self.directory is None:
+            return self.blobs[key]
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key, data):
+        if len(data) > self.budget:
+            raise ValueError(f"Compiled program is {len(data)} bytes, the cache holds {self.budget}")
+        self.remove(key)
+        while self.entries and self.size() + len(data) > self.budget:
+            self.remove(self.least_recently_used())
+            self.evictions += 1
+        if self.directory is None:
+            self.blobs[key] = bytes(data)
+        else:
+            with open(self.path(key), "wb") as f:
+                f.write(data)
+        self.uses += 1
+        self.entries[key] = [len(data), self.uses]
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is None:
+            return
+        if self.directory is None:
+            del self.blobs[key]
+        else:
+            import os
+            os.remove(self.path(key))
+
+    def load(self, machine, key):
+        # The cached program for key, or None. A blob that no longer loads
+        # (corrupt, or from another version) is dropped.
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            return loads(machine, data)
+        except ValueError:
+            self.remove(key)
+            raise
+
+    def upload(self, key, chunk):
+        # Blobs arrive from the host in base64 chunks. A chunk for another
+        # key drops the upload in progress, and one that grows past the
+        # budget is dropped before it can fill the heap.
+        if key != self.upload_key:
+            self.cancel_upload()
+            self.upload_key = key
+            self.upload_data = bytearray()
+        data = binascii.a2b_base64(chunk)
+        if len(self.upload_data) + len(data) > self.budget:
+            self.cancel_upload()
+            raise ValueError(f"Upload of {key} is larger than the cache ({self.budget} bytes)")
+        self.upload_data.extend(data)
+
+    def cancel_upload(self):
+        self.upload_key = None
+        self.upload_data = None
+
+    def finish_upload(self, key):
+        if key != self.upload_key:
+            raise ValueError(f"No upload in progress for {key}")
+        data = self.upload_data
+        self.cancel_upload()
+        if blob_key(data) != key:
+            raise ValueError(f"Uploaded program is not {key}")
+        self.put(key, data)
+        return len(data)
+
+    def stats(self):
+        return {
+            "programs": len(self.entries),
+            "bytes": self.size(),
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,269 @@
+import struct
+
+# Line protocol spoken by the server in code.py. Every message is one line
+# ending in "\n", so commands that arrive split over several TCP segments, or
+# several to a segment, come out the same.
+#
+#   host -> device   "@<seq> <line>"        sequenced line, can be pipelined
+#                    "<line>"               plain line, e.g. typed into nc
+#                    "[GCODE] <text>"       message for RECV
+#                    "QUEUES"               queue occupancy, answered at once
+#                    "CONTROL" / "RELEASE"  take or give up control (sessions.py)
+#                    "SESSIONS"             list connected clients
+#                    "STATS [ON|OFF|RESET]" profiling data as one line of JSON
+#
+#   device -> host   "ACK <seq> <free>"     line accepted, <free> lines of
+#                                           the receive window are left
+#                    "NAK <seq> <free>"     window full, send <seq> again
+#                    "OK <seq>"             statement finished
+#                    "ERR <seq> <message>"  statement failed
+#                    "OK" / "ERROR <message>" for plain lines
+#                    "[GCODE] <text>"       WRITE message
+#                    "BUSY messages"        [GCODE] message was rejected
+#                    "ERR <seq> read-only"  sent by a client that isn't in control
+#                    "QUEUES messages=<length>/<capacity> high=<n> dropped=<n>
+#                     rejected=<n> commands=..."
+#
+# Motion commands can also be sent as binary frames instead of lines, so the
+# board doesn't have to split and parse text (host/encoder.py makes them).
+# A frame starts with FRAME_MAGIC, which never starts a line of UTF-8 text,
+# so frames and lines can be mixed on one connection:
+#
+#   <B magic> <B opcode> <I seq> <H word mask> <i value> ...   little-endian
+#
+# The opcode indexes FRAME_CODES and bit n of the mask says that word
+# FRAME_WORDS[n] follows, as a fixed point int32 of value * FRAME_SCALE.
+# seq 0 is a plain frame. Frames are acknowledged and answered like the
+# line they stand for, and can't be part of an IF/FOR/WHILE/MACRO block.
+#
+# A statement is a single line or a whole IF/FOR/WHILE/MACRO block. Lines of
+# a block are held until the block is closed and then run together; each of
+# them takes a place in the window until then. Lines inside an open block are
+# accepted even when the window is full, otherwise a block longer than the
+# window could never be completed. A block may hold at most MAX_BLOCK bytes:
+# past that its lines get "ERR <seq> block too long" and the rest of the
+# block, up to its END, is dropped with the same error.
+
+GCODE_IDENTIFIER = "[GCODE]"
+
+WINDOW_SIZE = 16
+MAX_LINE = 1024
+MAX_BLOCK = 8 * 1024  # Bytes of an open block held on the board
+
+FRAME_MAGIC = 0xA5
+FRAME_HEADER = "<BBIH"
+FRAME_HEADER_SIZE = 8
+FRAME_SEQ_OFFSET = 2
+FRAME_MASK_OFFSET = 6
+FRAME_VALUE = "<i"
+FRAME_SCALE = 1000  # Values are sent in thousandths
+# Never reorder these, only add to the end
+FRAME_CODES = ("G0", "G1", "G2", "G3", "G14", "G15", "M2", "M10", "M11")
+FRAME_WORDS = ("X", "Y", "Z", "A", "B", "C", "E", "F", "I", "J", "K", "P", "R", "S")
+
+def frame_size(mask):
+    count = 0
+    while mask:
+        count += mask & 1
+        mask >>= 1
+    return FRAME_HEADER_SIZE + 4 * count
+
+def decode_frame(data, pos=0):
+    # (seq, code, args) of the frame at data[pos:]. seq is None for a plain
+    # frame and code is the opcode number if it isn't known.
+    _, opcode, seq, mask = struct.unpack_from(FRAME_HEADER, data, pos)
+    args = {}
+    offset = pos + FRAME_HEADER_SIZE
+    for word in FRAME_WORDS:
+        if mask & 1:
+            args[word] = struct.unpack_from(FRAME_VALUE, data, offset)[0] / FRAME_SCALE
+            offset += 4
+        mask >>= 1
+    code = FRAME_CODES[opcode] if opcode < len(FRAME_CODES) else opcode
+    return seq or None, code, args
+
+class LineFramer:
+    # Reassembles lines and binary frames from received chunks. Lines come
+    # out as str and frames as (seq, code, args) tuples, in order.
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self.buffer = bytearray()
+
+    def feed(self, data, length=None):
+        # data is bytes, or a receive buffer of which the first length bytes
+        # were filled. Only what is left incomplete is copied out of it.
+        if length is None:
+            length = len(data)
+        if self.buffer:
+            self.buffer.extend(memoryview(data)[:length])
+            data = self.buffer
+            length = len(data)
+        items = []
+        pos = 0
+        while pos < length:
+            if data[pos] == FRAME_MAGIC:
+                if length - pos < FRAME_HEADER_SIZE:
+                    break
+                size = frame_size(data[pos + FRAME_MASK_OFFSET] | data[pos + FRAME_MASK_OFFSET + 1] << 8)
+                if length - pos < size:
+                    break
+                items.append(decode_frame(data, pos))
+                pos += size
+                continue
+            end = data.find(b"\n", pos, length)
+            if end < 0:
+                break
+            items.append(bytes(data[pos:end]).decode("utf-8").rstrip("\r"))
+            pos = end + 1
+
+        if length - pos > self.max_line:
+            self.buffer = bytearray()
+            raise ValueError(f"Line longer than {self.max_line} bytes")
+        if pos < length:
+            self.buffer = bytearray(memoryview(data)[pos:length])
+        elif self.buffer:
+            self.buffer = bytearray()
+        return items
+
+def parse_frame(line):
+    # Split "@<seq> <line>" into (seq, line); plain lines have seq None
+    if line.startswith("@"):
+        seq, _, text = line[1:].partition(" ")
+        if seq.isdigit():
+            return int(seq), text
+    return None, line
+
+def block_change(line):
+    # How a line changes the block nesting depth
+    line = line.split(';')[0].strip()
+    if not line:
+        return 0
+    word = line.split()[0]
+    if word.startswith("END"):
+        return -1
+    if word.startswith("ELSE"):
+        return 0
+    if word == "MACRO" or word.startswith("IF") or word.startswith("FOR") or word.startswith("WHILE"):
+        return 1
+    return 0
+
+class BlockAssembler:
+    # Collects lines until they form a complete statement
+    def __init__(self, max_block=MAX_BLOCK):
+        self.max_block = max_block
+        self.lines = []
+        self.seqs = []
+        self.depth = 0
+        self.size = 0
+        self.dropping = 0  # Depth left of a block that was too long
+
+    def feed(self, line, seq):
+        # Returns (program, seqs) once a statement is complete, else None.
+        # When a block grows past max_block it is thrown away and (None,
+        # seqs) is returned for its lines, and then for each line of the
+        # rest of it.
+        change = block_change(line)
+        if self.dropping:
+            self.dropping = max(self.dropping + change, 0)
+            return None, [seq]
+        self.lines.append(line)
+        self.seqs.append(seq)
+        self.size += len(line) + 1
+        self.depth = max(self.depth + change, 0)
+        if self.depth:
+            if self.size <= self.max_block:
+                return None
+            self.dropping = self.depth
+            seqs = self.seqs
+            self.reset()
+            return None, seqs
+        program = "\n".join(self.lines)
+        seqs = self.seqs
+        self.reset()
+        return program, seqs
+
+    def reset(self):
+        self.lines = []
+        self.seqs = []
+        self.depth = 0
+        self.size = 0
+
+class Receiver:
+    # Receiving end of one connection: framing, the receive window and
+    # assembling statements. After a NAK, sequenced lines are refused until
+    # the NAKed one is sent again, so they still run in order (go-back-N).
+    def __init__(self, window=WINDOW_SIZE):
+        self.window = window
+        self.framer = LineFramer()
+        self.assembler = BlockAssembler()
+        self.held_lines = 0
+        self.resend_from = None
+
+    def handle_line(self, line):
+        # Returns (reply, message, statement), each of which may be None:
+        # an ACK/NAK to send back, a [GCODE] message for RECV, and a
+        # complete (program, seqs) statement for the interpreter
+        if line.startswith(GCODE_IDENTIFIER):
+            return None, line[len(GCODE_IDENTIFIER):].strip(), None
+
+        reply = None
+        seq, text = parse_frame(line)
+        if seq is not None:
+            reply, accepted = self.admit(seq)
+            if not accepted:
+                return reply, None, None
+        self.held_lines += 1
+
+        statement = self.assembler.feed(text, seq)
+        if statement is not None and statement[0] is None:
+            # Part of a block that was too long: it leaves the window at once
+            self.finished(statement[1])
+            return (reply or "") + "".join(reply_lines(statement[1], "block too long")), None, None
+        return reply, None, statement
+
+    def admit(self, seq):
+        # The ACK or NAK for a sequenced line, and whether it was accepted
+        free = self.window - self.held_lines
+        if (free <= 0 and not self.assembler.depth) or (self.resend_from is not None and seq != self.resend_from):
+            if self.resend_from is None:
+                self.resend_from = seq
+            return f"NAK {seq} {max(free, 0)}\n", False
+        self.resend_from = None
+        return f"ACK {seq} {max(free - 1, 0)}\n", True
+
+    def handle_frame(self, frame):
+        # Like handle_line for a decoded frame. Returns (replies, statement)
+        # where the statement is ((code, args), seqs) for the interpreter.
+        seq, code, args = frame
+        reply = ""
+        if seq is not None:
+            reply, accepted = self.admit(seq)
+            if not accepted:
+                return reply, None
+        error = None
+        if self.assembler.depth:
+            error = "binary frame inside a block"
+        elif not isinstance(code, str):
+            error = f"Unknown frame opcode {code}"
+        if error is not None:
+            return reply + "".join(reply_lines([seq], error)), None
+        self.held_lines += 1
+        return reply or None, ((code, args), [seq])
+
+    def finished(self, seqs):
+        # The statement with these seqs is done and its lines leave the window
+        self.held_lines = max(self.held_lines - len(seqs), 0)
+
+def reply_lines(seqs, error=None):
+    # Replies for a finished statement
+    replies = []
+    for seq in seqs:
+        if seq is None:
+            continue
+        if error is None:
+            replies.append(f"OK {seq}\n")
+        else:
+            replies.append(f"ERR {seq} {error}\n")
+    if None in seqs:
+        replies.append("OK\n" if error is None else f"ERROR {error}\n")
+    return replies
@@ -0,0 +1,82 @@
+# Fixed capacity FIFO queue with O(1) append and popleft. All storage is
+# allocated up front, so a chatty host can't grow it past its capacity.
+#
+# What happens when it is full is set by the overflow policy:
+#   DROP_OLDEST  the oldest item is thrown away to make room
+#   REJECT       append() returns False so the caller can push back
+#   BLOCK        put() waits (in asyncio) until there is room
+
+DROP_OLDEST = "drop-oldest"
+REJECT = "reject"
+BLOCK = "block"
+
+class RingBuffer:
+    def __init__(self, capacity, overflow=DROP_OLDEST):
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        if overflow not in (DROP_OLDEST, REJECT, BLOCK):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.items = [None] * capacity
+        self.capacity = capacity
+        self.overflow = overflow
+        self.head = 0
+        self.count = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def append(self, item):
+        # Returns False if the item was rejected
+        if self.count == self.capacity:
+            if self.overflow == DROP_OLDEST:
+                self.items[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+                self.count -= 1
+                self.dropped += 1
+            else:
+                self.rejected += 1
+                return False
+        self.items[(self.head + self.count) % self.capacity] = item
+        self.count += 1
+        if self.count > self.high_water:
+            self.high_water = self.count
+        return True
+
+    async def put(self, item):
+        # Like append(), but with the BLOCK policy waits for room instead
+        if self.overflow == BLOCK:
+            import asyncio
+            while self.count == self.capacity:
+                await asyncio.sleep(0.005)
+        return self.append(item)
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError("pop from an empty queue")
+        item = self.items[self.head]
+        self.items[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        return item
+
+    def full(self):
+        return self.count == self.capacity
+
+    def clear(self):
+        while self.count:
+            self.popleft()
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def stats(self):
+        return {
+            "length": self.count,
+            "capacity": self.capacity,
+            "high_water": self.high_water,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,138 @@
+import protocol
+import ringbuffer
+
+# Several clients connected to the server at once. One session has control
+# and may run commands; the others are read-only monitors that get WRITE
+# messages and pin changes. All sockets are non-blocking and polled, so a
+# slow or idle client never holds up another one.
+#
+# Session commands, answered at once:
+#   "CONTROL"   take control if nobody has it -> "CONTROL granted" / "CONTROL denied"
+#   "RELEASE"   give control up               -> "CONTROL released"
+#   "SESSIONS"  list connected clients        -> "SESSIONS <n> owner=<addr>"
+
+MAX_SESSIONS = 4
+OUTBOX_SIZE = 64
+RECEIVE_SIZE = 1024
+
+# errno values that only mean "try again later": EAGAIN and ETIMEDOUT
+RETRY_ERRNOS = (11, 110)
+
+def would_block(error):
+    code = error.args[0] if error.args else None
+    # socket.timeout and friends carry a message instead of an errno
+    return code is None or isinstance(code, str) or code in RETRY_ERRNOS
+
+class Session:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.receiver = protocol.Receiver()
+        # Outgoing data. Broadcasts put the same bytes object in every
+        # session's outbox; a client that stops reading loses the oldest.
+        self.outbox = ringbuffer.RingBuffer(OUTBOX_SIZE, ringbuffer.DROP_OLDEST)
+        self.sending = None
+        self.closed = False
+        # Received data goes into the same buffer every time
+        self.buffer = bytearray(RECEIVE_SIZE)
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.outbox.append(data)
+
+    def read(self):
+        # Returns the number of bytes received into self.buffer, 0 once the
+        # client has gone, or None if there is nothing to read yet
+        try:
+            return self.conn.recv_into(self.buffer)
+        except OSError as e:
+            if would_block(e):
+                return None
+            return 0
+
+    def flush(self):
+        while not self.closed:
+            if self.sending is None:
+                if not self.outbox:
+                    return
+                self.sending = memoryview(self.outbox.popleft())
+            try:
+                sent = self.conn.send(self.sending)
+            except OSError as e:
+                if not would_block(e):
+                    self.closed = True
+                return
+            if sent is None or sent >= len(self.sending):
+                self.sending = None
+            else:
+                self.sending = self.sending[sent:]
+
+class SessionServer:
+    def __init__(self, sock, max_sessions=MAX_SESSIONS):
+        self.sock = sock
+        self.max_sessions = max_sessions
+        self.sessions = []
+        self.owner = None
+
+    def accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except OSError:
+            return None
+        if len(self.sessions) >= self.max_sessions:
+            conn.send(b"ERROR too many sessions\n")
+            conn.close()
+            return None
+        conn.settimeout(0)
+        session = Session(conn, addr)
+        self.sessions.append(session)
+        # The first client to connect gets control
+        if self.owner is None:
+            self.owner = session
+        print(f"Connected by {addr}")
+        return session
+
+    def close(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if self.owner is session:
+            self.owner = None
+        session.closed = True
+        try:
+            session.conn.close()
+        except OSError:
+            pass
+        print(f"Connection with {session.addr} closed.")
+
+    def broadcast(self, text):
+        # Encoded once and shared by every session
+        data = text.encode("utf-8")
+        for session in self.sessions:
+            session.send(data)
+
+    def flush(self):
+        for session in list(self.sessions):
+            session.flush()
+            if session.closed:
+                self.close(session)
+
+    def handle_session_command(self, session, line):
+        # Returns True if the line was a session command
+        if line == "CONTROL":
+            if self.owner is None or self.owner is session:
+                self.owner = session
+                session.send("CONTROL granted\n")
+            else:
+                session.send("CONTROL denied\n")
+            return True
+        if line == "RELEASE":
+            if self.owner is session:
+                self.owner = None
+            session.send("CONTROL released\n")
+            return True
+        if line == "SESSIONS":
+            owner = self.owner.addr if self.owner is not None else None
+            session.send(f"SESSIONS {len(self.sessions)} owner={owner}\n")
+            return True
+        return False
@@ -0,0 +1,273 @@
+import math
+
+import grunt
+import planner
+
+# Dry run of a program on a virtual machine. Handlers for the commands
+# code.py knows only keep count of what the program would do. It reports
+# distance travelled, the bounding box, per-command counts and an estimate
+# of the cycle time, worked out with the motion planner from feed rates and
+# acceleration.
+#
+#   python simulator.py program.gcode
+#   python simulator.py program.gcode --limits X0:200,Y0:150 --read 0=1 --recv ok
+#
+# Moves are absolute like in planner.py, and arcs are cut into G1 moves
+# (arcs.py). G0 moves at rapid_feed. READ returns the value given for the
+# pin (0 by default), or read_values(pin) if it is a function. RECV returns
+# the given messages in turn and then None after its timeout, and WAIT PIN
+# succeeds at once.
+
+DEFAULT_LIMITS = {"max_velocity": 100.0, "max_accel": 500.0}
+RAPID_FEED = 3000.0  # mm/min
+
+# Stepper and servo as set up in code.py
+STEPPER_MAX_RATE = 2000  # steps/s
+STEPPER_ACCEL = 8000  # steps/s^2
+SERVO_SPEED = 600.0  # degrees/s, a typical hobby servo
+
+def trapezoid_time(distance, speed, accel):
+    # Time for a move that starts and ends at rest
+    ramp = speed * speed / accel  # Distance to speed up and slow down again
+    if distance >= ramp:
+        return 2 * speed / accel + (distance - ramp) / speed
+    return 2 * math.sqrt(distance / accel)
+
+class Simulator:
+    def __init__(self, axes=None, lookahead=True, rapid_feed=RAPID_FEED, bounds=None,
+                 read_values=None, messages=None, machine=None):
+        # axes: {"X": {"max_velocity": ..., "max_accel": ...}, ...}
+        # bounds: {"X": (min, max), ...} checked for every move
+        self.axes = axes or {name: DEFAULT_LIMITS for name in ("X", "Y", "Z")}
+        self.axis_names = list(self.axes)
+        self.rapid_feed = rapid_feed
+        self.bounds = bounds or {}
+        self.read_values = read_values or {}
+        self.messages = list(messages or [])
+        # Without lookahead every move starts and ends at rest: the planner
+        # is flushed after each one
+        self.lookahead = lookahead
+        self.planner = planner.Planner(self.axes, self.add_segment)
+        self.machine = machine or grunt.Grunt(arcs=True)
+        self.reset()
+        self.register(self.machine)
+
+    def reset(self):
+        self.motion_time = 0.0
+        self.other_time = 0.0
+        self.cutting_distance = 0.0
+        self.rapid_distance = 0.0
+        self.low = [math.inf] * len(self.axis_names)
+        self.high = [-math.inf] * len(self.axis_names)
+        self.out_of_bounds = []  # The first few targets outside bounds
+        self.out_of_bounds_count = 0
+        self.counts = {}
+        self.sent = []  # WRITE messages
+        self.stepper_steps = 0
+        self.servo_angle = 0.0
+        self.relay = False
+        self.ended = False
+
+    def register(self, machine):
+        for code in ("G0", "G1"):
+            machine.register(code, self.motion_handler(code))
+        machine.register("G14", self.stepper)
+        machine.register("G15", self.servo)
+        for code in ("M2", "M10", "M11"):
+            machine.register(code, self.m_handler(code))
+        machine.register("READ", self.read)
+        machine.register("RECV", self.receive)
+        machine.register("WRITEMSG", self.write_message)
+        machine.register("WRITEPIN", self.write_pin)
+        machine.register("WAITPIN", self.wait_pin)
+
+    def count(self, code):
+        self.counts[code] = self.counts.get(code, 0) + 1
+
+    def add_segment(self, segment):
+        self.motion_time += segment.duration()
+
+    def motion_handler(self, code):
+        rapid = code == "G0"
+        names = self.axis_names
+
+        def handler(args):
+            self.count(code)
+            feed = args.get("F")
+            if feed is not None and not rapid:
+                self.planner.feed = float(feed)
+            position = self.planner.position
+            target = list(position)
+            for i, name in enumerate(names):
+                value = args.get(name)
+                if value is not None:
+                    target[i] = float(value)
+            distance = math.sqrt(sum((t - p) * (t - p) for t, p in zip(target, position)))
+            if rapid:
+                self.rapid_distance += distance
+                cutting_feed = self.planner.feed
+                self.planner.move(target, self.rapid_feed)
+                self.planner.feed = cutting_feed
+            else:
+                self.cutting_distance += distance
+                self.planner.move(target)
+            if not self.lookahead:
+                self.planner.flush()
+            self.check(target)
+        return handler
+
+    def check(self, target):
+        low = self.low
+        high = self.high
+        for i, value in enumerate(target):
+            if value < low[i]:
+                low[i] = value
+            if value > high[i]:
+                high[i] = value
+        for i, name in enumerate(self.axis_names):
+            limits = self.bounds.get(name)
+            if limits is not None and not limits[0] <= target[i] <= limits[1]:
+                self.out_of_bounds_count += 1
+                if len(self.out_of_bounds) < 10:
+                    self.out_of_bounds.append(dict(zip(self.axis_names, target)))
+                return
+
+    def stop(self):
+        # Motion comes to rest before anything else happens, like on the
+        # board where other commands flush the planner
+        self.planner.flush()
+
+    def stepper(self, args):
+        self.count("G14")
+        self.stop()
+        steps = int(args.get("S", 0))
+        self.stepper_steps += steps
+        if steps:
+            self.other_time += trapezoid_time(steps, STEPPER_MAX_RATE, STEPPER_ACCEL)
+
+    def servo(self, args):
+        self.count("G15")
+        self.stop()
+        angle = float(args.get("A", 0))
+        self.other_time += abs(angle - self.servo_angle) / SERVO_SPEED
+        self.servo_angle = angle
+
+    def m_handler(self, code):
+        def handler(args):
+            self.count(code)
+            self.stop()
+            if code == "M10":
+                self.relay = True
+            elif code == "M11":
+                self.relay = False
+            elif code == "M2":
+                self.ended = True
+        return handler
+
+    def read(self, pin_number):
+        self.count("READ")
+        self.stop()
+        if callable(self.read_values):
+            return self.read_values(pin_number)
+        return self.read_values.get(pin_number, 0)
+
+    def receive(self, timeout):
+        self.count("RECV")
+        self.stop()
+        if self.messages:
+            return self.messages.pop(0)
+        # Nothing comes, so the board would wait for the whole timeout
+        self.other_time += timeout
+        return None
+
+    def write_message(self, message):
+        self.count("WRITEMSG")
+        self.sent.append(message)
+
+    def write_pin(self, pin_number, value):
+        self.count("WRITEPIN")
+
+    def wait_pin(self, pin_number, value, timeout):
+        self.count("WAITPIN")
+        self.stop()
+        return True
+
+    def run(self, program):
+        # Run program text (or a Program); returns the report
+        if isinstance(program, grunt.Program):
+            self.machine.run_compiled(program)
+        else:
+            self.machine.run(program)
+        return self.report()
+
+    def run_stream(self, source):
+        # Run a file or other line source without reading it all first
+        self.machine.run_stream(source)
+        return self.report()
+
+    def report(self):
+        self.stop()
+        moved = self.low[0] != math.inf
+        return {
+            "cycle_time": self.motion_time + self.other_time,
+            "motion_time": self.motion_time,
+            "other_time": self.other_time,
+            "cutting_distance": self.cutting_distance,
+            "rapid_distance": self.rapid_distance,
+            "bounding_box": {name: (self.low[i], self.high[i]) for i, name in enumerate(self.axis_names)} if moved else {},
+            "out_of_bounds": self.out_of_bounds_count,
+            "out_of_bounds_targets": self.out_of_bounds,
+            "counts": dict(self.counts),
+            "stepper_steps": self.stepper_steps,
+            "messages": list(self.sent),
+            "ended": self.ended,
+        }
+
+def parse_limits(text):
+    # "X0:200,Y0:150" -> {"X": (0.0, 200.0), "Y": (0.0, 150.0)}
+    bounds = {}
+    for part in text.split(","):
+        low, high = part[1:].split(":")
+        bounds[part[0]] = (float(low), float(high))
+    return bounds
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import time
+
+    parser = argparse.ArgumentParser(description="Dry run Grunt programs and estimate their cycle time")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--limits", help="allowed travel, e.g. X0:200,Y0:150,Z-50:0")
+    parser.add_argument("--read", action="append", default=[], help="pin=value returned by READ")
+    parser.add_argument("--recv", action="append", default=[], help="message returned by RECV, in order")
+    parser.add_argument("--no-lookahead", action="store_true", help="stop at the end of every move")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+    options = parser.parse_args()
+
+    reads = {}
+    for item in options.read:
+        pin, _, value = item.partition("=")
+        reads[int(pin)] = float(value)
+
+    for path in options.files:
+        simulator = Simulator(lookahead=not options.no_lookahead,
+                              bounds=parse_limits(options.limits) if options.limits else None,
+                              read_values=reads, messages=options.recv)
+        start = time.perf_counter()
+        with open(path) as f:
+            report = simulator.run_stream(f)
+        elapsed = time.perf_counter() - start
+        if options.json:
+            print(json.dumps({"file": path, "simulated_in": elapsed, **report}))
+            continue
+        minutes, seconds = divmod(report["cycle_time"], 60)
+        print(f"{path}: {int(minutes)}m {seconds:.1f}s "
+              f"(motion {report['motion_time']:.1f}s, other {report['other_time']:.1f}s)")
+        print(f"  distance: {report['cutting_distance']:.1f} mm cutting, {report['rapid_distance']:.1f} mm rapid")
+        for name, (low, high) in report["bounding_box"].items():
+            print(f"  {name}: {low:.3f} .. {high:.3f}")
+        if report["out_of_bounds"]:
+            print(f"  OUT OF BOUNDS: {report['out_of_bounds']} moves, first at {report['out_of_bounds_targets'][0]}")
+        print("  counts: " + ", ".join(f"{code}={n}" for code, n in sorted(report["counts"].items())))
+        print(f"  simulated in {elapsed:.2f}s")
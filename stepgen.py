@@ -0,0 +1,301 @@
+import math
+import time
+
+# Step pulse generation for stepper drivers like the A4988. The timing of
+# every step is worked out from an acceleration profile ahead of time and
+# pulses go out on absolute deadlines, so jitter in one step doesn't shift
+# the rest of the move. Times are integer nanoseconds: CircuitPython floats
+# lose sub-millisecond precision once the board has been up a while.
+
+NS = 1000000000
+
+def step_intervals(steps, cruise_rate, accel, start_rate=0.0, end_rate=0.0):
+    # Yield the time in ns before each of the steps of a trapezoidal move.
+    # Rates are in steps/s and accel in steps/s^2. The speed for step k is
+    # the lowest of accelerating from start_rate, cruising, and being able
+    # to slow down to end_rate in the steps that are left.
+    start2 = start_rate * start_rate
+    end2 = end_rate * end_rate
+    accel2 = 2.0 * accel
+    for k in range(1, steps + 1):
+        rate = min(cruise_rate,
+                   math.sqrt(start2 + accel2 * k),
+                   math.sqrt(end2 + accel2 * (steps - k + 1)))
+        yield int(NS / rate)
+
+class MonotonicClock:
+    # Real time, waiting by spinning on time.monotonic_ns()
+    def now(self):
+        return time.monotonic_ns()
+
+    def wait_until(self, deadline):
+        while time.monotonic_ns() < deadline:
+            pass
+
+    async def sleep(self, ns):
+        import asyncio
+        await asyncio.sleep(ns / NS)
+
+class SimulatedClock:
+    # Time only moves when something waits, so a move "runs" instantly
+    def __init__(self, start=0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def wait_until(self, deadline):
+        if deadline > self.time:
+            self.time = deadline
+
+    async def sleep(self, ns):
+        import asyncio
+        self.time += ns
+        await asyncio.sleep(0)
+
+class SimulatedPin:
+    # Stands in for a digitalio.DigitalInOut and records (time, value)
+    # every time the value is set
+    def __init__(self, clock):
+        self.clock = clock
+        self.changes = []
+        self._value = False
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self.changes.append((self.clock.now(), value))
+
+    def rising_edges(self):
+        return [t for t, value in self.changes if value]
+
+class StepJob:
+    # One move in progress. poll() sends any step that is due and returns
+    # the ns until the next one, or None once the move is done, so a caller
+    # can do other work (or await) in between steps.
+    def __init__(self, stepper, intervals):
+        self.stepper = stepper
+        self.intervals = iter(intervals)
+        self.steps_done = 0
+        self.deadline = stepper.clock.now()
+        self.schedule()
+
+    def schedule(self):
+        interval = next(self.intervals, None)
+        if interval is None:
+            self.deadline = None
+        else:
+            self.deadline += interval
+
+    def poll(self):
+        if self.deadline is None:
+            return None
+        now = self.stepper.clock.now()
+        if now < self.deadline:
+            return self.deadline - now
+        self.stepper.pulse()
+        self.steps_done += 1
+        # Next deadline is relative to the last one, not to now, so late
+        # steps don't make the move slower
+        self.schedule()
+        if self.deadline is None:
+            return None
+        return max(self.deadline - now, 0)
+
+    def done(self):
+        return self.deadline is None
+
+class DeadlineStepper:
+    def __init__(self, step_pin, dir_pin, clock=None):
+        self.step_pin = step_pin
+        self.dir_pin = dir_pin
+        self.clock = clock or MonotonicClock()
+
+    def pulse(self):
+        # The A4988 needs 1us high; toggling from Python already takes longer
+        self.step_pin.value = True
+        self.step_pin.value = False
+
+    def start(self, steps, direction, cruise_rate, accel, start_rate=0.0, end_rate=0.0):
+        self.dir_pin.value = direction
+        return StepJob(self, step_intervals(steps, cruise_rate, accel, start_rate, end_rate))
+
+    def move(self, steps, direction, cruise_rate, accel, start_rate=0.0, end_rate=0.0):
+        return run_job(self.start(steps, direction, cruise_rate, accel, start_rate, end_rate), self.clock)
+
+    async def move_async(self, steps, direction, cruise_rate, accel, start_rate=0.0, end_rate=0.0,
+                         yield_ns=2000000, yield_steps=64):
+        job = self.start(steps, direction, cruise_rate, accel, start_rate, end_rate)
+        return await run_job_async(job, self.clock, yield_ns, yield_steps)
+
+def run_job(job, clock):
+    # Send every step of a job, spinning until each deadline
+    while job.deadline is not None:
+        clock.wait_until(job.deadline)
+        job.poll()
+    return job.steps_done
+
+async def run_job_async(job, clock, yield_ns=2000000, yield_steps=64):
+    # Like run_job(), but sleeps in the event loop when the next step is at
+    # least yield_ns away and gives other tasks a turn every yield_steps
+    # steps during fast moves. Steps spaced closer than yield_ns are still
+    # timed by spinning so they stay on their deadlines.
+    import asyncio
+    steps_since_yield = 0
+    while job.deadline is not None:
+        wait = job.deadline - clock.now()
+        if wait >= yield_ns:
+            await clock.sleep(wait - yield_ns // 2)
+            steps_since_yield = 0
+            continue
+        if steps_since_yield >= yield_steps:
+            await asyncio.sleep(0)
+            steps_since_yield = 0
+        clock.wait_until(job.deadline)
+        job.poll()
+        steps_since_yield += 1
+    return job.steps_done
+
+# Several axes moving together. The axis with the most steps to go sets the
+# pace with the same trapezoidal profile as a single stepper; on each of its
+# steps the other axes step or not by Bresenham's line algorithm (a DDA), so
+# every axis takes its steps evenly spread over the move and all of them
+# finish on the same step.
+#
+#   axes = {"X": StepperAxis(x_step, x_dir, steps_per_mm=80),
+#           "Y": StepperAxis(y_step, y_dir, steps_per_mm=80)}
+#   motion = MultiAxisStepper(axes)
+#   motion.move({"X": 8000, "Y": 4000}, feed=1200, accel=500)
+#
+# Targets are absolute positions in steps. feed is in mm/min along the path
+# and accel in mm/s^2, as in planner.py.
+
+class StepperAxis:
+    def __init__(self, step_pin, dir_pin, steps_per_mm=1.0, max_rate=None, invert=False):
+        self.step_pin = step_pin
+        self.dir_pin = dir_pin
+        self.steps_per_mm = steps_per_mm
+        self.max_rate = max_rate  # steps/s, None for no limit
+        self.invert = invert
+
+class AxisMove:
+    # The Bresenham state of one move. StepJob calls pulse() for every step
+    # of the leading axis.
+    def __init__(self, clock, axes, counts):
+        self.clock = clock
+        self.axes = axes  # StepperAxis for each entry of counts
+        self.counts = counts  # Steps each axis takes
+        self.major = max(counts)
+        # Starting at half way spreads the steps evenly
+        self.errors = [self.major // 2] * len(counts)
+        self.due = [False] * len(counts)
+
+    def pulse(self):
+        counts = self.counts
+        errors = self.errors
+        due = self.due
+        major = self.major
+        axes = self.axes
+        for i in range(len(counts)):
+            errors[i] += counts[i]
+            if errors[i] >= major:
+                errors[i] -= major
+                due[i] = True
+        # All step pins of this tick go high together, then low together
+        for i in range(len(counts)):
+            if due[i]:
+                axes[i].step_pin.value = True
+        for i in range(len(counts)):
+            if due[i]:
+                axes[i].step_pin.value = False
+                due[i] = False
+
+class MultiAxisStepper:
+    def __init__(self, axes, clock=None):
+        # axes maps an axis letter to its StepperAxis, set up once
+        self.axes = axes
+        self.clock = clock or MonotonicClock()
+        self.position = {name: 0 for name in axes}
+
+    def start(self, target, feed, accel, start_speed=0.0, end_speed=0.0):
+        # A StepJob that moves to target, a dict of absolute step positions
+        # (axes left out stay where they are), or None if nothing moves.
+        # Speeds are in mm/s along the path.
+        names = []
+        axes = []
+        counts = []
+        length2 = 0.0
+        for name, axis in self.axes.items():
+            steps = int(target.get(name, self.position[name])) - self.position[name]
+            if not steps:
+                continue
+            names.append(name)
+            axes.append(axis)
+            counts.append(abs(steps))
+            axis.dir_pin.value = (steps > 0) != axis.invert
+            self.position[name] += steps
+            length2 += (steps / axis.steps_per_mm) ** 2
+        if not counts:
+            return None
+
+        # Steps of the leading axis per mm of path turn path speeds into its
+        # step rates
+        major = max(counts)
+        scale = major / math.sqrt(length2)
+        cruise_rate = feed / 60 * scale
+        for axis, count in zip(axes, counts):
+            if axis.max_rate is not None and cruise_rate * count / major > axis.max_rate:
+                cruise_rate = axis.max_rate * major / count
+        move = AxisMove(self.clock, axes, counts)
+        return StepJob(move, step_intervals(major, cruise_rate, accel * scale,
+                                            min(start_speed * scale, cruise_rate),
+                                            min(end_speed * scale, cruise_rate)))
+
+    def move(self, target, feed, accel, start_speed=0.0, end_speed=0.0):
+        job = self.start(target, feed, accel, start_speed, end_speed)
+        return run_job(job, self.clock) if job is not None else 0
+
+    async def move_async(self, target, feed, accel, start_speed=0.0, end_speed=0.0,
+                         yield_ns=2000000, yield_steps=64):
+        job = self.start(target, feed, accel, start_speed, end_speed)
+        if job is None:
+            return 0
+        return await run_job_async(job, self.clock, yield_ns, yield_steps)
+
+    def steps_for(self, name, mm):
+        return round(mm * self.axes[name].steps_per_mm)
+
+def simulated_axes(names, clock, steps_per_mm=1.0, max_rate=None):
+    # StepperAxis objects on SimulatedPins, to check moves without a board
+    return {name: StepperAxis(SimulatedPin(clock), SimulatedPin(clock), steps_per_mm, max_rate) for name in names}
+
+if __name__ == "__main__":
+    # python stepgen.py X8000 Y4000 [F1200] [A500] [steps_per_mm]
+    # Runs a move on simulated pins and reports how the axes kept together
+    import sys
+
+    words = {arg[0]: float(arg[1:]) for arg in sys.argv[1:] if arg[0].isalpha()}
+    steps_per_mm = float(next((arg for arg in sys.argv[1:] if not arg[0].isalpha()), 1.0))
+    clock = SimulatedClock()
+    names = [name for name in words if name not in "FA"]
+    motion = MultiAxisStepper(simulated_axes(names, clock, steps_per_mm), clock)
+    start = clock.now()
+    steps = motion.move({name: int(words[name]) for name in names}, words.get("F", 600.0), words.get("A", 500.0))
+    elapsed = (clock.now() - start) / NS
+    print(f"{steps} ticks in {elapsed:.4f} s")
+    # How far each axis got from the straight line, in steps, at every tick
+    ticks = max((motion.axes[name].step_pin.rising_edges() for name in names), key=len)
+    for name in names:
+        edges = motion.axes[name].step_pin.rising_edges()
+        last = (edges[-1] - start) / NS if edges else 0.0
+        deviation = 0.0
+        done = 0
+        for k, t in enumerate(ticks, 1):
+            while done < len(edges) and edges[done] <= t:
+                done += 1
+            deviation = max(deviation, abs(done - len(edges) * k / len(ticks)))
+        print(f"  {name}: {len(edges)} steps, last at {last:.4f} s, off the line by at most {deviation:.2f} steps")
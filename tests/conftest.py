@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the top of the repository. It goes at the end of the
+# path because code.py (the board's server) would hide the standard code
+# module that pytest imports.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
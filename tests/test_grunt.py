@@ -0,0 +1,22 @@
+import grunt
+
+def run(program, **options):
+    machine = grunt.Grunt(**options)
+    sent = []
+    machine.register("G1", lambda args: sent.append(dict(args)))
+    machine.register("WRITEMSG", sent.append)
+    machine.run(program)
+    return sent
+
+def test_loop_variable_stays_an_int():
+    program = "FOR #i 1 2\nG1 X[#i]\nWRITE val [#i]\nENDFOR\nWRITE after [#i]"
+    expected = [{"X": 1}, "val 1", {"X": 2}, "val 2", "after 2"]
+    assert run(program) == expected
+    assert run(program, optimize=True, unroll_limit=10) == expected
+
+def test_comparison_stays_a_bool():
+    assert run("#b = [2 GT 1]\nWRITE v [#b]") == ["v True"]
+
+def test_macro_arguments_are_floats():
+    program = "MACRO mv\nG1 X[$1] Y$2\nENDMACRO\nFOR #i 1 2\nCALL mv #i 10.0\nENDFOR"
+    assert run(program) == [{"X": 1.0, "Y": 10.0}, {"X": 2.0, "Y": 10.0}]
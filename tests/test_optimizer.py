@@ -0,0 +1,10 @@
+import grunt
+import optimizer
+
+def test_dump_shows_the_line_of_each_branch():
+    machine = grunt.Grunt()
+    program = machine.compile("#a = 1\nIF [#a LT 0]\nG1 X1\nELSEIF [#a LT 5]\nG1 X2\n\nELSEIF [#a LT 9]\nG1 X3\nENDIF")
+    lines = optimizer.dump(machine, program).split("\n")
+    assert lines[1].startswith("    2: IF ")
+    assert lines[3].startswith("    4: ELSEIF ")
+    assert lines[5].startswith("    7: ELSEIF ")
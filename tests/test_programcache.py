@@ -0,0 +1,38 @@
+import binascii
+import struct
+
+import pytest
+
+import grunt
+import programcache
+
+KEY = "00112233445566ff"
+
+def with_body(blob, body):
+    # The blob with another body and a header (CRC, length) that matches it
+    magic, version, key, _, _ = struct.unpack_from(programcache.HEADER, blob, 0)
+    return struct.pack(programcache.HEADER, magic, version, key, binascii.crc32(body), len(body)) + body
+
+@pytest.mark.parametrize("damage", [
+    lambda body: body[:len(body) // 2],              # Truncated: struct.error
+    lambda body: body[:-2] + b"\xff\xff",            # String out of the table: IndexError
+    lambda body: body.replace(b"\x01\x00*", b"\x01\x00?"),  # Unknown operator: KeyError
+])
+def test_corrupt_body_with_valid_crc_is_dropped(damage):
+    machine = grunt.Grunt()
+    program = "#a = 2\nG1 X[#a * 3] Y1\nWRITE done"
+    blob = programcache.dumps(machine, machine.compile(program), KEY)
+    body = blob[programcache.HEADER_SIZE:]
+    cache = programcache.ProgramCache()
+    cache.put(KEY, with_body(blob, damage(body)))
+    with pytest.raises(ValueError):
+        cache.load(machine, KEY)
+    assert KEY not in cache
+    assert cache.load(machine, KEY) is None
+
+def test_blob_round_trip():
+    machine = grunt.Grunt()
+    blob = programcache.dumps(machine, machine.compile("G1 X1"), KEY)
+    cache = programcache.ProgramCache()
+    cache.put(KEY, blob)
+    assert cache.load(machine, KEY).nodes[0][4] == {"X": 1.0}
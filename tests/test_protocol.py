@@ -0,0 +1,36 @@
+import protocol
+
+def test_block_too_long_is_dropped():
+    receiver = protocol.Receiver()
+    reply, _, statement = receiver.handle_line("@1 MACRO m")
+    assert reply.startswith("ACK 1") and statement is None
+    seq = 2
+    while receiver.assembler.lines:
+        reply, _, statement = receiver.handle_line(f"@{seq} G1 X{seq} Y{seq} F1200")
+        seq += 1
+    # The whole block so far is refused and nothing is held any more
+    assert "ERR 1 block too long\n" in reply
+    assert f"ERR {seq - 1} block too long\n" in reply
+    assert statement is None
+    assert receiver.held_lines == 0
+    assert seq - 1 < protocol.MAX_BLOCK // 10
+
+    # The rest of the block is dropped up to its END, with the window free
+    for _ in range(100000):
+        reply, _, statement = receiver.handle_line(f"@{seq} G1 X1")
+        assert reply == f"ACK {seq} {protocol.WINDOW_SIZE - 1}\nERR {seq} block too long\n"
+        seq += 1
+    reply, _, statement = receiver.handle_line(f"@{seq} ENDMACRO")
+    assert reply.endswith(f"ERR {seq} block too long\n") and statement is None
+    assert receiver.held_lines == 0 and not receiver.assembler.lines
+
+    # After that, statements run again
+    reply, _, statement = receiver.handle_line(f"@{seq + 1} G1 X2")
+    assert statement == ("G1 X2", [seq + 1])
+
+def test_block_within_limit_runs():
+    receiver = protocol.Receiver()
+    lines = ["FOR #i 1 3", "G1 X[#i]", "ENDFOR"]
+    for seq, line in enumerate(lines, 1):
+        _, _, statement = receiver.handle_line(f"@{seq} {line}")
+    assert statement == ("\n".join(lines), [1, 2, 3])
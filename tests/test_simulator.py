@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+import simulator
+
+PROGRAM = "G1 X10 F600\nG1 X20\nG1 X30"
+
+def test_no_lookahead_stops_after_every_move():
+    with_lookahead = simulator.Simulator().run(PROGRAM)["cycle_time"]
+    without = simulator.Simulator(lookahead=False).run(PROGRAM)["cycle_time"]
+    assert abs(with_lookahead - 3.02) < 1e-6
+    assert abs(without - 3.06) < 1e-6
+
+def test_no_lookahead_option_takes_longer(tmp_path):
+    path = tmp_path / "line.gcode"
+    path.write_text(PROGRAM)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def cycle_time(*options):
+        output = subprocess.run([sys.executable, "simulator.py", str(path), "--json", *options],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+        return json.loads(output)["cycle_time"]
+
+    assert cycle_time("--no-lookahead") > cycle_time()
@@ -0,0 +1,193 @@
+import grunt
+
+# Vectorized FOR loops. When a loop body is only G-code commands whose
+# words are arithmetic on variables (no READ/RECV, WRITE, CALL or nested
+# blocks), every pass can be worked out at once with NumPy over the range of
+# the loop variable instead of evaluating each word on each pass.
+#
+#   machine = grunt.Grunt(vectorize=True)
+#   machine.register_batch("G1", move_many)
+#
+# If all commands in the body go to the same batch handler, it gets whole
+# arrays; otherwise the values are worked out in bulk and the handlers are
+# called once per command as usual. Loops that don't qualify, or where a
+# value can't be computed this way (a division by zero, an unset or text
+# variable), run on the normal path from the pass they got to.
+
+MIN_PASSES = 64
+CHUNK = 4096
+
+PURE_ITEMS = (grunt.EXPR_CONST, grunt.EXPR_VAR, grunt.EXPR_OP)
+
+# Commands that arcs.py has to see one at a time
+ARC_TRACKED = ("G0", "G1", "G2", "G3", "G17", "G18", "G19")
+
+def vectorizable(body):
+    if not body:
+        return False
+    for node in body:
+        if node[0] != grunt.OP_GCODE:
+            return False
+        if node[5]:
+            for _, rpn, _ in node[4]:
+                if rpn and any(kind not in PURE_ITEMS for kind, _ in rpn):
+                    return False
+    return True
+
+def loop_qualifies(node):
+    # The checks run_for and iter_rows share: a body vectorizable() accepts
+    # and bounds that don't need READ/RECV
+    _, _, _, start, end, body = node
+    return vectorizable(body) and start[-1][0] != grunt.EXPR_IO and end[-1][0] != grunt.EXPR_IO
+
+def evaluate(machine, rpn, slot, index):
+    # Like Grunt.evaluate_rpn, with the loop variable as an array
+    stack = []
+    for kind, value in rpn:
+        if kind == grunt.EXPR_CONST:
+            stack.append(value)
+        elif kind == grunt.EXPR_VAR:
+            stack.append(index if value == slot else machine.variables.get_slot(value))
+        else:
+            b = stack.pop()
+            stack.append(value(stack.pop(), b))
+    return stack[0]
+
+def chunk_columns(machine, body, slot, index, np):
+    # For each command, its words as arrays (or single values) over index
+    columns = []
+    with np.errstate(divide="raise", invalid="raise"):
+        for node in body:
+            if node[5]:
+                words = {}
+                for key, rpn, value in node[4]:
+                    if rpn:
+                        value = evaluate(machine, rpn, slot, index)
+                        if isinstance(value, str):
+                            raise TypeError("text value")
+                    words[key] = value
+                columns.append(words)
+            else:
+                columns.append(node[4])
+    return columns
+
+def batch_target(machine, body):
+    # The batch collector every command in the body goes to, or None
+    target = None
+    for node in body:
+        handler = node[3][0] or machine.gcode_handlers.get(node[2])
+        if not isinstance(handler, grunt.BatchCollector) or (target is not None and handler is not target):
+            return None
+        target = handler
+    return target
+
+def row_values(words, count):
+    # Each word as a list with one value per pass
+    values = {}
+    for key, value in words.items():
+        if hasattr(value, "tolist"):
+            value = value.tolist()  # NumPy array or scalar to Python values
+        values[key] = value if isinstance(value, list) else [value] * count
+    return values
+
+def to_batch(collector, columns, count, np):
+    # Interleave the commands of each pass into one structured array
+    keys = []
+    for words in columns:
+        for key in words:
+            if key not in keys:
+                keys.append(key)
+    batch = np.empty(count * len(columns), dtype=[(key, 'f8') for key in keys])
+    for key in keys:
+        grid = np.full((count, len(columns)), np.nan)
+        for i, words in enumerate(columns):
+            if key in words:
+                try:
+                    grid[:, i] = words[key]
+                except ValueError:
+                    raise ValueError(f"{collector.code} batch has a non-numeric {key} argument")
+        batch[key] = grid.ravel()
+    return batch
+
+def emit_batch(machine, collector, columns, count, np):
+    if machine.pending_batch is not None:
+        machine.flush_batch()
+    batch = to_batch(collector, columns, count, np)
+    for start in range(0, len(batch), collector.max_batch):
+        collector.handler(batch[start:start + collector.max_batch])
+
+def emit_rows(machine, body, columns, count, slot, low):
+    # Call the handlers pass by pass, the way exec_gcode would, with the
+    # loop variable set to each pass's value
+    rows = [(node, row_values(words, count) if node[5] else words) for node, words in zip(body, columns)]
+    set_slot = machine.variables.set_slot
+    for i in range(count):
+        set_slot(slot, low + i)
+        for node, words in rows:
+            handler = node[3][0] or machine.gcode_handlers.get(node[2])
+            if handler is None:
+                print(f"Unknown command: {node[2]} (line {node[1]})")
+                continue
+            if machine.pending_batch is not None and handler is not machine.pending_batch:
+                machine.flush_batch()
+            handler({key: values[i] for key, values in words.items()} if node[5] else words)
+
+def run_for(machine, node, batch_only=False):
+    # Runs the loop and returns True, or returns False without doing
+    # anything if it can't be vectorized
+    _, line_no, slot, start, end, body = node
+    if not loop_qualifies(node):
+        return False
+    if machine.arcs is not None and any(command[2] in ARC_TRACKED for command in body):
+        return False  # The arc position has to follow every move
+    collector = batch_target(machine, body)
+    if batch_only and collector is None:
+        return False
+    try:
+        import numpy as np
+    except ImportError:
+        return False
+    first = int(machine.evaluate_rpn(start))
+    last = int(machine.evaluate_rpn(end))
+    if last - first + 1 < MIN_PASSES:
+        return False
+
+    for low in range(first, last + 1, CHUNK):
+        high = min(low + CHUNK, last + 1)
+        index = np.arange(low, high, dtype=np.float64)
+        try:
+            columns = chunk_columns(machine, body, slot, index, np)
+        except (ArithmeticError, KeyError, TypeError, ValueError):
+            # Let the normal path run the rest and raise what it raises
+            machine.exec_for((grunt.OP_FOR, line_no, slot, [(grunt.EXPR_CONST, low)], end, body))
+            return True
+        if collector is not None:
+            # A batch handler gets many passes at once and sees the last
+            machine.variables.set_slot(slot, high - 1)
+            emit_batch(machine, collector, columns, high - low, np)
+        else:
+            emit_rows(machine, body, columns, high - low, slot, low)
+    # Where the normal path leaves it
+    machine.variables.set_slot(slot, last)
+    return True
+
+def iter_rows(machine, node):
+    # The (code, args) of every command the loop runs, worked out a chunk at
+    # a time, without calling any handlers. Only for loops run_for could
+    # vectorize: anything else raises ValueError.
+    _, line_no, slot, start, end, body = node
+    if not loop_qualifies(node):
+        raise ValueError(f"FOR loop at line {line_no} can't be vectorized")
+    import numpy as np
+    first = int(machine.evaluate_rpn(start))
+    last = int(machine.evaluate_rpn(end))
+    for low in range(first, last + 1, CHUNK):
+        count = min(low + CHUNK, last + 1) - low
+        try:
+            columns = chunk_columns(machine, body, slot, np.arange(low, low + count, dtype=np.float64), np)
+        except (ArithmeticError, KeyError, TypeError) as e:
+            raise ValueError(f"FOR loop at line {line_no} can't be vectorized from pass {low}: {e!r}")
+        values = [row_values(words, count) for words in columns]
+        for i in range(count):
+            for command, words in zip(body, values):
+                yield command[2], {key: column[i] for key, column in words.items()}